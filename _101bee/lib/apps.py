@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class LibConfig(AppConfig):
+    name = '_101bee.lib'
+
+    def ready(self):
+        from .database import apply_sqlite_pragmas
+        connection_created.connect(apply_sqlite_pragmas)
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs writers inserting collection cycles alongside readers querying '
+        'history against a scratch SQLite file, first with stock settings '
+        'and then with SQLITE_PRAGMAS, and compares throughput and locking.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=200000,
+            help='Readings seeded before the run.'
+        )
+
+    def handle(self, *args, **options):
+        for label, pragmas in [
+            ('stock', {}),
+            ('tuned', settings.SQLITE_PRAGMAS),
+        ]:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'benchmark.sqlite3')
+                _seed(path, options['rows'])
+                stats = self._run(path, pragmas, options)
+            seconds = options['seconds']
+            reads = sorted(stats['read_times']) or [0]
+            self.stdout.write(
+                f"{label:<6} "
+                f"writes {stats['writes'] / seconds:8.1f}/s  "
+                f"reads {len(stats['read_times']) / seconds:8.1f}/s  "
+                f"read p95 {reads[int(len(reads) * 0.95)] * 1000:7.1f} ms  "
+                f"locked {stats['locked']}"
+            )
+
+    def _run(self, path, pragmas, options):
+        stats = {'writes': 0, 'read_times': [], 'locked': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['seconds']
+
+        def connect():
+            # The stock run keeps sqlite3's own 5 second busy timeout.
+            db = sqlite3.connect(path, isolation_level=None)
+            for pragma, value in pragmas.items():
+                db.execute(f"PRAGMA {pragma} = {value}")
+            return db
+
+        def write():
+            db = connect()
+            while time.monotonic() < deadline:
+                try:
+                    db.execute('BEGIN IMMEDIATE')
+                    db.executemany(
+                        'INSERT INTO reading (sensor_id, created_at, '
+                        'temperature) VALUES (?, ?, ?)',
+                        [(x, datetime.now().isoformat(), 20.0)
+                         for x in range(10)]
+                    )
+                    db.execute('COMMIT')
+                    with lock:
+                        stats['writes'] += 1
+                except sqlite3.OperationalError:
+                    if db.in_transaction:
+                        db.execute('ROLLBACK')
+                    with lock:
+                        stats['locked'] += 1
+            db.close()
+
+        def read():
+            db = connect()
+            start = (datetime.now() - timedelta(days=1)).isoformat()
+            while time.monotonic() < deadline:
+                started = time.monotonic()
+                try:
+                    db.execute(
+                        'SELECT sensor_id, created_at, temperature '
+                        'FROM reading WHERE created_at >= ? '
+                        'ORDER BY sensor_id, created_at',
+                        [start]
+                    ).fetchall()
+                except sqlite3.OperationalError:
+                    with lock:
+                        stats['locked'] += 1
+                    continue
+                with lock:
+                    stats['read_times'].append(time.monotonic() - started)
+            db.close()
+
+        threads = [
+            threading.Thread(target=write)
+            for _ in range(options['writers'])
+        ] + [
+            threading.Thread(target=read)
+            for _ in range(options['readers'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stats
+
+
+# Utils
+def _seed(path, rows):
+    db = sqlite3.connect(path)
+    db.execute(
+        'CREATE TABLE reading (id INTEGER PRIMARY KEY, sensor_id INTEGER, '
+        'created_at TEXT, temperature REAL)'
+    )
+    db.execute('CREATE INDEX reading_created ON reading (created_at)')
+    now = datetime.now()
+    db.executemany(
+        'INSERT INTO reading (sensor_id, created_at, temperature) '
+        'VALUES (?, ?, ?)',
+        [
+            (x % 10, (now - timedelta(minutes=x // 10 * 5)).isoformat(), 20.0)
+            for x in range(rows)
+        ]
+    )
+    db.commit()
+    db.close()
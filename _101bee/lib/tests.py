@@ -0,0 +1,18 @@
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+
+from .database import apply_sqlite_pragmas
+
+
+class SqlitePragmaTests(TransactionTestCase):
+    @override_settings(SQLITE_PRAGMAS={
+        'synchronous': 'off',
+        'busy_timeout': 1234
+    })
+    def test_pragmas_are_applied_to_new_connections(self):
+        apply_sqlite_pragmas(None, connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1234)
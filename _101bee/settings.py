@@ -82,9 +82,23 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ROOT_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': ENV.int('DJANGO__CONN_MAX_AGE', default=600),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Applied to every new SQLite connection (see _101bee.lib.database). WAL lets
+# the dashboard read while collection writes, and synchronous=NORMAL is safe
+# under WAL. cache_size is in KiB when negative; busy_timeout in ms.
+SQLITE_PRAGMAS = {
+    'journal_mode': ENV.str('SQLITE__JOURNAL_MODE', default='wal'),
+    'synchronous': ENV.str('SQLITE__SYNCHRONOUS', default='normal'),
+    'cache_size': ENV.int('SQLITE__CACHE_SIZE', default=-32000),
+    'mmap_size': ENV.int('SQLITE__MMAP_SIZE', default=268435456),
+    'busy_timeout': ENV.int('SQLITE__BUSY_TIMEOUT', default=20000),
+    'temp_store': 'memory',
+}
+
 
 # Password validation #
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -156,3 +170,78 @@ CORS_ALLOW_HEADERS = (
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'login'
+
+# Hue Bridge
+HUE_BRIDGE_TIMEOUT = ENV.float('HUE_BRIDGE__TIMEOUT', default=5)
+HUE_BRIDGE_POOL_SIZE = ENV.int('HUE_BRIDGE__POOL_SIZE', default=4)
+HUE_BRIDGE_CONNECT_RETRIES = ENV.int('HUE_BRIDGE__CONNECT_RETRIES', default=3)
+HUE_BRIDGE_BATCH_WORKERS = ENV.int('HUE_BRIDGE__BATCH_WORKERS', default=3)
+HUE_BRIDGE_WRITES_PER_SECOND = ENV.float(
+    'HUE_BRIDGE__WRITES_PER_SECOND',
+    default=10
+)
+HUE_BRIDGE_CACHE_TTL = ENV.float('HUE_BRIDGE__CACHE_TTL', default=5)
+HUE_BRIDGE_CACHE_TTLS = {
+    'device': 30,
+    'device_power': 60,
+    'room': 30,
+}
+HUE_BRIDGE_EVENTSTREAM = ENV.bool('HUE_BRIDGE__EVENTSTREAM', default=False)
+HUE_BRIDGE_EVENTSTREAM_IDLE = ENV.float(
+    'HUE_BRIDGE__EVENTSTREAM_IDLE',
+    default=300
+)
+
+# Lights Page
+LIGHTS_PAGE_DEADLINE = ENV.float('LIGHTS__PAGE_DEADLINE', default=8)
+LIGHTS_LOADER_WORKERS = ENV.int('LIGHTS__LOADER_WORKERS', default=10)
+# Serve the Lights page from the async view when running under ASGI.
+LIGHTS_ASYNC = ENV.bool('LIGHTS__ASYNC', default=False)
+
+# Heating
+HEATING_POLL_WORKERS = ENV.int('HEATING__POLL_WORKERS', default=8)
+HEATING_SENSOR_DEADLINE = ENV.float('HEATING__SENSOR_DEADLINE', default=10)
+HEATING_CYCLE_DEADLINE = ENV.float('HEATING__CYCLE_DEADLINE', default=30)
+HEATING_ESP8266_KEEPALIVE = ENV.float('HEATING__ESP8266_KEEPALIVE', default=60)
+HEATING_POLL_INTERVAL = ENV.float('HEATING__POLL_INTERVAL', default=300)
+HEATING_POLL_INTERVALS = {
+    'esp8266_heat_pump': 60,
+    'esp8266_room': 120,
+}
+HEATING_SCHEDULER_LOCK = ENV.str(
+    'HEATING__SCHEDULER_LOCK',
+    default=str(ROOT_DIR / '.heating-scheduler.lock')
+)
+HEATING_CHART_POINTS = ENV.int('HEATING__CHART_POINTS', default=500)
+HEATING_RETENTION_DAYS = ENV.int('HEATING__RETENTION_DAYS', default=180)
+HEATING_RETENTION_PAUSE = ENV.float('HEATING__RETENTION_PAUSE', default=0.1)
+HEATING_VACUUM_FREE_RATIO = ENV.float(
+    'HEATING__VACUUM_FREE_RATIO',
+    default=0.2
+)
+HEATING_ARCHIVE_DIR = Path(ENV.str(
+    'HEATING__ARCHIVE_DIR',
+    default=str(ROOT_DIR / 'archive')
+))
+
+# Daikin
+DAIKIN_REFRESH_MARGIN = ENV.float('DAIKIN__REFRESH_MARGIN', default=300)
+DAIKIN_TEMPS_TTL = ENV.float('DAIKIN__TEMPS_TTL', default=60)
+
+# Entry
+ENTRY_PROBE_TIMEOUT = ENV.float('ENTRY__PROBE_TIMEOUT', default=2)
+ENTRY_PROBE_WORKERS = ENV.int('ENTRY__PROBE_WORKERS', default=4)
+ENTRY_HEALTH_TTL = ENV.float('ENTRY__HEALTH_TTL', default=30)
+ENTRY_MONITOR_INTERVAL = ENV.float('ENTRY__MONITOR_INTERVAL', default=30)
+ENTRY_MONITOR_MAX_BACKOFF = ENV.float(
+    'ENTRY__MONITOR_MAX_BACKOFF',
+    default=600
+)
+ENTRY_MONITOR_LOCK = ENV.str(
+    'ENTRY__MONITOR_LOCK',
+    default=str(ROOT_DIR / '.entry-monitor.lock')
+)
+ENTRY_STREAM_POLL = ENV.float('ENTRY__STREAM_POLL', default=2)
+# Each status stream holds a sync worker, so it is kept short; the browser
+# reconnects when it ends.
+ENTRY_STREAM_DURATION = ENV.float('ENTRY__STREAM_DURATION', default=25)
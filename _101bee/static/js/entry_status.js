@@ -0,0 +1,31 @@
+// Keep door statuses current without reloading the page.
+const statusBadges = {
+    'open': ['button-danger', 'door_open', 'Currently Open'],
+    'closed': ['button-success', 'door_front', 'Currently Closed'],
+    'locked': ['button-success', 'lock', 'Currently Locked'],
+    'unlocked': ['button-success', 'lock_open', 'Currently Unlocked'],
+    'connected': ['button-success', 'link', 'Connected'],
+    'not_connected': ['button-danger', 'link_off', 'Not Connected'],
+};
+const unknownBadge = ['button-warning', 'link_off', 'Status Unknown'];
+
+function showDoorStatus(door) {
+  var badge = document.querySelector(`[data-door-status="${door.id}"]`);
+  if (!badge) {
+      return;
+  }
+  var [colour, icon, label] = statusBadges[door.status] || unknownBadge;
+  badge.innerHTML = (
+      `<span class="badge ${colour} mb-3 mt-0">` +
+      `<span class="material-symbols-outlined md-dark md-18 align-middle">${icon}</span> ` +
+      `${label}</span>`
+  );
+  document.querySelectorAll(`button[data-door="${door.id}"]`).forEach(
+      button => button.disabled = door.status == 'not_connected'
+  );
+}
+
+const doorStatus = new EventSource(doorStatusUrl);
+doorStatus.onmessage = function(event) {
+  JSON.parse(event.data)['doors'].forEach(showDoorStatus);
+};
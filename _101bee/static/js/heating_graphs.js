@@ -3,15 +3,14 @@ const dailyChart = document.getElementById('dailyChart');
 const weeklyChart = document.getElementById('weeklyChart');
 const monthlyChart = document.getElementById('monthlyChart');
 const yearlyChart = document.getElementById('yearlyChart');
-var dataset_shortlist = []
 
 // Create datasets from data
-function addToShortlist(name, data, colour, hide) {
+function addToShortlist(shortlist, name, data, colour, hide) {
   var dataRecords = data.map(item => ({
     x: new Date(item.x),
     y: item.y
   }));
-  dataset_shortlist.push({
+  shortlist.push({
     label: name,
     data: dataRecords,
     backgroundColor: 'transparent',
@@ -21,10 +20,6 @@ function addToShortlist(name, data, colour, hide) {
     hidden: hide
   });
 }
-addToShortlist('Room Setpoint', roomSetpointRecordsJSON, '#9C5013', true);
-addToShortlist('Tank Setpoint', tankSetpointRecordsJSON, 'darkblue', true);
-addToShortlist('Flow', flowTemperatureRecordsJSON, '#204809', false);
-addToShortlist('Return', returnTemperatureRecordsJSON, '#B7B863', false);
 
 const cooler_room = 'rgb(0, 153, 0, 0.3)';
 const colours = {
@@ -51,27 +46,7 @@ const hide_these_datatsets = [
     'Plant Room'
 ]
 
-for (sensor_name in sensorRecords) {
-    sensor_records = sensorRecords[sensor_name];
-    var colour = 'rgb(214, 111, 26, 0.5)';
-    if (sensor_name in colours) {
-        colour = colours[sensor_name];
-    }
-    var hide_dataset = false;
-    if (hide_these_datatsets.includes(sensor_name)) {
-        hide_dataset = true;
-    }
-    addToShortlist(
-      sensor_name,
-      JSON.parse(sensor_records),
-      colour,
-      hide_dataset
-    );
-}
-
-// Re-Order Datasets
-var datasets = [];
-var ordering = [
+const ordering = [
     'Room Setpoint',
     'Thermostat',
     'Kitchen',
@@ -93,19 +68,73 @@ var ordering = [
     'Flow',
     'Return'
 ];
-for (var s = 0; s < ordering.length; s++) {
-    var search_for = ordering[s];
-    for (var d = 0; d < dataset_shortlist.length; d++) {
-        let dataset_name = dataset_shortlist[d].label;
-        if (search_for == dataset_name) {
-            datasets.push(dataset_shortlist.splice(d, 1)[0]);
-        }
-    }
+
+// Each chart window is fetched when it is first shown, at the resolution
+// that suits its length.
+const chartColumns = {
+    'room_setpoint': ['Room Setpoint', '#9C5013', true],
+    'tank_setpoint': ['Tank Setpoint', 'darkblue', true],
+    'flow_temperature': ['Flow', '#204809', false],
+    'return_temperature': ['Return', '#B7B863', false],
+};
+var loadedCharts = [];
+
+function withHistory(chart_window, draw) {
+  if (loadedCharts.includes(chart_window)) {
+      return;
+  }
+  loadedCharts.push(chart_window);
+  var params = new URLSearchParams({
+      start: chartWindows[chart_window]['start'],
+      end: timeNow,
+      resolution: chartWindows[chart_window]['resolution'],
+      points: chartPoints
+  });
+  fetch(historyUrl + '?' + params)
+    .then(response => response.json())
+    .then(data => draw(buildDatasets(data['series'])));
+}
+
+function buildDatasets(series) {
+  var dataset_shortlist = [];
+  for (const item of series) {
+      var sensor_name = item['name'];
+      var colour = 'rgb(214, 111, 26, 0.5)';
+      var hide_dataset = false;
+      if (item['sensor'] === null) {
+          [sensor_name, colour, hide_dataset] = chartColumns[item['field']];
+      }
+      if (sensor_name in colours) {
+          colour = colours[sensor_name];
+      }
+      if (hide_these_datatsets.includes(sensor_name)) {
+          hide_dataset = true;
+      }
+      addToShortlist(
+        dataset_shortlist,
+        sensor_name,
+        item['points'],
+        colour,
+        hide_dataset
+      );
+  }
+
+  // Re-Order Datasets
+  var datasets = [];
+  for (var s = 0; s < ordering.length; s++) {
+      var search_for = ordering[s];
+      for (var d = 0; d < dataset_shortlist.length; d++) {
+          let dataset_name = dataset_shortlist[d].label;
+          if (search_for == dataset_name) {
+              datasets.push(dataset_shortlist.splice(d, 1)[0]);
+          }
+      }
+  }
+  return datasets.concat(dataset_shortlist);
 }
-datasets = datasets.concat(dataset_shortlist);
 
 // Create Daily chart straight away.
-new Chart(dailyChart, {
+withHistory('day', datasets => new Chart(dailyChart, {
     type: 'line',
     data: {
       datasets: datasets
@@ -166,12 +195,12 @@ new Chart(dailyChart, {
             }
         }
     }
-});
+}));
 
 
 // Prep other graphs
 function loadTwoDailyChart() {
-  new Chart(twoDailyChart, {
+  withHistory('two_days', datasets => new Chart(twoDailyChart, {
       type: 'line',
       data: {
         datasets: datasets
@@ -209,11 +238,11 @@ function loadTwoDailyChart() {
           }
         }
       }
-  });
+  }));
 }
 
 function loadWeeklyChart() {
-  new Chart(weeklyChart, {
+  withHistory('week', datasets => new Chart(weeklyChart, {
       type: 'line',
       data: {
         datasets: datasets
@@ -257,11 +286,11 @@ function loadWeeklyChart() {
           }
         }
       }
-  });
+  }));
 }
 
 function loadMonthlyChart() {
-  new Chart(monthlyChart, {
+  withHistory('month', datasets => new Chart(monthlyChart, {
       type: 'line',
       data: {
         datasets: datasets
@@ -305,11 +334,11 @@ function loadMonthlyChart() {
           }
         }
       }
-  });
+  }));
 }
 
 function loadYearlyChart() {
-  new Chart(yearlyChart, {
+  withHistory('year', datasets => new Chart(yearlyChart, {
       type: 'line',
       data: {
         datasets: datasets
@@ -353,7 +382,7 @@ function loadYearlyChart() {
           }
         }
       }
-  });
+  }));
 }
 
 function loadGraph(graph_name) {
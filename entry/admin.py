@@ -4,7 +4,9 @@ from .models import *
 
 
 class DoorAdmin(admin.ModelAdmin):
-    list_display = ('name', 'type', 'address', 'status', )
+    list_display = (
+        'name', 'type', 'address', 'status', 'checked_at', 'latency',
+    )
 
     @admin.display(description='Door Address')
     def address(self, door):
@@ -37,6 +39,13 @@ class EntryUserAccessAdmin(admin.ModelAdmin):
             return object.User.username
 
 
+class DoorTransitionAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'Door', 'previous_status', 'status',
+                    'latency', )
+    list_filter = ('Door', )
+
+
 admin.site.register(Door, DoorAdmin)
+admin.site.register(DoorTransition, DoorTransitionAdmin)
 admin.site.register(Key, KeyAdmin)
 admin.site.register(EntryUserAccess, EntryUserAccessAdmin)
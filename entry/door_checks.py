@@ -0,0 +1,150 @@
+import fcntl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Max
+
+from .models import Door, DoorTransition
+
+
+# Health Checks
+# Doors are probed together, each with a short timeout, and their statuses
+# are written back in one bulk_update. The Entry page renders from the
+# stored statuses. While monitor_doors runs it keeps them current; without
+# it, the page asks for a background refresh once they are older than
+# ENTRY_HEALTH_TTL.
+_probe_pool = ThreadPoolExecutor(
+    max_workers=settings.ENTRY_PROBE_WORKERS,
+    thread_name_prefix='door-probe'
+)
+_refreshing = threading.Lock()
+
+
+def is_probed(door):
+    # These are just going to have to be unique for now
+    return door.name == 'Garage'
+
+
+def probe(door):
+    # Returns the door's status and how long it took to answer.
+    started = time.monotonic()
+    try:
+        r = requests.get(
+            f"http://{door.ip}:{door.port}/hellooo",
+            timeout=settings.ENTRY_PROBE_TIMEOUT
+        )
+    except requests.RequestException as e:
+        print(f"{door.name} did not respond: {e}")
+        return 'not_connected', None
+    status = 'connected' if r.status_code == 200 else 'not_connected'
+    return status, time.monotonic() - started
+
+
+def check_doors(doors=None):
+    '''
+        Probes every door that can be probed at once and saves their
+        statuses with a single bulk_update, logging a DoorTransition for
+        each one that changed. Returns the doors checked.
+    '''
+    if doors is None:
+        doors = Door.objects.all()
+    doors = [x for x in doors if is_probed(x)]
+    if not doors:
+        return []
+
+    previous = {x.id: x.status for x in doors}
+    futures = {_probe_pool.submit(probe, x): x for x in doors}
+    # The timeout covers connecting and reading separately.
+    done, _ = wait(futures, timeout=settings.ENTRY_PROBE_TIMEOUT * 2)
+    checked_at = datetime.now()
+    for future, door in futures.items():
+        door.status, door.latency = future.result() if future in done \
+            else ('not_connected', None)
+        door.checked_at = checked_at
+
+    transitions = [
+        DoorTransition(
+            Door=x,
+            created_at=checked_at,
+            previous_status=previous[x.id],
+            status=x.status,
+            latency=x.latency
+        )
+        for x in doors if x.status != previous[x.id]
+    ]
+    with transaction.atomic():
+        Door.objects.bulk_update(doors, ['status', 'checked_at', 'latency'])
+        DoorTransition.objects.bulk_create(transitions)
+    return doors
+
+
+def refresh_stale(doors):
+    '''
+        Starts a background check if any of the doors' statuses are older
+        than ENTRY_HEALTH_TTL, and returns straight away. Does nothing while
+        monitor_doors is running, so its backoff isn't cut short.
+    '''
+    cutoff = datetime.now() - timedelta(seconds=settings.ENTRY_HEALTH_TTL)
+    if not any(
+        is_probed(x) and (not x.checked_at or x.checked_at < cutoff)
+        for x in doors
+    ):
+        return False
+    if _monitor_running():
+        return False
+    if not _refreshing.acquire(blocking=False):
+        return False
+
+    def refresh():
+        try:
+            check_doors()
+        finally:
+            _refreshing.release()
+            close_old_connections()
+
+    threading.Thread(
+        target=refresh,
+        name='door-health-refresh',
+        daemon=True
+    ).start()
+    return True
+
+
+def statuses():
+    '''
+        The last known state of every door, for the Entry page to poll or
+        stream.
+    '''
+    doors = Door.objects.annotate(
+        changed_at=Max('doortransition__created_at')
+    ).order_by('id').values_list(
+        'id', 'name', 'status', 'checked_at', 'changed_at', 'latency'
+    )
+    return [
+        {
+            'id': id,
+            'name': name,
+            'status': status,
+            'checked_at': checked_at.isoformat() if checked_at else None,
+            'changed_at': changed_at.isoformat() if changed_at else None,
+            'latency': latency,
+        }
+        for id, name, status, checked_at, changed_at, latency in doors
+    ]
+
+
+# Utils
+def _monitor_running():
+    # monitor_doors holds this lock for as long as it runs.
+    with open(settings.ENTRY_MONITOR_LOCK, 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return False
@@ -0,0 +1,64 @@
+import fcntl
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from entry.door_checks import check_doors
+from entry.monitor import DoorMonitor
+
+
+class Command(BaseCommand):
+    help = (
+        'Keeps door statuses current, probing each door every '
+        'ENTRY_MONITOR_INTERVAL and backing off from doors that are offline.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Probe every door once and exit.'
+        )
+
+    def handle(self, *args, **options):
+        # Only one monitor may probe at a time, however many are started.
+        lock = open(settings.ENTRY_MONITOR_LOCK, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CommandError('Another door monitor is running.')
+
+        monitor = DoorMonitor(
+            settings.ENTRY_MONITOR_INTERVAL,
+            settings.ENTRY_MONITOR_MAX_BACKOFF,
+            self.check_doors,
+            self.report
+        )
+        try:
+            if options['once']:
+                monitor.run_pending()
+            else:
+                monitor.run_forever(lambda: False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def check_doors(self, doors):
+        close_old_connections()
+        return check_doors(doors)
+
+    def report(self, doors, stats):
+        for door in doors:
+            door_stats = stats[door.name]
+            latency = f" in {door.latency * 1000:.0f}ms" if door.latency else ''
+            self.stdout.write(
+                f"{door.name} is {door.status}{latency} "
+                f"(probes={door_stats['probes']} "
+                f"failures={door_stats['failures']} "
+                f"transitions={door_stats['transitions']} "
+                f"mean={door_stats['mean_latency'] * 1000:.0f}ms "
+                f"max={door_stats['max_latency'] * 1000:.0f}ms)"
+            )
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -25,6 +27,18 @@ class Door(models.Model):
         blank=True,
         null=True
     )
+    checked_at = models.DateTimeField(
+        'Last Checked',
+        blank=True,
+        null=True,
+        editable=False
+    )
+    latency = models.FloatField(
+        'Probe Latency (s)',
+        blank=True,
+        null=True,
+        editable=False
+    )
     type = models.CharField(
         'Type',
         max_length=64,
@@ -41,6 +55,42 @@ class Door(models.Model):
         return self.name
 
 
+class DoorTransition(models.Model):
+    created_at = models.DateTimeField(default=datetime.now, editable=False)
+    door = models.ForeignKey(
+        Door,
+        name='Door',
+        blank=False,
+        null=False,
+        on_delete=models.CASCADE
+    )
+    previous_status = models.CharField(
+        'Previous Status',
+        max_length=64,
+        blank=True,
+        null=True
+    )
+    status = models.CharField(
+        'Status',
+        max_length=64,
+        blank=True,
+        null=True
+    )
+    latency = models.FloatField(
+        'Probe Latency (s)',
+        blank=True,
+        null=True
+    )
+
+    def __str__(self):
+        return f"{self.created_at}: {self.Door} {self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['Door', 'created_at']),
+        ]
+
+
 class Key(models.Model):
     door = models.ForeignKey(
         Door,
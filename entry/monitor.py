@@ -0,0 +1,80 @@
+import time
+
+from .door_checks import check_doors, is_probed
+from .models import Door
+
+
+class DoorMonitor:
+    '''
+        Probes doors every interval. A door that is offline is tried again
+        after interval * 2 ** failures, up to max_backoff, so dead doors
+        don't tie up probes; it goes back to the normal interval as soon as
+        it answers.
+    '''
+    def __init__(self, interval, max_backoff, check=check_doors,
+                 report=None, clock=time.monotonic, sleep=time.sleep):
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.check = check
+        self.report = report
+        self.clock = clock
+        self.sleep = sleep
+        self.next_checks = {}
+        self.failures = {}
+        self.stats = {}
+
+    def due(self, doors):
+        now = self.clock()
+        return [x for x in doors if self.next_checks.get(x.id, 0) <= now]
+
+    def run_pending(self):
+        doors = self.due(x for x in Door.objects.all() if is_probed(x))
+        if not doors:
+            return []
+        checked = self.check(doors)
+        now = self.clock()
+        for door in checked:
+            if door.status == 'connected':
+                self.failures[door.id] = 0
+                delay = self.interval
+            else:
+                self.failures[door.id] = self.failures.get(door.id, 0) + 1
+                delay = min(
+                    self.interval * 2 ** self.failures[door.id],
+                    self.max_backoff
+                )
+            self.next_checks[door.id] = now + delay
+            self._record(door)
+        if self.report:
+            self.report(checked, self.stats)
+        return checked
+
+    def run_forever(self, stopped):
+        while not stopped():
+            self.run_pending()
+            now = self.clock()
+            wait = min(self.next_checks.values(), default=now + self.interval)
+            self.sleep(max(wait - now, 1))
+
+    def _record(self, door):
+        stats = self.stats.setdefault(door.name, {
+            'probes': 0,
+            'failures': 0,
+            'transitions': 0,
+            'status': None,
+            'last_latency': None,
+            'mean_latency': 0.0,
+            'max_latency': 0.0,
+        })
+        stats['probes'] += 1
+        if stats['status'] is not None and stats['status'] != door.status:
+            stats['transitions'] += 1
+        stats['status'] = door.status
+        if door.latency is None:
+            stats['failures'] += 1
+            return
+        answered = stats['probes'] - stats['failures']
+        stats['last_latency'] = door.latency
+        stats['mean_latency'] += \
+            (door.latency - stats['mean_latency']) / answered
+        stats['max_latency'] = max(stats['max_latency'], door.latency)
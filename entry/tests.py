@@ -1,3 +1,142 @@
-from django.test import TestCase
+import fcntl
+import json
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .door_checks import check_doors, refresh_stale
+from .models import Door, DoorTransition, EntryUserAccess
+from .monitor import DoorMonitor
+
+
+@override_settings(ENTRY_PROBE_TIMEOUT=0.2)
+class DoorCheckTests(TestCase):
+    def setUp(self):
+        self.released = threading.Event()
+        self.addCleanup(self.released.set)
+        self.garage = Door.objects.create(
+            name='Garage', ip='10.0.0.5', port=80, type='open-close'
+        )
+
+    def _hang(self, *args, **kwargs):
+        self.released.wait(5)
+
+    def test_unresponsive_door_is_marked_quickly(self):
+        with mock.patch(
+            'entry.door_checks.requests.get', side_effect=self._hang
+        ), CaptureQueriesContext(connection) as queries:
+            started = time.monotonic()
+            check_doors()
+            duration = time.monotonic() - started
+
+        self.assertLess(duration, 1)
+        updates = [
+            x for x in queries.captured_queries
+            if x['sql'].startswith('UPDATE')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.garage.refresh_from_db()
+        self.assertEqual(self.garage.status, 'not_connected')
+        self.assertIsNotNone(self.garage.checked_at)
+        transition = DoorTransition.objects.get()
+        self.assertEqual(
+            (transition.previous_status, transition.status),
+            (None, 'not_connected')
+        )
+
+    def test_entry_page_renders_from_last_known_state(self):
+        user = User.objects.create_user('entry')
+        EntryUserAccess.objects.create(User=user)
+        self.client.force_login(user)
+        with mock.patch('entry.door_checks.requests.get') as get, \
+                mock.patch('entry.views.door_checks.refresh_stale') as refresh:
+            response = self.client.get(reverse('entry'))
+        self.assertEqual(response.status_code, 200)
+        get.assert_not_called()
+        refresh.assert_called_once()
+
+    def test_page_leaves_probing_to_a_running_monitor(self):
+        lock = tempfile.NamedTemporaryFile()
+        self.addCleanup(lock.close)
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with override_settings(ENTRY_MONITOR_LOCK=lock.name), \
+                mock.patch('entry.door_checks.threading.Thread') as thread:
+            self.assertFalse(refresh_stale([self.garage]))
+        thread.assert_not_called()
+
+
+class DoorMonitorTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.online = False
+        self.garage = Door.objects.create(
+            name='Garage', ip='10.0.0.5', port=80, type='open-close'
+        )
+        self.monitor = DoorMonitor(
+            30,
+            200,
+            check=self._check,
+            clock=lambda: self.now
+        )
+
+    def _check(self, doors):
+        for door in doors:
+            door.status = 'connected' if self.online else 'not_connected'
+            door.latency = 0.05 if self.online else None
+        return doors
+
+    def _probed_at(self, times):
+        probed = []
+        for self.now in times:
+            if self.monitor.run_pending():
+                probed.append(self.now)
+        return probed
+
+    def test_offline_doors_back_off_until_they_answer(self):
+        self.assertEqual(
+            self._probed_at(range(0, 600, 10)),
+            [0, 60, 180, 380, 580]
+        )
+        self.online = True
+        self.assertEqual(
+            self._probed_at(range(600, 900, 10)),
+            [780, 810, 840, 870]
+        )
+        stats = self.monitor.stats['Garage']
+        self.assertEqual(stats['transitions'], 1)
+        self.assertEqual(stats['failures'], 5)
+        self.assertEqual(stats['mean_latency'], 0.05)
+
+
+@override_settings(ENTRY_STREAM_DURATION=0.1, ENTRY_STREAM_POLL=0.05)
+class DoorStatusTests(TestCase):
+    def test_statuses_are_served_as_json_and_events(self):
+        user = User.objects.create_user('entry')
+        EntryUserAccess.objects.create(User=user)
+        self.client.force_login(user)
+        door = Door.objects.create(
+            name='Garage', ip='10.0.0.5', port=80, type='open-close',
+            status='connected'
+        )
+
+        doors = self.client.get(reverse('door_status')).json()['doors']
+        self.assertEqual(
+            [(x['id'], x['status']) for x in doors],
+            [(door.id, 'connected')]
+        )
+
+        response = self.client.get(reverse('door_status_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = b''.join(response.streaming_content).decode()
+        self.assertEqual(events.count('data: '), 1)
+        self.assertEqual(
+            json.loads(events.split('data: ')[1].split('\n')[0]),
+            {'doors': doors}
+        )
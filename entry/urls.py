@@ -3,4 +3,10 @@ from .views import *
 
 urlpatterns = [
     path('', Entry.as_view(), name='entry'),
+    path('status/', DoorStatus.as_view(), name='door_status'),
+    path(
+        'status/stream/',
+        DoorStatusStream.as_view(),
+        name='door_status_stream'
+    ),
 ]
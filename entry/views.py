@@ -1,8 +1,17 @@
+import json
+import time
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import close_old_connections
+from django.http import (HttpResponseForbidden,
+                         JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import render, redirect
 from django.urls import reverse_lazy
 from django.views.generic import View
+from . import door_checks
 from .models import Door, Key, EntryUserAccess
 
 import requests
@@ -17,28 +26,12 @@ class Entry(LoginRequiredMixin, View):
         if not EntryUserAccess.objects.filter(User=user).exists():
             return redirect(reverse_lazy('dashboard'))
 
-        keys = Key.objects.filter(User=user.id)
-        doors = Door.objects.all()
-
-        for door in doors:
-            # These are just going to have to be unique for now
-            if door.name == 'Garage':
-                try:
-                    print(f'calling http://{door.ip}:{door.port}/hellooo')
-                    r = requests.get(f'http://{door.ip}:{door.port}/hellooo', timeout=10)
-                    print('called')
-                    if r.status_code == 200:
-                        door.status = 'connected'
-                    else:
-                        door.status = 'not_connected'
-                except requests.ConnectionError as e:
-                    print('connection error')
-                    print(e)
-                    door.status = 'not_connected'
-                except requests.Timeout as e:
-                    print('timeout')
-                    door.status = 'not_connected'
-                door.save()
+        keys = Key.objects.filter(User=user.id).select_related('Door')
+        doors = list(Door.objects.all())
+
+        # Render from the last known statuses; stale ones are re-checked in
+        # the background, unless the door monitor is keeping them current.
+        door_checks.refresh_stale(doors)
         context = {
             'keys': keys,
             'inaccessible_doors': [
@@ -46,7 +39,6 @@ class Entry(LoginRequiredMixin, View):
             ]
         }
 
-
         return render(request, template_name, context)
 
     def post(self, request, *args, **kwargs):
@@ -112,3 +104,44 @@ class Entry(LoginRequiredMixin, View):
         except KeyError:
             pass
         return redirect(reverse_lazy('entry'))
+
+
+class DoorStatus(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        if not EntryUserAccess.objects.filter(User=request.user).exists():
+            return HttpResponseForbidden()
+        return JsonResponse({'doors': door_checks.statuses()})
+
+
+class DoorStatusStream(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        if not EntryUserAccess.objects.filter(User=request.user).exists():
+            return HttpResponseForbidden()
+        response = StreamingHttpResponse(
+            _status_events(),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+# Utils
+def _status_events():
+    # Sends the doors whenever they change. The stream ends after
+    # ENTRY_STREAM_DURATION so it only holds a worker briefly, and its
+    # database connection is then tidied up as at the end of any request.
+    # The browser's EventSource reconnects by itself.
+    deadline = time.monotonic() + settings.ENTRY_STREAM_DURATION
+    last = None
+    try:
+        while time.monotonic() < deadline:
+            doors = door_checks.statuses()
+            if doors != last:
+                yield f"data: {json.dumps({'doors': doors})}\n\n"
+                last = doors
+            else:
+                yield ': waiting\n\n'
+            time.sleep(settings.ENTRY_STREAM_POLL)
+    finally:
+        close_old_connections()
@@ -21,3 +21,9 @@ class TemperatureRecordAdmin(admin.ModelAdmin):
 @admin.register(HeatPumpStatusRecord)
 class HeatStatusRecordAdmin(admin.ModelAdmin):
     list_display = ('created_at', 'flow_temperature', 'return_temperature', )
+
+
+@admin.register(ReadingRollup)
+class ReadingRollupAdmin(admin.ModelAdmin):
+    list_display = ('bucket', 'resolution', 'sensor', 'field', 'count', )
+    list_filter = ('resolution', 'sensor', 'field', )
@@ -0,0 +1,271 @@
+import os
+import struct
+import zipfile
+from datetime import datetime
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import transaction
+
+from .models import (ClimateSensor,
+                     ClimateSensorRecord,
+                     HeatPumpStatusRecord,
+                     ReadingRollup)
+from .rollups import (HEAT_PUMP_FIELDS,
+                      SENSOR_FIELDS,
+                      add_readings,
+                      bucket_start)
+
+
+# Each kind of record is archived a month to a file, one column per field:
+# created_at as int64 seconds, sensor_id as int32 and readings as float32,
+# with NaN standing in for a missing reading.
+KINDS = {
+    'climate': (ClimateSensorRecord, SENSOR_FIELDS),
+    'heat_pump': (HeatPumpStatusRecord, HEAT_PUMP_FIELDS),
+}
+CHUNK_SIZE = 5000
+
+
+def archive_path(kind, month):
+    return settings.HEATING_ARCHIVE_DIR / f"{kind}-{month:%Y-%m}.npz"
+
+
+def archived_months(kind):
+    if not settings.HEATING_ARCHIVE_DIR.is_dir():
+        return []
+    months = []
+    for path in settings.HEATING_ARCHIVE_DIR.glob(f"{kind}-*.npz"):
+        try:
+            months.append(datetime.strptime(path.stem[-7:], '%Y-%m'))
+        except ValueError:
+            continue
+    return sorted(months)
+
+
+def archived_until(kind):
+    '''
+        The end of the newest archived month whose records have been deleted
+        from the database. The history API reads a kind's records before it
+        from the archive and nothing from the database; a month archived
+        without --delete, or imported back, is read from the database.
+    '''
+    model, _ = KINDS[kind]
+    for month in reversed(archived_months(kind)):
+        end = month + relativedelta(months=1)
+        if not model.objects.filter(
+            created_at__gte=month,
+            created_at__lt=end
+        ).exists():
+            return end
+    return None
+
+
+def export_month(kind, month, compress=False):
+    '''
+        Writes a month of records to its archive file, reading them in
+        chunks so only that month is ever held, as numpy columns. Stored
+        archives can be memory-mapped by read_columns; compressed ones are
+        smaller but have to be read in whole. Returns the rows written.
+    '''
+    model, fields = KINDS[kind]
+    keys = _keys(kind)
+    rows = model.objects.filter(
+        created_at__gte=month,
+        created_at__lt=month + relativedelta(months=1)
+    ).order_by(*keys[1:], 'created_at').values_list(*keys, *fields)
+
+    chunks = []
+    chunk = []
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            chunks.append(_to_columns(keys, fields, chunk))
+            chunk = []
+    if chunk:
+        chunks.append(_to_columns(keys, fields, chunk))
+    if not chunks:
+        return 0
+
+    columns = {
+        x: np.concatenate([y[x] for y in chunks]) for x in chunks[0]
+    }
+    path = archive_path(kind, month)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f".{path.name}")
+    with open(partial, 'wb') as f:
+        (np.savez_compressed if compress else np.savez)(f, **columns)
+    os.replace(partial, path)
+    return len(columns['created_at'])
+
+
+def delete_month(kind, month):
+    model, _ = KINDS[kind]
+    with transaction.atomic():
+        return model.objects.filter(
+            created_at__gte=month,
+            created_at__lt=month + relativedelta(months=1)
+        ).delete()[0]
+
+
+def import_archive(path):
+    '''
+        Loads an archive file back into the database, skipping readings
+        from sensors that no longer exist, and rebuilds the rollups for the
+        days it covers. A month that already has records in the database
+        is left alone, so nothing is imported twice. Returns the rows
+        created.
+    '''
+    name = os.path.splitext(os.path.basename(path))[0]
+    kind = name.split('-')[0]
+    month = datetime.strptime(name[-7:], '%Y-%m')
+    model, fields = KINDS[kind]
+    columns = _load(path)
+    keep = np.ones(len(columns['created_at']), dtype=bool)
+    if kind == 'climate':
+        sensor_ids = ClimateSensor.objects.values_list('id', flat=True)
+        keep = np.isin(columns['sensor_id'], list(sensor_ids))
+
+    with transaction.atomic():
+        if model.objects.filter(
+            created_at__gte=month,
+            created_at__lt=month + relativedelta(months=1)
+        ).exists():
+            return 0
+
+        created = []
+        for start in range(0, len(keep), CHUNK_SIZE):
+            window = slice(start, start + CHUNK_SIZE)
+            rows = {
+                x: y[window][keep[window]].tolist()
+                for x, y in columns.items()
+            }
+            rows['created_at'] = _to_datetimes(
+                columns['created_at'][window][keep[window]]
+            )
+            created += model.objects.bulk_create([
+                model(**{x: _reading(rows[x][i]) for x in rows})
+                for i in range(len(rows['created_at']))
+            ])
+
+        # Only the days the archive has readings for are rebuilt; any
+        # others keep the rollups compaction left them.
+        for day in {bucket_start(x.created_at, 'day') for x in created}:
+            ReadingRollup.objects.filter(
+                sensor__isnull=kind == 'heat_pump',
+                bucket__gte=day,
+                bucket__lt=day + relativedelta(days=1)
+            ).delete()
+        add_readings(**{
+            'records' if kind == 'climate' else 'heat_pump_statuses': created
+        })
+    return len(created)
+
+
+def read_columns(kind, start, end, sensor_ids=None, fields=None):
+    '''
+        Returns {sensor_id: {field: (timestamps, values)}} of archived
+        readings from start to end. Heat pump fields are under the None key.
+    '''
+    fields = fields or KINDS[kind][1]
+    low = np.datetime64(start, 's').astype(np.int64)
+    high = np.datetime64(end, 's').astype(np.int64)
+    series = {}
+    month = datetime(start.year, start.month, 1)
+    while month < end:
+        path = archive_path(kind, month)
+        month += relativedelta(months=1)
+        if not path.exists():
+            continue
+
+        columns = _load(path)
+        times = columns['created_at']
+        wanted = (times >= low) & (times < high)
+        groups = [(None, wanted)]
+        if kind == 'climate':
+            sensors = columns['sensor_id']
+            if sensor_ids is not None:
+                wanted &= np.isin(sensors, sensor_ids)
+            groups = [
+                (x, wanted & (sensors == x))
+                for x in np.unique(sensors[wanted]).tolist()
+            ]
+        for key, rows in groups:
+            for field in fields:
+                values = columns[field][rows]
+                present = ~np.isnan(values)
+                timestamps, readings = series.setdefault(
+                    key, {}
+                ).setdefault(field, ([], []))
+                timestamps.extend(_to_datetimes(times[rows][present]))
+                readings.extend(values[present].tolist())
+    return series
+
+
+# Utils
+def _keys(kind):
+    return ['created_at', 'sensor_id'] if kind == 'climate' \
+        else ['created_at']
+
+
+def _to_columns(keys, fields, rows):
+    columns = list(zip(*rows))
+    chunk = {
+        'created_at': np.array(
+            columns[0], dtype='datetime64[s]'
+        ).astype(np.int64)
+    }
+    if 'sensor_id' in keys:
+        chunk['sensor_id'] = np.array(columns[1], dtype=np.int32)
+    for field, values in zip(fields, columns[len(keys):]):
+        chunk[field] = np.array(
+            [np.nan if x is None else x for x in values],
+            dtype=np.float32
+        )
+    return chunk
+
+
+def _to_datetimes(seconds):
+    return seconds.astype('datetime64[s]').tolist()
+
+
+def _reading(value):
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _load(path):
+    # np.load never memory-maps inside an .npz, but a stored (uncompressed)
+    # member is a plain .npy laid out in the zip, so it can be mapped from
+    # its offset directly.
+    with zipfile.ZipFile(path) as archive:
+        members = archive.infolist()
+    if any(x.compress_type != zipfile.ZIP_STORED for x in members):
+        with np.load(path) as loaded:
+            return {x: loaded[x] for x in loaded.files}
+
+    columns = {}
+    with open(path, 'rb') as f:
+        for member in members:
+            name = member.filename[:-len('.npy')]
+            f.seek(member.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            if np.lib.format.read_magic(f) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, _, dtype = header
+            if not shape[0]:
+                columns[name] = np.empty(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(
+                path,
+                dtype=dtype,
+                mode='r',
+                shape=shape,
+                offset=f.tell()
+            )
+    return columns
@@ -1,6 +1,11 @@
+import copy
 import json
+import threading
+import time
 
 import requests
+from django.conf import settings
+from django.db import close_old_connections
 from .models import DaikinAccessToken
 import environ
 from datetime import datetime, timedelta
@@ -9,6 +14,26 @@ from requests.auth import HTTPBasicAuth
 
 ENV = environ.Env()
 
+# Token Cache
+# The token is read from the DB once per process, and again before any
+# refresh in case another process has rotated it. Once introspection has
+# confirmed it, it is trusted until DAIKIN_REFRESH_MARGIN before it expires,
+# at which point it is refreshed in the background.
+_token_lock = threading.Lock()
+_token_cache = {'token': None, 'loaded': False, 'verified_until': None}
+_refreshing = threading.Lock()
+
+# Status Cache
+_temps_lock = threading.Lock()
+_temps_cache = {'result': None, 'expires_at': 0}
+
+
+def clear_cache():
+    with _token_lock:
+        _token_cache.update(token=None, loaded=False, verified_until=None)
+    with _temps_lock:
+        _temps_cache.update(result=None, expires_at=0)
+
 
 class DaikinApi:
     def __init__(self):
@@ -31,15 +56,28 @@ class DaikinApi:
         return url
 
     def get_token(self):
+        with _token_lock:
+            if not _token_cache['loaded']:
+                _token_cache['token'] = DaikinAccessToken.objects.first()
+                _token_cache['loaded'] = True
+            return _token_cache['token']
+
+    def _reload_token(self):
         token = DaikinAccessToken.objects.first()
-        return token if token else None
+        with _token_lock:
+            cached = _token_cache['token']
+            if not token or not cached \
+                    or token.refresh_token != cached.refresh_token:
+                _token_cache['verified_until'] = None
+            _token_cache.update(token=token, loaded=True)
+        return token
 
     def is_authenticated(self):
         token = self.get_token()
         if not token:
             return {'authorized': False, 'error': 'No saved auth token.'}
         if token.expires_at < datetime.now():
-            refresh = self.refresh_token(token.refresh_token)
+            refresh = self._refresh(token)
             if not refresh['success']:
                 return {
                     'authorized': False,
@@ -48,12 +86,25 @@ class DaikinApi:
                 }
             else:
                 token = refresh['token']
+
+        with _token_lock:
+            verified_until = _token_cache['verified_until']
+        if verified_until and datetime.now() < verified_until:
+            return {'authorized': True}
+        if verified_until:
+            # Close to expiry: keep using the token while a new one is fetched.
+            self._refresh_in_background(token)
+            return {'authorized': True}
+
         url = self.build_url('idp', 'introspect', {'token': token.access_token})
         r = requests.post(url, auth=self.basic_auth, headers=self.headers)
         cleaned_r = self.clean_response(r, ['active'])
         if cleaned_r['success']:
             r_json = cleaned_r['json']
             if r_json['active']:
+                with _token_lock:
+                    _token_cache['verified_until'] = token.expires_at - \
+                        timedelta(seconds=settings.DAIKIN_REFRESH_MARGIN)
                 return {'authorized': True}
             else:
                 return {
@@ -67,6 +118,44 @@ class DaikinApi:
                           f"an issue with the response:\n{cleaned_r['error']}")
             }
 
+    def _refresh(self, token):
+        # The web server and collect_data share one token, and Daikin only
+        # accepts the newest refresh token. If the other process has already
+        # rotated it, use theirs instead of spending a retired one.
+        latest = self._reload_token()
+        if not latest:
+            return {'success': False, 'error': 'No saved auth token.'}
+        if latest.refresh_token != token.refresh_token:
+            if latest.expires_at > datetime.now():
+                return {'success': True, 'token': latest}
+            token = latest
+        r = self.refresh_token(token.refresh_token)
+        if not r['success']:
+            # Lost a race with the other process's refresh; pick up its token.
+            latest = self._reload_token()
+            if latest and latest.refresh_token != token.refresh_token:
+                return {'success': True, 'token': latest}
+        return r
+
+    def _refresh_in_background(self, token):
+        if not _refreshing.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                r = self._refresh(token)
+                if not r['success']:
+                    print(f"Daikin token refresh failed: {r['error']}")
+            finally:
+                _refreshing.release()
+                close_old_connections()
+
+        threading.Thread(
+            target=refresh,
+            name='daikin-token-refresh',
+            daemon=True
+        ).start()
+
     def auth_url(self):
         params = {
             'response_type': 'code',
@@ -142,6 +231,8 @@ class DaikinApi:
         print('Saving token:')
         print(token.__dict__)
         token.save()
+        with _token_lock:
+            _token_cache.update(token=token, loaded=True, verified_until=None)
         return token
 
     def revoke_access(self):
@@ -160,6 +251,7 @@ class DaikinApi:
         requests.post(url, headers=self.headers)
 
         token.delete()
+        clear_cache()
         return
 
     def clean_response(self, r, required_keys=[]):
@@ -178,6 +270,21 @@ class DaikinApi:
         return {'success': True, 'json': r_json}
 
     def current_temps(self):
+        # Shared by the heating page and data collection, so a page view
+        # straight after a cycle doesn't go back to Daikin.
+        with _temps_lock:
+            if _temps_cache['expires_at'] > time.monotonic():
+                return copy.deepcopy(_temps_cache['result'])
+        r = self._fetch_temps()
+        if r['success']:
+            with _temps_lock:
+                _temps_cache.update(
+                    result=copy.deepcopy(r),
+                    expires_at=time.monotonic() + settings.DAIKIN_TEMPS_TTL
+                )
+        return r
+
+    def _fetch_temps(self):
         auth_check = self.is_authenticated()
         if not auth_check['authorized']:
             return {
@@ -200,14 +307,18 @@ class DaikinApi:
         url = self.build_url('api', 'gateway-devices')
         r = requests.get(url, headers=self.headers)
         self.headers.pop('Authorization', None)
-        if 'message' in r.json():
+        data = r.json()
+        if 'message' in data:
+            # The token may have been revoked since it was last introspected.
+            with _token_lock:
+                _token_cache['verified_until'] = None
             return {
                 'success': False,
                 'error': (f"While retrieving the status of the Daikin heating"
                           f"system the following error occurred\n"
-                          f"{r.json()['message']}")
+                          f"{data['message']}")
             }
-        for g in r.json():
+        for g in data:
             for m in g['managementPoints']:
                 if m['managementPointType'] == 'domesticHotWaterTank':
                     temps['hot_water'] = m['sensoryData']['value']['tankTemperature']['value']
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    '''
+        Largest-Triangle-Three-Buckets. Returns the indices of the threshold
+        points that best keep the shape of the series, peaks included. The
+        first and last points are always kept.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # The n - 2 inner points split into threshold - 2 buckets. Each bucket
+    # is judged against the mean of the one after it, all worked out up
+    # front; only the choice of the previous point has to be sequential.
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+    next_x = np.append(np.add.reduceat(x[:-1], edges[:-1])[1:]
+                       / counts[1:], x[-1])
+    next_y = np.append(np.add.reduceat(y[:-1], edges[:-1])[1:]
+                       / counts[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        areas = np.abs(
+            (x[a] - next_x[i]) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (next_y[i] - y[a])
+        )
+        a = lo + int(areas.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(timestamps, values, threshold):
+    '''
+        Reduces a series of datetimes and values to at most threshold
+        chart points, [{'x', 'y'}].
+    '''
+    keep = range(len(timestamps))
+    if threshold < len(timestamps):
+        x = np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+        keep = lttb(x, values, threshold).tolist()
+    return [
+        {'x': timestamps[i].isoformat(), 'y': round(values[i], 2)}
+        for i in keep
+    ]
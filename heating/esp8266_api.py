@@ -0,0 +1,73 @@
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Connection Pooling
+# Each board gets one keep-alive session, built from the retry policy on its
+# ClimateSensor. A session is rebuilt when that policy changes, and once it
+# has sat idle long enough that the board will have dropped the socket.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(sensor):
+    policy = (sensor.connect_retries, sensor.retry_backoff)
+    now = time.monotonic()
+    with _sessions_lock:
+        entry = _sessions.get(sensor.ip_address)
+        if entry:
+            idle = now - entry['used_at']
+            if entry['policy'] != policy \
+                    or idle > settings.HEATING_ESP8266_KEEPALIVE:
+                entry['session'].close()
+                entry = None
+        if not entry:
+            entry = {'session': _build_session(*policy), 'policy': policy}
+            _sessions[sensor.ip_address] = entry
+        entry['used_at'] = now
+        return entry['session']
+
+
+def recycle_session(ip_address):
+    with _sessions_lock:
+        entry = _sessions.pop(ip_address, None)
+    if entry:
+        entry['session'].close()
+
+
+def _build_session(connect_retries, retry_backoff):
+    session = requests.Session()
+    # One read retry lets a request that lands on a socket the board has
+    # just closed go again on a fresh connection.
+    retry = Retry(
+        connect=connect_retries,
+        read=1,
+        backoff_factor=retry_backoff
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=1,
+        max_retries=retry
+    )
+    session.mount('http://', adapter)
+    return session
+
+
+def sensor_url(sensor):
+    return f"http://{sensor.ip_address}/"
+
+
+def read_sensor(sensor):
+    try:
+        r = get_session(sensor).get(sensor_url(sensor), timeout=sensor.timeout)
+        data = r.json()
+        r.close()
+    except (requests.ConnectionError, ValueError):
+        recycle_session(sensor.ip_address)
+        raise
+    return data
@@ -0,0 +1,262 @@
+import hashlib
+import json
+from datetime import datetime
+from itertools import groupby
+
+from dateutil.relativedelta import relativedelta
+from django.db.models import Q
+
+from .archive import KINDS, archived_until, read_columns
+from .downsampling import downsample
+from .models import (ClimateSensor,
+                     ClimateSensorRecord,
+                     HeatPumpStatusRecord,
+                     ReadingRollup)
+from .rollups import (HEAT_PUMP_FIELDS,
+                      RESOLUTIONS,
+                      SENSOR_FIELDS,
+                      bucket_start)
+
+
+HEAT_PUMP = 'heat_pump'
+DEFAULT_FIELDS = [
+    'temperature',
+    'room_setpoint',
+    'tank_setpoint',
+    'flow_temperature',
+    'return_temperature',
+]
+
+
+def parse_query(params):
+    '''
+        Reads a history request from the query string. Any of sensor (an id,
+        or heat_pump) and field may be repeated; with no sensor, everything
+        is returned. Raises ValueError for anything it can't make sense of.
+    '''
+    end = _parse_time(params.get('end')) or datetime.now()
+    start = _parse_time(params.get('start')) or end + relativedelta(days=-1)
+    if start >= end:
+        raise ValueError('The start must be before the end.')
+
+    resolution = params.get('resolution', 'raw')
+    if resolution not in ['raw', *RESOLUTIONS]:
+        raise ValueError(f"{resolution} is not a resolution.")
+
+    fields = params.getlist('field') or DEFAULT_FIELDS
+    for field in fields:
+        if field not in SENSOR_FIELDS + HEAT_PUMP_FIELDS:
+            raise ValueError(f"{field} is not a field.")
+
+    sensors = params.getlist('sensor')
+    points = params.get('points')
+    if points is not None:
+        points = int(points)
+        if points < 3:
+            raise ValueError('At least 3 points are needed.')
+
+    return {
+        'start': start,
+        'end': end,
+        'resolution': resolution,
+        'sensor_ids': sorted(int(x) for x in sensors if x != HEAT_PUMP)
+        if sensors else None,
+        'heat_pump': not sensors or HEAT_PUMP in sensors,
+        'sensor_fields': [x for x in fields if x in SENSOR_FIELDS],
+        'heat_pump_fields': [x for x in fields if x in HEAT_PUMP_FIELDS],
+        'points': points,
+        'archived_until': {x: archived_until(x) for x in KINDS},
+    }
+
+
+def last_modified(query):
+    '''
+        The newest raw record the query covers; every series, rollups
+        included, changes only when one arrives.
+    '''
+    sets = querysets(query)
+    latest = [
+        x for name in ['climate_latest', 'heat_pump_latest'] if name in sets
+        for x in sets[name]
+    ]
+    return max(latest) if latest else None
+
+
+def querysets(query):
+    '''
+        The querysets a history request runs, by name, leaving out any it
+        has no use for. The heating_query_plan command explains these.
+    '''
+    climate = query['sensor_fields'] and query['sensor_ids'] != []
+    heat_pump = query['heat_pump_fields'] and query['heat_pump']
+    sets = {}
+    if climate:
+        sets['climate_latest'] = _latest(_climate_records(query))
+    if heat_pump:
+        sets['heat_pump_latest'] = _latest(_heat_pump_records(query))
+
+    if query['resolution'] != 'raw':
+        if climate or heat_pump:
+            sets['rollups'] = _rollup_rows(query, climate, heat_pump)
+        return sets
+
+    if climate:
+        sets['climate'] = _climate_records(query).order_by(
+            'sensor_id', 'created_at'
+        ).values_list('sensor_id', 'created_at', *query['sensor_fields'])
+    if heat_pump:
+        sets['heat_pump'] = _heat_pump_records(query).order_by(
+            'created_at'
+        ).values_list('created_at', *query['heat_pump_fields'])
+    return sets
+
+
+def etag(query, modified):
+    key = json.dumps([query, modified], default=str, sort_keys=True)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def stream(query):
+    '''
+        Yields the JSON body, {"series": [{sensor, name, field, points}]},
+        one series at a time.
+    '''
+    names = dict(ClimateSensor.objects.values_list('id', 'name'))
+    yield '{"series": ['
+    separator = ''
+    for sensor_id, field, timestamps, values in _series(query):
+        item = {
+            'sensor': sensor_id,
+            'name': names.get(sensor_id),
+            'field': field,
+            'points': downsample(
+                timestamps,
+                values,
+                query['points'] or len(timestamps)
+            )
+        }
+        yield separator + json.dumps(item)
+        separator = ', '
+    yield ']}'
+
+
+# Utils
+def _parse_time(value):
+    if not value:
+        return None
+    at = datetime.fromisoformat(value)
+    # Records are stored in naive local time, and browsers send UTC.
+    if at.tzinfo is not None:
+        at = at.astimezone().replace(tzinfo=None)
+    return at
+
+
+def _database_start(query, kind):
+    archived = query['archived_until'][kind]
+    return max(query['start'], archived) if archived else query['start']
+
+
+def _climate_records(query):
+    records = ClimateSensorRecord.objects.filter(
+        created_at__gte=_database_start(query, 'climate'),
+        created_at__lt=query['end']
+    )
+    if query['sensor_ids'] is not None:
+        records = records.filter(sensor_id__in=query['sensor_ids'])
+    return records
+
+
+def _heat_pump_records(query):
+    return HeatPumpStatusRecord.objects.filter(
+        created_at__gte=_database_start(query, 'heat_pump'),
+        created_at__lt=query['end']
+    )
+
+
+def _archived(query, kind):
+    if query['start'] >= _database_start(query, kind):
+        return {}
+    return read_columns(
+        kind,
+        query['start'],
+        min(query['end'], _database_start(query, kind)),
+        query['sensor_ids'],
+        query['sensor_fields' if kind == 'climate' else 'heat_pump_fields']
+    )
+
+
+def _latest(records):
+    return records.order_by('-created_at').values_list(
+        'created_at',
+        flat=True
+    )[:1]
+
+
+def _rollup_rows(query, climate, heat_pump):
+    wanted = Q()
+    if climate:
+        sensors = Q(sensor__isnull=False)
+        if query['sensor_ids'] is not None:
+            sensors = Q(sensor_id__in=query['sensor_ids'])
+        wanted |= sensors & Q(field__in=query['sensor_fields'])
+    if heat_pump:
+        wanted |= Q(sensor__isnull=True) \
+            & Q(field__in=query['heat_pump_fields'])
+
+    resolution = query['resolution']
+    return ReadingRollup.objects.filter(
+        wanted,
+        resolution=resolution,
+        bucket__gte=bucket_start(query['start'], resolution),
+        bucket__lt=query['end']
+    ).order_by('sensor_id', 'field', 'bucket').values_list(
+        'sensor_id', 'field', 'bucket', 'total', 'count'
+    )
+
+
+def _series(query):
+    sets = querysets(query)
+    if 'rollups' in sets:
+        rows = sets['rollups'].iterator(chunk_size=2000)
+        for (sensor_id, field), group in groupby(rows, key=lambda x: x[:2]):
+            group = list(group)
+            yield (
+                sensor_id,
+                field,
+                [x[2] for x in group],
+                [x[3] / x[4] for x in group]
+            )
+
+    if 'climate' in sets:
+        fields = query['sensor_fields']
+        archived = _archived(query, 'climate')
+        rows = sets['climate'].iterator(chunk_size=2000)
+        for sensor_id, group in groupby(rows, key=lambda x: x[0]):
+            yield from _columns(
+                sensor_id,
+                fields,
+                (x[1:] for x in group),
+                archived.pop(sensor_id, {})
+            )
+        for sensor_id, columns in archived.items():
+            yield from _columns(sensor_id, fields, (), columns)
+
+    if 'heat_pump' in sets:
+        fields = query['heat_pump_fields']
+        archived = _archived(query, 'heat_pump')
+        rows = sets['heat_pump'].iterator(chunk_size=2000)
+        yield from _columns(None, fields, rows, archived.get(None, {}))
+
+
+def _columns(sensor_id, fields, rows, archived):
+    # One pass splits (created_at, *values) rows into a column per field,
+    # after any archived readings, which always come first.
+    columns = [archived.get(x, ([], [])) for x in fields]
+    for at, *values in rows:
+        for (timestamps, readings), value in zip(columns, values):
+            if value is not None:
+                timestamps.append(at)
+                readings.append(value)
+    for field, (timestamps, readings) in zip(fields, columns):
+        if timestamps:
+            yield sensor_id, field, timestamps, readings
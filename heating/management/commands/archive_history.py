@@ -0,0 +1,94 @@
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+
+from heating.archive import (KINDS,
+                             archive_path,
+                             delete_month,
+                             export_month,
+                             import_archive)
+
+
+class Command(BaseCommand):
+    help = (
+        'Exports climate and heat pump records a month at a time to .npz '
+        'column archives in HEATING_ARCHIVE_DIR, or imports archives back. '
+        'The history API reads archived months straight from the files.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--before',
+            help='Archive months before this one (YYYY-MM); this month by '
+                 'default.'
+        )
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            help='Delete records from the database once archived.'
+        )
+        parser.add_argument(
+            '--compress',
+            action='store_true',
+            help='Compress archives. Smaller, but they cannot be '
+                 'memory-mapped.'
+        )
+        parser.add_argument(
+            '--overwrite',
+            action='store_true',
+            help='Export months that already have an archive again.'
+        )
+        parser.add_argument(
+            '--import',
+            dest='imports',
+            action='append',
+            default=[],
+            metavar='PATH',
+            help='Load an archive back into the database. Repeat for more.'
+        )
+
+    def handle(self, *args, **options):
+        if options['imports']:
+            for path in options['imports']:
+                rows = import_archive(path)
+                if not rows:
+                    self.stdout.write(
+                        f"Skipped {path}; its month already has records."
+                    )
+                    continue
+                self.stdout.write(f"Imported {rows} rows from {path}.")
+            return
+
+        before = datetime.now().replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        if options['before']:
+            try:
+                before = datetime.strptime(options['before'], '%Y-%m')
+            except ValueError:
+                raise CommandError(f"{options['before']} is not YYYY-MM.")
+
+        for kind, (model, _) in KINDS.items():
+            oldest = model.objects.aggregate(x=Min('created_at'))['x']
+            if not oldest:
+                continue
+            month = datetime(oldest.year, oldest.month, 1)
+            while month < before:
+                if options['overwrite'] \
+                        or not archive_path(kind, month).exists():
+                    self._export(kind, month, options)
+                month += relativedelta(months=1)
+
+    def _export(self, kind, month, options):
+        rows = export_month(kind, month, options['compress'])
+        if not rows:
+            return
+        message = f"Archived {rows} {kind} rows for {month:%Y-%m}"
+        # Only months written just now are deleted, so nothing collected
+        # since an older archive was made can be lost.
+        if options['delete']:
+            delete_month(kind, month)
+            message += ' and deleted them'
+        self.stdout.write(f"{message}.")
@@ -0,0 +1,72 @@
+import fcntl
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from heating.models import ClimateSensor, sensor_types
+from heating.scheduler import CollectionScheduler
+from heating.workflows import Heating
+
+
+class Command(BaseCommand):
+    help = (
+        'Records climate and heat pump data on a schedule, polling each '
+        'sensor type at its interval from HEATING_POLL_INTERVALS.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single cycle for every sensor type and exit.'
+        )
+
+    def handle(self, *args, **options):
+        # Only one scheduler may collect at a time, however many are started.
+        lock = open(settings.HEATING_SCHEDULER_LOCK, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CommandError('Another collection scheduler is running.')
+
+        intervals = {
+            x: settings.HEATING_POLL_INTERVALS.get(
+                x,
+                settings.HEATING_POLL_INTERVAL
+            )
+            for x, _ in sensor_types
+        }
+        self.scheduler = CollectionScheduler(
+            intervals,
+            self.run_cycle,
+            self.report
+        )
+        try:
+            if options['once']:
+                self.scheduler.start()
+                self.scheduler.run_pending()
+            else:
+                self.scheduler.run_forever(lambda: False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def run_cycle(self, due_types):
+        close_old_connections()
+        if not ClimateSensor.objects.filter(type__in=due_types).exists():
+            return
+        Heating().record_current_data(sensor_types=due_types)
+
+    def report(self, due_types, stats):
+        self.stdout.write(
+            f"Cycle for {', '.join(due_types)} took "
+            f"{stats['last_duration']:.2f}s "
+            f"(cycles={stats['cycles']} "
+            f"mean={stats['mean_duration']:.2f}s "
+            f"max={stats['max_duration']:.2f}s "
+            f"skipped={stats['skipped']} "
+            f"failures={stats['failures']})"
+        )
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from heating.retention import compact_history
+
+
+class Command(BaseCommand):
+    help = (
+        'Compacts raw climate and heat pump records older than '
+        'HEATING_RETENTION_DAYS into hourly and daily rollups, then '
+        'deletes them. Run it daily.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.HEATING_RETENTION_DAYS,
+            help='Days of raw records to keep.'
+        )
+        parser.add_argument(
+            '--vacuum',
+            action='store_true',
+            help='VACUUM afterwards however few pages were freed.'
+        )
+
+    def handle(self, *args, **options):
+        report = compact_history(options['days'], options['vacuum'])
+        self.stdout.write(
+            f"Compacted {report['rows_compacted']} rows over "
+            f"{report['days']} days, reclaiming "
+            f"{report['bytes_reclaimed'] / 1024:.0f} KiB"
+            f"{' (vacuumed)' if report['vacuumed'] else ''}."
+        )
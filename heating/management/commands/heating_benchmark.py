@@ -0,0 +1,123 @@
+import timeit
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.http import QueryDict
+
+from heating import history
+from heating.models import (ClimateSensor,
+                            ClimateSensorRecord,
+                            HeatPumpStatusRecord)
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a throwaway test database with synthetic readings and times '
+        'the heating history queries without, then with, the indexes on '
+        'the record tables.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensors', type=int, default=10)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=300,
+            help='Seconds between readings.'
+        )
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self._seed(options['sensors'], options['days'],
+                       options['interval'])
+            self._run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _seed(self, sensor_count, days, interval):
+        sensors = ClimateSensor.objects.bulk_create([
+            ClimateSensor(name=f"Sensor {x}", type='esp8266_room')
+            for x in range(sensor_count)
+        ])
+        self.sensor_id = sensors[0].id
+        now = datetime.now().replace(microsecond=0)
+        steps = days * 86400 // interval
+        with transaction.atomic():
+            for start in range(0, steps, 10000):
+                times = [
+                    now - timedelta(seconds=x * interval)
+                    for x in range(start, min(start + 10000, steps))
+                ]
+                ClimateSensorRecord.objects.bulk_create([
+                    ClimateSensorRecord(
+                        sensor=sensor,
+                        created_at=at,
+                        temperature=18 + i % 7,
+                        relative_humidity=50.0
+                    )
+                    for sensor in sensors for i, at in enumerate(times)
+                ], batch_size=5000)
+                HeatPumpStatusRecord.objects.bulk_create([
+                    HeatPumpStatusRecord(
+                        created_at=at,
+                        room_setpoint=20.0,
+                        tank_setpoint=48.0,
+                        flow_temperature=35 + i % 5,
+                        return_temperature=30 + i % 5
+                    )
+                    for i, at in enumerate(times)
+                ], batch_size=5000)
+        self.stdout.write(
+            f"Seeded {ClimateSensorRecord.objects.count()} climate and "
+            f"{HeatPumpStatusRecord.objects.count()} heat pump records."
+        )
+
+    def _run(self):
+        indexes = [
+            (model, index)
+            for model in [ClimateSensorRecord, HeatPumpStatusRecord]
+            for index in model._meta.indexes
+        ]
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.remove_index(model, index)
+        self.stdout.write('Without indexes')
+        self._time_queries()
+
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.add_index(model, index)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write('With indexes')
+        self._time_queries()
+
+    def _time_queries(self):
+        for label, params in [
+            ('day, all sensors', {'start': _ago(days=1)}),
+            ('week, all sensors', {'start': _ago(days=7)}),
+            ('day, one sensor', {
+                'start': _ago(days=1),
+                'sensor': str(self.sensor_id)
+            }),
+        ]:
+            query = history.parse_query(QueryDict(urlencode(params)))
+            seconds = min(timeit.repeat(
+                lambda: (history.last_modified(query),
+                         ''.join(history.stream(query))),
+                number=1,
+                repeat=self.repeat
+            ))
+            self.stdout.write(f"  {label:<24} {seconds * 1000:8.2f} ms")
+
+
+# Utils
+def _ago(**kwargs):
+    return (datetime.now() - timedelta(**kwargs)).isoformat()
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from heating import history
+
+
+class Command(BaseCommand):
+    help = (
+        'Prints the EXPLAIN QUERY PLAN of every query the heating history '
+        'API runs for a window, to check they are served from indexes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sensor',
+            action='append',
+            default=[],
+            help='A sensor id, or heat_pump. Repeat for more; all by default.'
+        )
+        parser.add_argument('--start', help='ISO start, a day ago by default.')
+        parser.add_argument('--end', help='ISO end, now by default.')
+        parser.add_argument('--resolution', default='raw')
+
+    def handle(self, *args, **options):
+        params = QueryDict(mutable=True)
+        params.setlist('sensor', options['sensor'])
+        for x in ['start', 'end', 'resolution']:
+            if options[x]:
+                params[x] = options[x]
+        try:
+            query = history.parse_query(params)
+        except ValueError as e:
+            raise CommandError(e)
+
+        for name, queryset in history.querysets(query).items():
+            self.stdout.write(name)
+            self.stdout.write(f"  {queryset.query}")
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f"  {line}")
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+
+from heating.models import (ClimateSensorRecord,
+                            HeatPumpStatusRecord,
+                            ReadingRollup)
+from heating.rollups import add_readings, bucket_start
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the history chart rollups from the raw climate and heat '
+        'pump records. Collection keeps them up to date after that.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Raw records folded in per batch.'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            for model, kwarg, heat_pump in [
+                (ClimateSensorRecord, 'records', False),
+                (HeatPumpStatusRecord, 'heat_pump_statuses', True)
+            ]:
+                # Days before a table's oldest raw record only live on as
+                # rollups once compact_history has run, so those are left
+                # alone.
+                oldest = model.objects.aggregate(x=Min('created_at'))['x']
+                if not oldest:
+                    continue
+                ReadingRollup.objects.filter(
+                    sensor__isnull=heat_pump,
+                    bucket__gte=bucket_start(oldest, 'day')
+                ).delete()
+                batch = []
+                for record in model.objects.order_by('created_at') \
+                        .iterator(chunk_size=batch_size):
+                    batch.append(record)
+                    if len(batch) == batch_size:
+                        add_readings(**{kwarg: batch})
+                        batch = []
+                add_readings(**{kwarg: batch})
+        self.stdout.write(
+            f"Rebuilt {ReadingRollup.objects.count()} rollups."
+        )
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -32,6 +34,15 @@ class ClimateSensor(models.Model):
     temperature_offset = models.FloatField(
         'Temperature Correction Offset', null=False, blank=False, default=0.0
     )
+    connect_retries = models.IntegerField(
+        'Connection Retries', null=False, blank=False, default=3
+    )
+    retry_backoff = models.FloatField(
+        'Retry Backoff Factor (s)', null=False, blank=False, default=0.5
+    )
+    timeout = models.FloatField(
+        'Request Timeout (s)', null=False, blank=False, default=5.0
+    )
 
     def __str__(self):
         return self.name
@@ -41,7 +52,7 @@ class ClimateSensor(models.Model):
 
 
 class ClimateSensorRecord(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=datetime.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     sensor = models.ForeignKey(ClimateSensor, verbose_name='Sensor', null=False, on_delete=models.CASCADE)
     temperature = models.FloatField('Temperature (°C)', null=True, blank=True)
@@ -53,10 +64,14 @@ class ClimateSensorRecord(models.Model):
 
     class Meta:
         verbose_name = 'Climate Sensor Record'
+        indexes = [
+            models.Index(fields=['sensor', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
 
 
 class HeatPumpStatusRecord(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=datetime.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     room_setpoint = models.FloatField('Heating Setpoint (°C)', null=True, blank=True)
     tank_setpoint = models.FloatField('Hot Water Setpoint (°C)', null=True, blank=True)
@@ -69,6 +84,55 @@ class HeatPumpStatusRecord(models.Model):
 
     class Meta:
         verbose_name = 'Heat Pump Status Record'
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
+
+rollup_resolutions = (
+    ('5min', '5 Minutes'),
+    ('hour', 'Hourly'),
+    ('day', 'Daily'),
+)
+
+
+class ReadingRollup(models.Model):
+    resolution = models.CharField('Resolution', max_length=5, choices=rollup_resolutions)
+    bucket = models.DateTimeField('Bucket Start')
+    sensor = models.ForeignKey(
+        ClimateSensor, verbose_name='Sensor', null=True, blank=True, on_delete=models.CASCADE
+    )
+    field = models.CharField('Field', max_length=30)
+    count = models.IntegerField('Readings', default=0)
+    total = models.FloatField('Total', default=0.0)
+    minimum = models.FloatField('Minimum', null=True, blank=True)
+    maximum = models.FloatField('Maximum', null=True, blank=True)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        return f"{self.resolution} {self.bucket}: {self.sensor or 'Heat Pump'} {self.field}"
+
+    class Meta:
+        verbose_name = 'Reading Rollup'
+        indexes = [
+            models.Index(fields=['resolution', 'bucket']),
+        ]
+        # Heat pump rollups have no sensor, and NULLs never clash in a
+        # unique index, so they need a constraint of their own.
+        constraints = [
+            models.UniqueConstraint(
+                fields=['resolution', 'bucket', 'sensor', 'field'],
+                name='unique_sensor_rollup'
+            ),
+            models.UniqueConstraint(
+                fields=['resolution', 'bucket', 'field'],
+                condition=models.Q(sensor__isnull=True),
+                name='unique_heat_pump_rollup'
+            ),
+        ]
 
 
 class HeatingUserAccess(models.Model):
@@ -0,0 +1,109 @@
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+
+from .models import ClimateSensorRecord, HeatPumpStatusRecord, ReadingRollup
+from .rollups import add_readings, bucket_start
+
+
+def compact_history(retention_days=None, vacuum=False, now=None):
+    '''
+        Folds raw readings older than the retention period into the hourly
+        and daily rollups, then deletes them along with their 5 minute
+        rollups. Works a day at a time, each in its own short transaction,
+        so the web process is never locked out for long, and skips days
+        with nothing to compact.
+
+        Returns {'days', 'rows_compacted', 'bytes_reclaimed', 'vacuumed'}.
+    '''
+    if retention_days is None:
+        retention_days = settings.HEATING_RETENTION_DAYS
+    now = now or datetime.now()
+    cutoff = bucket_start(now - timedelta(days=retention_days), 'day')
+
+    report = {
+        'days': 0,
+        'rows_compacted': 0,
+        'bytes_reclaimed': 0,
+        'vacuumed': False,
+    }
+    size = _database_size()
+    day = _next_day()
+    while day and day < cutoff:
+        with transaction.atomic():
+            compacted = _compact_day(day)
+        report['rows_compacted'] += compacted
+        report['days'] += 1
+        if compacted:
+            time.sleep(settings.HEATING_RETENTION_PAUSE)
+        # Gaps, such as months archived with --delete, are skipped over.
+        day = _next_day(day + timedelta(days=1))
+
+    if report['days'] or vacuum:
+        report['vacuumed'] = _maintain(vacuum)
+    report['bytes_reclaimed'] = size - _database_size()
+    return report
+
+
+# Utils
+def _next_day(since=None):
+    # The first day at or after since with any raw rows.
+    oldest = []
+    for model in [ClimateSensorRecord, HeatPumpStatusRecord]:
+        records = model.objects.all()
+        if since:
+            records = records.filter(created_at__gte=since)
+        oldest.append(records.aggregate(x=Min('created_at'))['x'])
+    oldest = [x for x in oldest if x]
+    return bucket_start(min(oldest), 'day') if oldest else None
+
+
+def _compact_day(day):
+    # A whole day is rebuilt from its raw rows, so the rollups come out
+    # the same whether or not collection folded every reading in. A table
+    # with no raw rows left that day (archived with --delete) keeps its
+    # rollups, since they are all there is.
+    end = day + timedelta(days=1)
+    rollups = ReadingRollup.objects.filter(bucket__gte=day, bucket__lt=end)
+    compacted = 0
+    for model, kwarg, heat_pump in [
+        (ClimateSensorRecord, 'records', False),
+        (HeatPumpStatusRecord, 'heat_pump_statuses', True)
+    ]:
+        rows = model.objects.filter(created_at__gte=day, created_at__lt=end)
+        if not rows.exists():
+            continue
+        rollups.filter(sensor__isnull=heat_pump).delete()
+        add_readings(**{kwarg: rows}, resolutions=['hour', 'day'])
+        compacted += rows.delete()[0]
+    return compacted
+
+
+def _maintain(vacuum):
+    # ANALYZE after every compaction keeps the planner's view of the
+    # shrinking tables current; VACUUM only once enough pages sit free.
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+        if connection.vendor != 'sqlite':
+            return False
+        cursor.execute('PRAGMA freelist_count')
+        free = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        if not vacuum and free < pages * settings.HEATING_VACUUM_FREE_RATIO:
+            return False
+        cursor.execute('VACUUM')
+    return True
+
+
+def _database_size():
+    if connection.vendor != 'sqlite':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return pages * cursor.fetchone()[0]
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+
+from .models import ReadingRollup
+
+
+SENSOR_FIELDS = ['temperature', 'relative_humidity', 'ambient_light']
+HEAT_PUMP_FIELDS = [
+    'room_setpoint',
+    'tank_setpoint',
+    'flow_temperature',
+    'return_temperature',
+    'reported_flow_temperature',
+]
+
+RESOLUTIONS = {
+    '5min': timedelta(minutes=5),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+# The rollup each chart window is drawn from; a few hundred points apiece.
+CHART_WINDOWS = {
+    'day': (relativedelta(days=1), '5min'),
+    'two_days': (relativedelta(days=2), '5min'),
+    'week': (relativedelta(weeks=1), 'hour'),
+    'month': (relativedelta(months=1), 'hour'),
+    'year': (relativedelta(years=1), 'day'),
+}
+
+
+def bucket_start(at, resolution):
+    if resolution == 'day':
+        return datetime(at.year, at.month, at.day)
+    if resolution == 'hour':
+        return datetime(at.year, at.month, at.day, at.hour)
+    return datetime(
+        at.year, at.month, at.day, at.hour, at.minute - at.minute % 5
+    )
+
+
+def add_readings(records=(), heat_pump_statuses=(), resolutions=RESOLUTIONS):
+    '''
+        Folds new ClimateSensorRecords and HeatPumpStatusRecords into the
+        rollups, every resolution by default. Call it inside the transaction
+        that saves them.
+    '''
+    values = []
+    for record in records:
+        for field in SENSOR_FIELDS:
+            value = getattr(record, field)
+            if value is not None:
+                values.append(
+                    (record.sensor_id, field, record.created_at, value)
+                )
+    for status in heat_pump_statuses:
+        for field in HEAT_PUMP_FIELDS:
+            value = getattr(status, field)
+            if value is not None:
+                values.append((None, field, status.created_at, value))
+    if not values:
+        return
+    for resolution in resolutions:
+        _merge(resolution, values)
+
+
+# Utils
+def _merge(resolution, values):
+    buckets = {}
+    for sensor_id, field, at, value in values:
+        key = (sensor_id, field, bucket_start(at, resolution))
+        buckets.setdefault(key, []).append(value)
+
+    # Scribe and collect_data can merge at once. Creating any missing rows
+    # first takes the write lock, so the read-modify-write below can't
+    # interleave with another writer, and the constraints keep one row a key.
+    with transaction.atomic():
+        ReadingRollup.objects.bulk_create(
+            [
+                ReadingRollup(
+                    resolution=resolution,
+                    bucket=bucket,
+                    sensor_id=sensor_id,
+                    field=field
+                )
+                for sensor_id, field, bucket in buckets
+            ],
+            ignore_conflicts=True
+        )
+        rollups = ReadingRollup.objects.filter(
+            resolution=resolution,
+            bucket__in={x[2] for x in buckets}
+        )
+        updated = []
+        for rollup in rollups:
+            readings = buckets.get(
+                (rollup.sensor_id, rollup.field, rollup.bucket)
+            )
+            if not readings:
+                continue
+            bounds = [
+                x for x in [rollup.minimum, rollup.maximum] if x is not None
+            ]
+            rollup.count += len(readings)
+            rollup.total += sum(readings)
+            rollup.minimum = min(readings + bounds)
+            rollup.maximum = max(readings + bounds)
+            updated.append(rollup)
+        ReadingRollup.objects.bulk_update(
+            updated,
+            ['count', 'total', 'minimum', 'maximum']
+        )
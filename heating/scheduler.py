@@ -0,0 +1,79 @@
+import time
+
+
+class CollectionScheduler:
+    '''
+        Runs collection cycles for each sensor type on a fixed grid of
+        start + n * interval, so late cycles never push later ones back.
+        Cycles run one at a time; grid slots that pass while a cycle is
+        still running are skipped rather than queued up.
+    '''
+    def __init__(self, intervals, run_cycle, report=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.intervals = intervals
+        self.run_cycle = run_cycle
+        self.report = report
+        self.clock = clock
+        self.sleep = sleep
+        self.started_at = None
+        self.next_runs = {}
+        self.stats = {
+            'cycles': 0,
+            'failures': 0,
+            'skipped': 0,
+            'last_duration': None,
+            'mean_duration': 0.0,
+            'max_duration': 0.0,
+        }
+
+    def start(self):
+        self.started_at = self.clock()
+        self.next_runs = {x: self.started_at for x in self.intervals}
+
+    def due(self):
+        now = self.clock()
+        return sorted(x for x, at in self.next_runs.items() if at <= now)
+
+    def run_pending(self):
+        sensor_types = self.due()
+        if not sensor_types:
+            return
+        started = self.clock()
+        try:
+            self.run_cycle(sensor_types)
+        except Exception as e:
+            self.stats['failures'] += 1
+            print(
+                f"Collection cycle for {', '.join(sensor_types)} "
+                f"failed: {e}"
+            )
+        finished = self.clock()
+        self._record(finished - started)
+
+        for sensor_type in sensor_types:
+            interval = self.intervals[sensor_type]
+            slot = round((self.next_runs[sensor_type] - self.started_at)
+                         / interval)
+            next_slot = int((finished - self.started_at) // interval) + 1
+            self.stats['skipped'] += max(next_slot - slot - 1, 0)
+            self.next_runs[sensor_type] = \
+                self.started_at + next_slot * interval
+        if self.report:
+            self.report(sensor_types, self.stats)
+        return sensor_types
+
+    def run_forever(self, stopped):
+        self.start()
+        while not stopped():
+            self.run_pending()
+            wait = min(self.next_runs.values()) - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+
+    def _record(self, duration):
+        stats = self.stats
+        stats['cycles'] += 1
+        stats['last_duration'] = duration
+        stats['mean_duration'] += \
+            (duration - stats['mean_duration']) / stats['cycles']
+        stats['max_duration'] = max(stats['max_duration'], duration)
@@ -1,25 +1,604 @@
-from unittest import TestCase
-from .models import ClimateSensor, HeatRecord
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import TestCase, mock
+from urllib.parse import urlencode
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from django.http import QueryDict
+from django.test import TestCase as DjangoTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from scribe.models import WorkflowError
+from .models import (ClimateSensor,
+                     HeatingUserAccess,
+                     ClimateSensorRecord,
+                     DaikinAccessToken,
+                     HeatPumpStatusRecord,
+                     ReadingRollup)
+from . import archive, daikin_api, history
+from .archive import (archive_path,
+                      delete_month,
+                      export_month,
+                      import_archive)
+from .daikin_api import DaikinApi
+from .downsampling import downsample, lttb
+from .esp8266_api import get_session, read_sensor
+from .retention import compact_history
+from .rollups import RESOLUTIONS, add_readings
+from .scheduler import CollectionScheduler
+from .workflows import Heating
 
 
 class HeatingModelTests(TestCase):
     def test_heat_sensor(self):
         sensor = ClimateSensor.objects.create(
             name='Test Sensor',
-            protocol='nest_thermostat',
-            address='test_address'
+            type='nest_thermostat',
+            ip_address='10.0.0.1'
         )
         self.assertTrue(isinstance(sensor, ClimateSensor))
 
-        record = HeatRecord.objects.create(
+        record = ClimateSensorRecord.objects.create(
             sensor=sensor,
             temperature=21.5,
             relative_humidity=50.0,
             ambient_light=100.0
         )
-        self.assertTrue(isinstance(record, HeatRecord))
+        self.assertTrue(isinstance(record, ClimateSensorRecord))
 
 
 class HeatingFunctionalTests(TestCase):
     def test_fake(self):
         self.assertTrue(True)
+
+
+daikin_temps = {
+    'hot_water': 48.0,
+    'tank_setpoint': 50.0,
+    'room': 20.0,
+    'room_setpoint': 21.0,
+    'outdoor': 7.0,
+    'flow': 35.0
+}
+
+
+@override_settings(HEATING_SENSOR_DEADLINE=0.3, HEATING_CYCLE_DEADLINE=2)
+class RecordCurrentDataTests(DjangoTestCase):
+    def setUp(self):
+        self.released = threading.Event()
+        self.alive = ClimateSensor.objects.create(
+            name='Landing', type='esp8266_room', ip_address='10.0.0.2'
+        )
+        self.dead = ClimateSensor.objects.create(
+            name='Loft', type='esp8266_room', ip_address='10.0.0.3'
+        )
+        self.outdoor = ClimateSensor.objects.create(
+            name='Outside', type='daikin_weather', temperature_offset=-1
+        )
+        patch = mock.patch('heating.workflows.DaikinApi')
+        patch.start().return_value.current_temps.return_value = {
+            'success': True,
+            'temps': daikin_temps
+        }
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.released.set)
+
+    def _collect(self, sensor):
+        if sensor.id == self.dead.id:
+            self.released.wait(5)
+        return {'air': 19.04, 'humidity': 45.01}
+
+    def test_dead_board_does_not_hold_up_the_cycle(self):
+        with mock.patch(
+            'heating.workflows.read_sensor', side_effect=self._collect
+        ):
+            started = time.monotonic()
+            Heating().record_current_data()
+            duration = time.monotonic() - started
+
+        self.assertLess(duration, 1)
+        records = ClimateSensorRecord.objects.all()
+        self.assertEqual(
+            sorted((x.sensor.name, x.temperature) for x in records),
+            [('Landing', 19.0), ('Outside', 6.0)]
+        )
+        self.assertEqual(len({x.created_at for x in records}), 1)
+        error = WorkflowError.objects.get()
+        self.assertEqual(error.error, 'Sensor Timeout')
+        self.assertIn('Loft', error.description)
+
+    def test_cycle_is_written_with_one_insert_per_table(self):
+        self.released.set()
+        heating = Heating()
+        with mock.patch(
+            'heating.workflows.read_sensor', side_effect=self._collect
+        ), CaptureQueriesContext(connection) as queries:
+            heating.record_current_data()
+        inserts = [
+            x['sql'] for x in queries.captured_queries
+            if x['sql'].startswith('INSERT')
+        ]
+        rollups = [x for x in inserts if 'heating_readingrollup' in x]
+        self.assertEqual(len(inserts) - len(rollups), 2)
+        self.assertEqual(len(rollups), len(RESOLUTIONS))
+        self.assertEqual(ClimateSensorRecord.objects.count(), 3)
+        self.assertEqual(HeatPumpStatusRecord.objects.count(), 1)
+
+    def test_daikin_only_cycle_leaves_flow_to_the_heat_pump_board(self):
+        Heating().record_current_data(sensor_types=['daikin_weather'])
+        status = HeatPumpStatusRecord.objects.get()
+        self.assertEqual(status.room_setpoint, 21.0)
+        self.assertIsNone(status.flow_temperature)
+
+
+class ReadingRollupTests(DjangoTestCase):
+    def setUp(self):
+        self.sensor = ClimateSensor.objects.create(
+            name='Landing', type='esp8266_room', ip_address='10.0.0.2'
+        )
+
+    def _record(self, at, temperature):
+        return ClimateSensorRecord(
+            sensor=self.sensor, created_at=at, temperature=temperature
+        )
+
+    def test_readings_are_folded_into_each_resolution(self):
+        at = datetime(2024, 1, 1, 10, 2)
+        add_readings([self._record(at, 18.0)])
+        add_readings([
+            self._record(at + timedelta(minutes=1), 20.0),
+            self._record(at + timedelta(minutes=10), 22.0)
+        ])
+
+        five = ReadingRollup.objects.filter(resolution='5min')
+        self.assertEqual(
+            [(x.bucket.minute, x.count, x.mean) for x in
+             five.order_by('bucket')],
+            [(0, 2, 19.0), (10, 1, 22.0)]
+        )
+        hour = ReadingRollup.objects.get(resolution='hour')
+        self.assertEqual(
+            (hour.count, hour.mean, hour.minimum, hour.maximum),
+            (3, 20.0, 18.0, 22.0)
+        )
+
+    def test_each_key_has_one_rollup(self):
+        at = datetime(2024, 1, 1, 10, 2)
+        status = HeatPumpStatusRecord(created_at=at, room_setpoint=20.0)
+        add_readings([self._record(at, 18.0)], [status])
+        add_readings([self._record(at, 19.0)], [status])
+        self.assertEqual(
+            ReadingRollup.objects.filter(resolution='hour').count(),
+            2
+        )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ReadingRollup.objects.create(
+                resolution='hour',
+                bucket=datetime(2024, 1, 1, 10),
+                field='room_setpoint'
+            )
+
+
+@override_settings(HEATING_RETENTION_PAUSE=0, HEATING_VACUUM_FREE_RATIO=2)
+class CompactHistoryTests(DjangoTestCase):
+    def test_old_readings_are_kept_as_hourly_and_daily_rollups(self):
+        sensor = ClimateSensor.objects.create(
+            name='Landing', type='esp8266_room', ip_address='10.0.0.2'
+        )
+        now = datetime(2024, 3, 1, 12)
+        old = datetime(2024, 1, 1, 10)
+        records = ClimateSensorRecord.objects.bulk_create([
+            ClimateSensorRecord(sensor=sensor, created_at=at, temperature=t)
+            for at, t in [
+                (old, 18.0),
+                (old + timedelta(minutes=30), 20.0),
+                (now - timedelta(days=1), 21.0)
+            ]
+        ])
+        # The first reading predates the rollups, so only the others were
+        # folded in as they were collected.
+        add_readings(records[1:])
+
+        with mock.patch('heating.retention.time.sleep') as sleep:
+            report = compact_history(retention_days=30, now=now)
+        self.assertEqual(report['rows_compacted'], 2)
+        # Only the day with readings is visited; the gap after it isn't.
+        self.assertEqual(report['days'], 1)
+        sleep.assert_called_once()
+        self.assertEqual(
+            list(ClimateSensorRecord.objects.values_list(
+                'temperature', flat=True
+            )),
+            [21.0]
+        )
+        compacted = ReadingRollup.objects.filter(
+            bucket__lt=datetime(2024, 2, 1)
+        )
+        self.assertEqual(
+            sorted((x.resolution, x.count, x.mean) for x in compacted),
+            [('day', 2, 19.0), ('hour', 2, 19.0)]
+        )
+        self.assertEqual(
+            ReadingRollup.objects.filter(resolution='5min').count(),
+            1
+        )
+
+    def test_rollups_without_raw_rows_are_kept(self):
+        sensor = ClimateSensor.objects.create(
+            name='Landing', type='esp8266_room', ip_address='10.0.0.2'
+        )
+        old = datetime(2024, 1, 1, 10)
+        # The heat pump rows for the day were archived and deleted.
+        add_readings(heat_pump_statuses=[
+            HeatPumpStatusRecord(created_at=old, flow_temperature=35.0)
+        ])
+        ClimateSensorRecord.objects.create(
+            sensor=sensor, created_at=old, temperature=18.0
+        )
+
+        compact_history(retention_days=30, now=datetime(2024, 3, 1))
+        self.assertEqual(
+            sorted(
+                (x.resolution, x.field, x.count)
+                for x in ReadingRollup.objects.all()
+            ),
+            [
+                ('5min', 'flow_temperature', 1),
+                ('day', 'flow_temperature', 1),
+                ('day', 'temperature', 1),
+                ('hour', 'flow_temperature', 1),
+                ('hour', 'temperature', 1)
+            ]
+        )
+
+
+class ArchiveTests(DjangoTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patch = override_settings(HEATING_ARCHIVE_DIR=Path(directory.name))
+        patch.enable()
+        self.addCleanup(patch.disable)
+
+        self.sensor = ClimateSensor.objects.create(
+            name='Landing', type='esp8266_room', ip_address='10.0.0.2'
+        )
+        self.month = datetime(2024, 1, 1)
+        ClimateSensorRecord.objects.bulk_create([
+            ClimateSensorRecord(
+                sensor=self.sensor,
+                created_at=self.month + timedelta(hours=x),
+                temperature=None if x == 1 else 18.0 + x,
+                relative_humidity=50.0
+            )
+            for x in range(3)
+        ])
+
+    def test_month_round_trips_through_a_mapped_archive(self):
+        self.assertEqual(export_month('climate', self.month), 3)
+        delete_month('climate', self.month)
+        path = archive_path('climate', self.month)
+        columns = archive._load(path)
+        self.assertIsInstance(columns['temperature'], np.memmap)
+        self.assertEqual(columns['created_at'].dtype, np.int64)
+        self.assertEqual(columns['temperature'].dtype, np.float32)
+
+        query = history.parse_query(QueryDict(urlencode({
+            'start': '2024-01-01T00:00:00',
+            'end': '2024-02-01T00:00:00',
+            'field': 'temperature'
+        })))
+        self.assertEqual(query['archived_until']['climate'],
+                         datetime(2024, 2, 1))
+        series = json.loads(''.join(history.stream(query)))['series']
+        self.assertEqual(series[0]['points'], [
+            {'x': '2024-01-01T00:00:00', 'y': 18.0},
+            {'x': '2024-01-01T02:00:00', 'y': 20.0}
+        ])
+
+        self.assertEqual(import_archive(path), 3)
+        self.assertEqual(
+            sorted(ClimateSensorRecord.objects.values_list(
+                'temperature', flat=True
+            ), key=str),
+            [18.0, 20.0, None]
+        )
+        # A second import would duplicate every reading, so it's skipped.
+        self.assertEqual(import_archive(path), 0)
+        self.assertEqual(ClimateSensorRecord.objects.count(), 3)
+        day = ReadingRollup.objects.get(resolution='day', field='temperature')
+        self.assertEqual((day.count, day.mean), (2, 19.0))
+        # Imported rows are read from the database again.
+        query = history.parse_query(QueryDict(urlencode({
+            'start': '2024-01-01T00:00:00',
+            'end': '2024-02-01T00:00:00',
+            'field': 'temperature'
+        })))
+        self.assertIsNone(query['archived_until']['climate'])
+        series = json.loads(''.join(history.stream(query)))['series']
+        self.assertEqual(len(series[0]['points']), 2)
+
+
+class HeatingHistoryTests(DjangoTestCase):
+    def setUp(self):
+        user = User.objects.create_user('heating')
+        HeatingUserAccess.objects.create(User=user)
+        self.client.force_login(user)
+        self.sensor = ClimateSensor.objects.create(
+            name='Landing', type='esp8266_room', ip_address='10.0.0.2'
+        )
+        self.at = datetime(2024, 1, 1, 10)
+        records = [
+            ClimateSensorRecord(
+                sensor=self.sensor,
+                created_at=self.at + timedelta(minutes=x),
+                temperature=18 + x
+            )
+            for x in range(3)
+        ]
+        ClimateSensorRecord.objects.bulk_create(records)
+        add_readings(records)
+        self.params = {
+            'sensor': self.sensor.id,
+            'start': '2024-01-01T00:00:00',
+            'end': '2024-01-02T00:00:00'
+        }
+
+    def _get(self, params, **headers):
+        return self.client.get(reverse('heating_history'), params, **headers)
+
+    def _series(self, params):
+        response = self._get(params)
+        return json.loads(b''.join(response.streaming_content))['series']
+
+    def test_raw_and_rolled_up_series(self):
+        series = self._series(self.params)
+        self.assertEqual(series, [{
+            'sensor': self.sensor.id,
+            'name': 'Landing',
+            'field': 'temperature',
+            'points': [
+                {'x': '2024-01-01T10:00:00', 'y': 18.0},
+                {'x': '2024-01-01T10:01:00', 'y': 19.0},
+                {'x': '2024-01-01T10:02:00', 'y': 20.0}
+            ]
+        }])
+
+        series = self._series({**self.params, 'resolution': 'hour'})
+        self.assertEqual(
+            series[0]['points'],
+            [{'x': '2024-01-01T10:00:00', 'y': 19.0}]
+        )
+
+    def test_raw_history_is_one_query_per_table(self):
+        HeatPumpStatusRecord.objects.create(
+            created_at=self.at, flow_temperature=35.0, tank_setpoint=None
+        )
+        query = history.parse_query(QueryDict())
+        query['start'] = datetime(2024, 1, 1)
+        with self.assertNumQueries(3):
+            series = list(history.stream(query))
+        self.assertEqual(len(series), 4)
+
+    def test_unchanged_history_is_not_sent_again(self):
+        response = self._get(self.params)
+        self.assertEqual(response['Last-Modified'],
+                         'Mon, 01 Jan 2024 10:02:00 GMT')
+        self.assertEqual(
+            self._get(self.params,
+                      HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+            304
+        )
+        self.assertEqual(
+            self._get({**self.params, 'resolution': 'week'}).status_code,
+            400
+        )
+
+    def test_utc_times_are_read_as_local_time(self):
+        query = history.parse_query(QueryDict(urlencode({
+            'start': '2024-07-01T08:00:00Z',
+            'end': '2024-07-01T10:00:00.000Z'
+        })))
+        self.assertEqual(
+            (query['start'], query['end']),
+            (datetime(2024, 7, 1, 9), datetime(2024, 7, 1, 11))
+        )
+        response = self._get({
+            **self.params,
+            'start': '2024-01-01T00:00:00Z',
+            'end': '2024-01-02T00:00:00Z'
+        })
+        self.assertEqual(response.status_code, 200)
+
+    def test_last_modified_is_sent_in_gmt(self):
+        ClimateSensorRecord.objects.create(
+            sensor=self.sensor,
+            created_at=datetime(2024, 7, 1, 10, 2),
+            temperature=21.0
+        )
+        response = self._get({
+            'sensor': self.sensor.id,
+            'start': '2024-07-01T00:00:00',
+            'end': '2024-07-02T00:00:00'
+        })
+        self.assertEqual(response['Last-Modified'],
+                         'Mon, 01 Jul 2024 09:02:00 GMT')
+
+
+class DownsamplingTests(TestCase):
+    def test_lttb_keeps_the_ends_and_the_peaks(self):
+        values = [20.0] * 1000
+        values[123] = 35.0
+        values[777] = 5.0
+        keep = lttb(range(1000), values, 50).tolist()
+        self.assertEqual(len(keep), 50)
+        self.assertEqual(keep, sorted(set(keep)))
+        self.assertEqual((keep[0], keep[-1]), (0, 999))
+        self.assertIn(123, keep)
+        self.assertIn(777, keep)
+
+    def test_short_series_are_left_alone(self):
+        at = datetime(2024, 1, 1)
+        points = downsample([at, at + timedelta(hours=1)], [1.234, 2], 500)
+        self.assertEqual(points, [
+            {'x': '2024-01-01T00:00:00', 'y': 1.23},
+            {'x': '2024-01-01T01:00:00', 'y': 2}
+        ])
+
+
+class BoardHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"air": 19.5, "humidity": 45.0}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Esp8266SessionTests(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BoardHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.sensor = ClimateSensor(
+            name='Cupboard',
+            type='esp8266_heat_pump',
+            ip_address=f"127.0.0.1:{self.server.server_address[1]}"
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_board_connection_is_kept_alive(self):
+        for _ in range(3):
+            self.assertEqual(read_sensor(self.sensor)['air'], 19.5)
+        pool = get_session(self.sensor).get_adapter('http://').poolmanager
+        pool = list(pool.pools._container.values())[0]
+        self.assertEqual(pool.num_connections, 1)
+        self.assertEqual(pool.num_requests, 3)
+
+    def test_session_follows_sensor_policy(self):
+        session = get_session(self.sensor)
+        self.assertIs(get_session(self.sensor), session)
+        self.sensor.connect_retries = 1
+        self.assertIsNot(get_session(self.sensor), session)
+        with override_settings(HEATING_ESP8266_KEEPALIVE=0):
+            session = get_session(self.sensor)
+            time.sleep(0.01)
+            self.assertIsNot(get_session(self.sensor), session)
+
+
+class CollectionSchedulerTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cycles = []
+        self.durations = {'slow': 250}
+
+    def _run_cycle(self, sensor_types):
+        self.cycles.append((self.now, sensor_types))
+        self.now += max(self.durations.get(x, 1) for x in sensor_types)
+
+    def _scheduler(self):
+        scheduler = CollectionScheduler(
+            {'fast': 60, 'slow': 300},
+            self._run_cycle,
+            clock=lambda: self.now
+        )
+        scheduler.start()
+        return scheduler
+
+    def test_cycles_stay_on_the_grid(self):
+        scheduler = self._scheduler()
+        self.durations = {}
+        for _ in range(6):
+            scheduler.run_pending()
+            self.now = min(scheduler.next_runs.values())
+        self.assertEqual(self.cycles, [
+            (0, ['fast', 'slow']),
+            (60, ['fast']),
+            (120, ['fast']),
+            (180, ['fast']),
+            (240, ['fast']),
+            (300, ['fast', 'slow']),
+        ])
+
+    def test_overrunning_cycle_skips_missed_slots(self):
+        scheduler = self._scheduler()
+        scheduler.run_pending()
+        self.assertEqual(scheduler.next_runs, {'fast': 300, 'slow': 300})
+        self.assertEqual(scheduler.stats['skipped'], 4)
+        self.assertEqual(scheduler.stats['max_duration'], 250)
+
+
+@mock.patch.dict(os.environ, {
+    'DAIKIN__CLIENT_ID': 'id',
+    'DAIKIN__SECRET': 'secret',
+    'DAIKIN__REDIRECT_URI': 'https://example.com/'
+})
+class DaikinCacheTests(DjangoTestCase):
+    def setUp(self):
+        daikin_api.clear_cache()
+        self.addCleanup(daikin_api.clear_cache)
+        DaikinAccessToken.objects.create(
+            access_token='access',
+            refresh_token='refresh',
+            expires_at=datetime.now() + timedelta(hours=1)
+        )
+
+    def test_token_is_introspected_once(self):
+        active = mock.Mock(**{'json.return_value': {'active': True}})
+        with mock.patch(
+            'heating.daikin_api.requests.post', return_value=active
+        ) as post, self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertTrue(DaikinApi().is_authenticated()['authorized'])
+        self.assertEqual(post.call_count, 1)
+
+    def test_token_rotated_elsewhere_is_picked_up(self):
+        DaikinAccessToken.objects.update(
+            expires_at=datetime.now() - timedelta(minutes=1)
+        )
+        DaikinApi().get_token()
+        # collect_data refreshes it in another process.
+        DaikinAccessToken.objects.update(
+            access_token='rotated-access',
+            refresh_token='rotated',
+            expires_at=datetime.now() + timedelta(hours=1)
+        )
+        active = mock.Mock(**{'json.return_value': {'active': True}})
+        with mock.patch(
+            'heating.daikin_api.requests.post', return_value=active
+        ) as post:
+            self.assertTrue(DaikinApi().is_authenticated()['authorized'])
+        self.assertEqual(post.call_count, 1)
+        self.assertIn(
+            'introspect?token=rotated-access',
+            post.call_args.args[0]
+        )
+
+    def test_current_temps_are_shared_for_the_ttl(self):
+        r = {'success': True, 'temps': daikin_temps}
+        with mock.patch.object(
+            DaikinApi, '_fetch_temps', return_value=copy.deepcopy(r)
+        ) as fetch:
+            DaikinApi().current_temps()
+            DaikinApi().current_temps()['temps']['room'] = 0
+            self.assertEqual(DaikinApi().current_temps(), r)
+        self.assertEqual(fetch.call_count, 1)
+
@@ -2,20 +2,24 @@ import datetime
 import json
 
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponseRedirect
+from django.http import (HttpResponseForbidden,
+                         HttpResponseRedirect,
+                         JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.urls import reverse_lazy
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView, View
 
+from . import history
 from .daikin_api import DaikinApi
-from .models import (HeatingUserAccess,
-                     HeatPumpStatusRecord,
-                     ClimateSensor,
-                     ClimateSensorRecord)
+from .models import HeatingUserAccess
 from .nest_api import GoogleApi
+from .rollups import CHART_WINDOWS
 
 
 class Heating(TemplateView):
@@ -60,38 +64,16 @@ class Heating(TemplateView):
         context['one_month_ago'] = ONE_MONTH_AGO.isoformat()
         context['one_year_ago'] = ONE_YEAR_AGO.isoformat()
 
-        heat_status_records = HeatPumpStatusRecord.objects.filter(
-            created_at__gt=ONE_YEAR_AGO
-        )
-        sensors = ClimateSensor.objects.all()
-
-        context['sensor_records'] = {}
-        for sensor in sensors:
-            records = ClimateSensorRecord.objects.filter(
-                created_at__gt=ONE_YEAR_AGO,
-                sensor=sensor
-            )
-            context['sensor_records'][sensor.name] = json.dumps([
-                {'x': x.created_at.isoformat(), 'y': x.temperature}
-                for x in records
-            ])
-
-        context['room_setpoint_records'] = json.dumps([
-            {'x': x.created_at.isoformat(), 'y': x.room_setpoint}
-            for x in heat_status_records
-        ])
-        context['tank_setpoint_records'] = json.dumps([
-            {'x': x.created_at.isoformat(), 'y': x.tank_setpoint}
-            for x in heat_status_records
-        ])
-        context['flow_temperature_records'] = json.dumps([
-            {'x': x.created_at.isoformat(), 'y': x.flow_temperature}
-            for x in heat_status_records
-        ])
-        context['return_temperature_records'] = json.dumps([
-            {'x': x.created_at.isoformat(), 'y': x.return_temperature}
-            for x in heat_status_records
-        ])
+        # The page fetches each chart window from the history API when it is
+        # opened, at the rollup resolution that suits its length.
+        context['chart_windows'] = json.dumps({
+            window: {
+                'start': (NOW - length).isoformat(),
+                'resolution': resolution
+            }
+            for window, (length, resolution) in CHART_WINDOWS.items()
+        })
+        context['chart_points'] = settings.HEATING_CHART_POINTS
         return context
 
 
@@ -135,3 +117,38 @@ class DaikinCallback(View):
         if not r['success']:
             print(r['message'])
         return HttpResponseRedirect(reverse('heating'))
+
+
+class HeatingHistory(View):
+    def dispatch(self, request, *args, **kwargs):
+        user = request.user
+        if not user.is_authenticated \
+                or not HeatingUserAccess.objects.filter(User=user).exists():
+            return HttpResponseForbidden()
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            query = history.parse_query(request.GET)
+        except ValueError as e:
+            return JsonResponse(
+                {'success': False, 'errors': [str(e)]},
+                status=400
+            )
+
+        modified = history.last_modified(query)
+        tag = history.etag(query, modified)
+        if modified:
+            # Stored times are naive local time; the header is in GMT.
+            modified = modified.astimezone(datetime.timezone.utc)
+
+        @condition(
+            etag_func=lambda request: tag,
+            last_modified_func=lambda request: modified
+        )
+        def respond(request):
+            return StreamingHttpResponse(
+                history.stream(query),
+                content_type='application/json'
+            )
+        return respond(request)
@@ -1,14 +1,36 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from django.conf import settings
+from django.db import transaction
 
 from heating.models import (ClimateSensor,
                             HeatPumpStatusRecord,
                             ClimateSensorRecord)
 from lights.bridge_api import Bridge
+from lights.event_stream import get_mirror
 from lights.models import LightsSettings
 from scribe.models import WorkflowError
 from .daikin_api import DaikinApi
+from .esp8266_api import read_sensor
+from .rollups import add_readings
+
+
+_poll_pool = ThreadPoolExecutor(
+    max_workers=settings.HEATING_POLL_WORKERS,
+    thread_name_prefix='heating-poll'
+)
+
+_daikin_sensors = {
+    'daikin_thermostat': 'room',
+    'daikin_tank': 'hot_water',
+    'daikin_weather': 'outdoor',
+}
+
+# The heat pump status is written by cycles that include any of these.
+_heat_pump_sensors = ['esp8266_heat_pump', *_daikin_sensors]
 
 
 class Heating:
@@ -30,150 +52,201 @@ class Heating:
         else:
             self.daikin_temps = r['temps']
 
-    def record_current_data(self):
+    def record_current_data(self, sensor_types=None):
+        # Every reading in a cycle shares the time the cycle started, however
+        # long each sensor takes to answer.
+        cycle_at = datetime.now()
+
         # Initialize heat pump data
-        heat_pump_status = HeatPumpStatusRecord()
+        heat_pump_status = HeatPumpStatusRecord(created_at=cycle_at)
         if not self.daikin_error:
             heat_pump_status.room_setpoint = self.daikin_temps['room_setpoint']
             heat_pump_status.tank_setpoint = self.daikin_temps['tank_setpoint']
-            heat_pump_status.flow_temperature = self.daikin_temps['flow']
+            # Flow goes with the ESP8266's return reading; a Daikin-only
+            # cycle writing it alone would interleave with those rows.
+            if sensor_types is None or 'esp8266_heat_pump' in sensor_types:
+                heat_pump_status.flow_temperature = self.daikin_temps['flow']
 
         # Collect data from climate sensors
+        records = []
+        errors = []
         sensors = ClimateSensor.objects.all()
-        for sensor in sensors:
+        if sensor_types is not None:
+            sensors = sensors.filter(type__in=sensor_types)
+        sensors = list(sensors)
+        for sensor, reading in self._poll_sensors(sensors):
+            if 'error' in reading:
+                errors.append(WorkflowError(
+                    error=reading['error'],
+                    description=reading['description']
+                ))
+            if 'heat_pump' in reading and not self.daikin_error:
+                for field, value in reading['heat_pump'].items():
+                    setattr(heat_pump_status, field, value)
+                heat_pump_status.reported_flow_temperature = \
+                    self.daikin_temps['flow']
+            if 'climate' in reading:
+                records.append(ClimateSensorRecord(
+                    sensor=sensor,
+                    created_at=cycle_at,
+                    **reading['climate']
+                ))
+
+        # Write the whole cycle in one transaction
+        statuses = []
+        if not self.daikin_error and (
+            sensor_types is None
+            or any(x in _heat_pump_sensors for x in sensor_types)
+        ):
+            statuses.append(heat_pump_status)
+        with transaction.atomic():
+            ClimateSensorRecord.objects.bulk_create(records)
+            WorkflowError.objects.bulk_create(errors)
+            for status in statuses:
+                status.save()
+            add_readings(records, statuses)
+
+        return
+
+    # Polling
+    def _poll_sensors(self, sensors):
+        # One bridge check covers every Hue sensor in the cycle, and a live
+        # mirror already shows the bridge is answering.
+        self.hue_authorised = not any(
+            x.type == 'hue_presence_sensor' for x in sensors
+        ) or get_mirror(self.hue) is not None or self.hue.is_authorised()
+        started = {}
+
+        def poll(sensor):
+            started[sensor.id] = time.monotonic()
             print(f'Contacting {sensor.name}')
-            if sensor.type == 'hue_presence_sensor':
-                if self.hue.is_authorised():
-                    climate_data = self._collect_hue_climate_data(sensor)
-                    temperature = (
-                        climate_data['temperature']
-                        + sensor.temperature_offset
+            return self._read_sensor(sensor)
+
+        futures = {_poll_pool.submit(poll, x): x for x in sensors}
+        readings = {}
+        sensor_deadline = settings.HEATING_SENSOR_DEADLINE
+        cycle_deadline = time.monotonic() + settings.HEATING_CYCLE_DEADLINE
+        pending = set(futures)
+        while pending:
+            expiries = [
+                started[futures[x].id] + sensor_deadline for x in pending
+                if futures[x].id in started
+            ]
+            timeout = min([cycle_deadline] + expiries) - time.monotonic()
+            if timeout > 0:
+                done, pending = wait(
+                    pending,
+                    timeout=timeout,
+                    return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    readings[futures[future].id] = _result_of(
+                        future,
+                        futures[future]
                     )
-                    ClimateSensorRecord(
-                        sensor=sensor,
-                        temperature=temperature,
-                        ambient_light=climate_data['ambient_light']
-                    ).save()
-            elif sensor.type == 'daikin_thermostat':
-                if not self.daikin_error:
-                    temperature = (
-                            self.daikin_temps['room']
-                            + sensor.temperature_offset
+
+            # A board that hangs is left to finish in the background; its
+            # reading is dropped so it can't hold up the rest of the cycle.
+            now = time.monotonic()
+            for future in list(pending):
+                sensor = futures[future]
+                expired = sensor.id in started \
+                    and now >= started[sensor.id] + sensor_deadline
+                if expired or now >= cycle_deadline:
+                    future.cancel()
+                    pending.discard(future)
+                    readings[sensor.id] = {
+                        'error': 'Sensor Timeout',
+                        'description': (
+                            f'{sensor.name} did not respond in time.'
+                        )
+                    }
+        return [(x, readings[x.id]) for x in sensors]
+
+    def _read_sensor(self, sensor):
+        if sensor.type == 'hue_presence_sensor':
+            if not self.hue_authorised:
+                return {}
+            climate_data = self._collect_hue_climate_data(sensor)
+            if 'errors' in climate_data:
+                return {
+                    'error': 'Hue Error',
+                    'description': (
+                        f"{sensor.name} could not be read: "
+                        f"{climate_data['errors']}"
                     )
-                    ClimateSensorRecord(
-                        sensor=sensor,
-                        temperature=temperature
-                    ).save()
-            elif sensor.type == 'daikin_tank':
-                if not self.daikin_error:
-                    temperature = (
-                            self.daikin_temps['hot_water']
-                            + sensor.temperature_offset
+                }
+            return {'climate': {
+                'temperature': (
+                    climate_data['temperature']
+                    + sensor.temperature_offset
+                ),
+                'ambient_light': climate_data['ambient_light']
+            }}
+        elif sensor.type in _daikin_sensors:
+            if self.daikin_error:
+                return {}
+            temperature = (
+                self.daikin_temps[_daikin_sensors[sensor.type]]
+                + sensor.temperature_offset
+            )
+            return {'climate': {'temperature': temperature}}
+        elif sensor.type in ['esp8266_heat_pump', 'esp8266_room']:
+            try:
+                data = read_sensor(sensor)
+            except requests.ConnectTimeout:
+                return {
+                    'error': 'Connection Timeout',
+                    'description': (
+                        f'{sensor.name} was not contactable at '
+                        f'{sensor.ip_address}.'
                     )
-                    ClimateSensorRecord(
-                        sensor=sensor,
-                        temperature=temperature
-                    ).save()
-            elif sensor.type == 'daikin_weather':
-                if not self.daikin_error:
-                    temperature = (
-                        self.daikin_temps['outdoor']
-                        + sensor.temperature_offset
+                }
+            except requests.ConnectionError:
+                return {
+                    'error': 'Connection Error',
+                    'description': (
+                        f'{sensor.name} was not contactable at '
+                        f'{sensor.ip_address}.'
                     )
-                    ClimateSensorRecord(
-                        sensor=sensor,
-                        temperature=temperature
-                    ).save()
-            elif sensor.type == 'esp8266_heat_pump':
-                try:
-                    session = requests.Session()
-                    retry = Retry(connect=3, backoff_factor=0.5)
-                    adapter = HTTPAdapter(max_retries=retry)
-                    session.mount('http://', adapter)
-                    session.mount('https://', adapter)
-                    r = session.get(f"http://{sensor.ip_address}/", timeout=5)
-                    data = r.json()
-                    r.close()
-                    if 'flow' in data and 'return' in data:
-                        flow = round(data['flow'], 2)
-                        retn = round(data['return'], 2)
-                        if not self.daikin_error:
-                            heat_pump_status.flow_temperature = flow
-                            heat_pump_status.return_temperature = retn
-                            heat_pump_status.reported_flow_temperature = \
-                                self.daikin_temps['flow']
-                    if 'air' in data:
-                        temperature = (
-                            round(data['air'], 1)
-                            + sensor.temperature_offset
-                        )
-                        cupboard_climate_record = ClimateSensorRecord(
-                            sensor=sensor,
-                            temperature=temperature
-                        )
-                        if 'humidity' in data:
-                            cupboard_climate_record.relative_humidity = round(
-                                data['humidity'], 1
-                            )
-                        cupboard_climate_record.save()
-                except requests.ConnectTimeout:
-                    WorkflowError(
-                        error='Connection Timeout',
-                        description=(
-                            f'{sensor.name} was not contactable at '
-                            f'{sensor.ip_address}.'
-                        )
-                    ).save()
-                except requests.ConnectionError:
-                    WorkflowError(
-                        error='Connection Error',
-                        description=(
-                            f'{sensor.name} was not contactable at '
-                            f'{sensor.ip_address}.'
-                        )
-                    ).save()
-            elif sensor.type == 'esp8266_room':
-                try:
-                    session = requests.Session()
-                    retry = Retry(connect=3, backoff_factor=0.5)
-                    adapter = HTTPAdapter(max_retries=retry)
-                    session.mount('http://', adapter)
-                    session.mount('https://', adapter)
-                    r = session.get(f"http://{sensor.ip_address}/", timeout=5)
-                    data = r.json()
-                    r.close()
-                    temperature = (
+                }
+            reading = {}
+            if 'flow' in data and 'return' in data:
+                reading['heat_pump'] = {
+                    'flow_temperature': round(data['flow'], 2),
+                    'return_temperature': round(data['return'], 2)
+                }
+            if 'air' in data:
+                reading['climate'] = {
+                    'temperature': (
                         round(data['air'], 1)
                         + sensor.temperature_offset
                     )
-                    ClimateSensorRecord(
-                        sensor=sensor,
-                        temperature=temperature,
-                        relative_humidity=round(data['humidity'], 1)
-                    ).save()
-                except requests.ConnectTimeout:
-                    WorkflowError(
-                        error='Connection Timeout',
-                        description=(
-                            f'{sensor.name} was not contactable  at '
-                            f'{sensor.ip_address}.'
-                        )
-                    ).save()
-                except requests.ConnectionError:
-                    WorkflowError(
-                        error='Connection Error',
-                        description=(
-                            f'{sensor.name} was not contactable at '
-                            f'{sensor.ip_address}.'
-                        )
-                    ).save()
-        if not self.daikin_error:
-            heat_pump_status.save()
-
-        return
+                }
+                if 'humidity' in data:
+                    reading['climate']['relative_humidity'] = round(
+                        data['humidity'], 1
+                    )
+            return reading
+        return {}
 
     # Utils
     def _collect_hue_climate_data(self, sensor):
+        mirror = get_mirror(self.hue)
+        if mirror:
+            temperature = mirror.find_v1(
+                'temperature',
+                f"/sensors/{sensor.hue_temp_id}"
+            )
+            light_level = mirror.find_v1(
+                'light_level',
+                f"/sensors/{sensor.hue_light_id}"
+            )
+            if temperature and light_level:
+                return {
+                    'temperature': temperature['temperature']['temperature'],
+                    'ambient_light': light_level['light']['light_level']
+                }
         r = self.hue.get('sensors', sensor.hue_temp_id)
         if not r['success']:
             return r
@@ -189,3 +262,14 @@ class Heating:
             LightsSettings().save()
         return LightsSettings.objects.all().first()
 
+
+# Utils
+def _result_of(future, sensor):
+    if future.exception():
+        return {
+            'error': 'Sensor Error',
+            'description': (
+                f"{sensor.name} could not be read: {future.exception()}"
+            )
+        }
+    return future.result()
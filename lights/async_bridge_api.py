@@ -0,0 +1,269 @@
+import asyncio
+import json
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+
+from .bridge_api import (Bridge,
+                         BridgeResult,
+                         _cache_ttl,
+                         decode,
+                         v1_read_result,
+                         v1_write_result,
+                         v2_result)
+from .event_stream import get_mirror
+
+
+# Connection Pooling
+# An async client is bound to the event loop it was first used on, so
+# clients are kept per loop and per bridge IP and go away with their loop.
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+_cache_key_locks = weakref.WeakKeyDictionary()
+
+
+def get_client(bridge_ip):
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _clients.setdefault(loop, {})
+        if bridge_ip not in clients:
+            clients[bridge_ip] = _build_client()
+        return clients[bridge_ip]
+
+
+def _key_locks():
+    # Striped like the sync cache's key locks, but asyncio locks belong to
+    # a loop, so each loop has its own set.
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        if loop not in _cache_key_locks:
+            _cache_key_locks[loop] = [asyncio.Lock() for _ in range(64)]
+        return _cache_key_locks[loop]
+
+
+def _build_client():
+    transport = httpx.AsyncHTTPTransport(
+        verify=False,
+        retries=settings.HUE_BRIDGE_CONNECT_RETRIES,
+        limits=httpx.Limits(
+            max_connections=settings.HUE_BRIDGE_POOL_SIZE,
+            max_keepalive_connections=settings.HUE_BRIDGE_POOL_SIZE
+        )
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=settings.HUE_BRIDGE_TIMEOUT
+    )
+
+
+class AsyncBridge(Bridge):
+    '''
+        Awaitable counterpart to Bridge. Routing between the v1 and v2 APIs,
+        the resource cache and the result dicts are the same.
+    '''
+    async def request(self, method, url, payload=None):
+        try:
+            r = await get_client(self.bridge_ip).request(
+                method,
+                url,
+                headers=self.headers,
+                timeout=self.timeout,
+                content=None if payload is None else json.dumps(payload)
+            )
+        except (httpx.ConnectTimeout, httpx.PoolTimeout):
+            return None, 'No response from the Bridge.'
+        return decode(r.content)
+
+    async def is_authorised(self):
+        data, error = await self.request(
+            'GET',
+            f"https://{self.bridge_ip}/clip/v2/resource/bridge"
+        )
+        return not error and isinstance(data, dict) \
+            and not data.get('errors')
+
+    async def search(self, endpoint):
+        mirror = get_mirror(self)
+        r = mirror.search(endpoint) if mirror else None
+        if r:
+            return r
+        return await self._cached(
+            endpoint,
+            None,
+            lambda: self.search_v1(endpoint)
+            if endpoint in self.v1_endpoints()
+            else self.search_v2(endpoint)
+        )
+
+    async def get(self, endpoint, id):
+        mirror = get_mirror(self)
+        r = mirror.get(endpoint, id) if mirror else None
+        if r:
+            return r
+        return await self._cached(
+            endpoint,
+            str(id),
+            lambda: self.get_v1(endpoint, id)
+            if endpoint in self.v1_endpoints()
+            else self.get_v2(endpoint, id)
+        )
+
+    async def put(self, endpoint, id, payload, read_back=True):
+        return await self.put_v1(endpoint, id, payload, read_back) \
+            if endpoint in self.v1_endpoints() \
+            else await self.put_v2(endpoint, id, payload)
+
+    async def post(self, endpoint, payload, read_back=True):
+        return await self.post_v1(endpoint, payload, read_back) \
+            if endpoint in self.v1_endpoints() \
+            else await self.post_v2(endpoint, payload)
+
+    async def delete(self, endpoint, id):
+        return await self.delete_v1(endpoint, id) \
+            if endpoint in self.v1_endpoints() \
+            else await self.delete_v2(endpoint, id)
+
+    async def _cached(self, endpoint, id, fetch):
+        if _cache_ttl(endpoint) <= 0:
+            return await fetch()
+        key = self._cache_key(endpoint, id)
+        locks = _key_locks()
+
+        # Concurrent misses on the same key wait for the first fetch.
+        async with locks[hash(key) % len(locks)]:
+            r, generation = self._read_cache(endpoint, key)
+            if r:
+                return r
+            r = await fetch()
+            self._write_cache(endpoint, key, generation, r)
+            return r
+
+    # v2
+    async def search_v2(self, endpoint):
+        response = await self.request(
+            'GET',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}"
+        )
+        return v2_result(response, lambda x: {'records': x['data']})
+
+    async def get_v2(self, endpoint, id):
+        response = await self.request(
+            'GET',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}"
+        )
+        return v2_result(response, lambda x: {'record': x['data'][0]})
+
+    async def put_v2(self, endpoint, id, payload):
+        response = await self.request(
+            'PUT',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}",
+            payload
+        )
+        r = v2_result(response, lambda x: {'record': x['data'][0]})
+        if r.success:
+            self.invalidate(endpoint)
+        return r
+
+    async def post_v2(self, endpoint, payload):
+        response = await self.request(
+            'POST',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}",
+            payload
+        )
+        r = v2_result(response, lambda x: {'record': x['data'][0]})
+        if r.success:
+            self.invalidate(endpoint)
+        return r
+
+    async def delete_v2(self, endpoint, id):
+        response = await self.request(
+            'DELETE',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}"
+        )
+        r = v2_result(response, lambda x: {})
+        if r.success:
+            self.invalidate(endpoint)
+        return r
+
+    # v1
+    async def search_v1(self, endpoint):
+        response = await self.request(
+            'GET',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}"
+        )
+        return v1_read_result(response, lambda x: {'records': x})
+
+    async def get_v1(self, endpoint, id):
+        response = await self.request(
+            'GET',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
+        )
+        return v1_read_result(
+            response,
+            lambda x: {'record': x | {'id_v1': f"/{endpoint}/{id}"}}
+        )
+
+    async def put_v1(self, endpoint, id, payload, read_back=True):
+        response = await self.request(
+            'PUT',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}",
+            payload
+        )
+        r = v1_write_result(response)
+        if not r.success:
+            return r
+        self.invalidate(endpoint)
+        if not read_back:
+            return BridgeResult(
+                success=True,
+                record={'id_v1': f"/{endpoint}/{id}"}
+            )
+        r = await self.get(endpoint, id)
+        if not r['success']:
+            return BridgeResult(
+                success=False,
+                errors=('Updating the record appeared successful, '
+                        'but I was unable to retrieve the result '
+                        f"because of the error: {r['errors']}")
+            )
+        return BridgeResult(success=True, record=r['record'])
+
+    async def post_v1(self, endpoint, payload, read_back=True):
+        response = await self.request(
+            'POST',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}",
+            payload
+        )
+        r = v1_write_result(response)
+        if not r.success:
+            return r
+        self.invalidate(endpoint)
+        id = next(
+            x['success']['id'] for x in response[0] if 'success' in x
+        )
+        if not read_back:
+            return BridgeResult(
+                success=True,
+                record={'id_v1': f"/{endpoint}/{id}"}
+            )
+        r = await self.get(endpoint, id)
+        if not r['success']:
+            return BridgeResult(
+                success=False,
+                errors=('Creating the record appeared successful, '
+                        'but I was unable to retrieve the result '
+                        f"because of the error: {r['errors']}")
+            )
+        return BridgeResult(success=True, record=r['record'])
+
+    async def delete_v1(self, endpoint, id):
+        response = await self.request(
+            'DELETE',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
+        )
+        r = v1_write_result(response)
+        if r.success:
+            self.invalidate(endpoint)
+        return r
@@ -1,16 +1,143 @@
-import requests
+import copy
 import json
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+from .event_stream import get_mirror
 from .models import LightsSettings
 
 
+# Connection Pooling
+# Every Bridge in the process shares one keep-alive session per bridge IP.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(bridge_ip):
+    with _sessions_lock:
+        if bridge_ip not in _sessions:
+            _sessions[bridge_ip] = _build_session()
+        return _sessions[bridge_ip]
+
+
+def _build_session():
+    session = requests.Session()
+    session.verify = False
+    retry = Retry(
+        connect=settings.HUE_BRIDGE_CONNECT_RETRIES,
+        read=0,
+        backoff_factor=0.5
+    )
+    # Enough kept-alive connections for the widest fan-out against one
+    # bridge. Without pool_block, a caller beyond that gets a one-off
+    # connection rather than waiting on the pool with no bound.
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=max(
+            settings.HUE_BRIDGE_POOL_SIZE,
+            settings.LIGHTS_LOADER_WORKERS,
+            settings.HUE_BRIDGE_BATCH_WORKERS
+        ),
+        max_retries=retry
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def connection_stats():
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for bridge_ip, session in sessions:
+        opened = 0
+        requests_made = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+        stats[bridge_ip] = {
+            'opened': opened,
+            'reused': max(requests_made - opened, 0),
+            'requests': requests_made
+        }
+    return stats
+
+
+# Resource Cache
+# Successful search/get results are kept per bridge, user and endpoint for
+# the TTL configured in settings, and dropped whenever that endpoint is
+# written to. Misses on a key are coalesced under one of a fixed set of
+# striped locks, so the locks don't grow with the keys seen.
+_cache = {}
+_cache_lock = threading.Lock()
+_cache_key_locks = [threading.Lock() for _ in range(64)]
+_cache_generations = {}
+_cache_stats = {}
+
+
+def _cache_ttl(endpoint):
+    return settings.HUE_BRIDGE_CACHE_TTLS.get(
+        endpoint,
+        settings.HUE_BRIDGE_CACHE_TTL
+    )
+
+
+def _count_cache(endpoint, outcome):
+    with _cache_lock:
+        stats = _cache_stats.setdefault(endpoint, {'hits': 0, 'misses': 0})
+        stats[outcome] += 1
+
+
+def cache_stats():
+    with _cache_lock:
+        return copy.deepcopy(_cache_stats)
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats.clear()
+
+
+# Write Throttling
+_throttle_lock = threading.Lock()
+_next_write_slots = {}
+
+
+def throttle(bridge_ip):
+    interval = 1 / settings.HUE_BRIDGE_WRITES_PER_SECOND
+    with _throttle_lock:
+        now = time.monotonic()
+        slot = max(now, _next_write_slots.get(bridge_ip, now))
+        _next_write_slots[bridge_ip] = slot + interval
+    time.sleep(slot - now)
+
+
 class Bridge:
     def __init__(self, s):
         requests.packages.urllib3.disable_warnings()
+        self.timeout = settings.HUE_BRIDGE_TIMEOUT
         self.update_creds(s['bridge_ip'], s['bridge_user'])
 
     def update_creds(self, bridge_ip, bridge_user):
         self.bridge_ip = bridge_ip
         self.bridge_user = bridge_user
+        self.session = get_session(bridge_ip)
         self.headers = {
             'hue-application-key': bridge_user,
             'Cache-Control': 'no-cache',
@@ -18,43 +145,56 @@ class Bridge:
         }
 
     def authorise(self):
-        r = requests.post(
-            'http://{}/api'.format(self.bridge_ip),
-            data=json.dumps({
+        data, error = self.request(
+            'POST',
+            f"http://{self.bridge_ip}/api",
+            {
                 'devicetype': 'sitechindustries#hue_helper',
                 'generateclientkey': True
-            })
-        )
-        if 'error' in r.json()[0]:
-            return {
-                'success': False,
-                'message': r.json()[0]['error']['description']
             }
-        elif 'success' in r.json()[0]:
-            self.update_creds(
-                self.bridge_ip,
-                r.json()[0]['success']['username']
+        )
+        if error:
+            return BridgeResult(success=False, message=error)
+        if 'error' in data[0]:
+            return BridgeResult(
+                success=False,
+                message=data[0]['error']['description']
             )
+        elif 'success' in data[0]:
+            credentials = data[0]['success']
+            self.update_creds(self.bridge_ip, credentials['username'])
             s = LightsSettings.objects.all().first()
             s.bridge_ip = self.bridge_ip
-            s.bridge_user = r.json()[0]['success']['username']
-            s.bridge_key = r.json()[0]['success']['clientkey']
+            s.bridge_user = credentials['username']
+            s.bridge_key = credentials['clientkey']
             s.save()
-            return {'success': True}
+            return BridgeResult(success=True)
 
     def is_authorised(self):
-        url = 'https://{}/clip/v2/resource/bridge'.format(self.bridge_ip)
-        try:
-            r = requests.get(url, headers=self.headers, verify=False, timeout=5)
-        except requests.ConnectTimeout:
+        data, error = self.request(
+            'GET',
+            f"https://{self.bridge_ip}/clip/v2/resource/bridge"
+        )
+        if error:
+            print(error)
             return False
+        # A v1 error list or anything else unexpected counts as unauthorised.
+        return isinstance(data, dict) and not data.get('errors')
 
+    def request(self, method, url, payload=None):
         try:
-            if len(r.json()['errors']) <= 0:
-                return True
-        except Exception as e:
-            print(e)
-            return False
+            r = self.session.request(
+                method,
+                url,
+                headers=self.headers,
+                timeout=self.timeout,
+                data=None if payload is None else json.dumps(payload)
+            )
+        except requests.ConnectTimeout:
+            return None, 'No response from the Bridge.'
+        content = r.content
+        r.close()
+        return decode(content)
 
     '''
         The Hue Bridge v2 API is still in development, and some endpoints will
@@ -64,22 +204,38 @@ class Bridge:
         return ['rules', 'schedules', 'sensors', 'resourcelinks']
 
     def search(self, endpoint):
-        return self.search_v1(endpoint) \
-            if endpoint in self.v1_endpoints() \
+        mirror = get_mirror(self)
+        r = mirror.search(endpoint) if mirror else None
+        if r:
+            return r
+        return self._cached(
+            endpoint,
+            None,
+            lambda: self.search_v1(endpoint)
+            if endpoint in self.v1_endpoints()
             else self.search_v2(endpoint)
+        )
 
     def get(self, endpoint, id):
-        return self.get_v1(endpoint, id) \
-            if endpoint in self.v1_endpoints() \
+        mirror = get_mirror(self)
+        r = mirror.get(endpoint, id) if mirror else None
+        if r:
+            return r
+        return self._cached(
+            endpoint,
+            str(id),
+            lambda: self.get_v1(endpoint, id)
+            if endpoint in self.v1_endpoints()
             else self.get_v2(endpoint, id)
+        )
 
-    def put(self, endpoint, id, payload):
-        return self.put_v1(endpoint, id, payload) \
+    def put(self, endpoint, id, payload, read_back=True):
+        return self.put_v1(endpoint, id, payload, read_back) \
             if endpoint in self.v1_endpoints() \
             else self.put_v2(endpoint, id, payload)
 
-    def post(self, endpoint, payload):
-        return self.post_v1(endpoint, payload) \
+    def post(self, endpoint, payload, read_back=True):
+        return self.post_v1(endpoint, payload, read_back) \
             if endpoint in self.v1_endpoints() \
             else self.post_v2(endpoint, payload)
 
@@ -88,232 +244,241 @@ class Bridge:
             if endpoint in self.v1_endpoints() \
             else self.delete_v2(endpoint, id)
 
+    def _cached(self, endpoint, id, fetch):
+        if _cache_ttl(endpoint) <= 0:
+            return fetch()
+        key = self._cache_key(endpoint, id)
+        key_lock = _cache_key_locks[hash(key) % len(_cache_key_locks)]
+
+        # Concurrent misses on the same key wait for the first fetch.
+        with key_lock:
+            r, generation = self._read_cache(endpoint, key)
+            if r:
+                return r
+            r = fetch()
+            self._write_cache(endpoint, key, generation, r)
+            return r
+
+    def _cache_key(self, endpoint, id):
+        return (self.bridge_ip, self.bridge_user, endpoint, id)
+
+    def _read_cache(self, endpoint, key):
+        with _cache_lock:
+            entry = _cache.get(key)
+            generation = _cache_generations.get(key[:3], 0)
+        if entry and entry['expires_at'] > time.monotonic():
+            _count_cache(endpoint, 'hits')
+            return copy.deepcopy(entry['result']), generation
+        _count_cache(endpoint, 'misses')
+        return None, generation
+
+    def _write_cache(self, endpoint, key, generation, r):
+        if not r['success']:
+            return
+        with _cache_lock:
+            if _cache_generations.get(key[:3], 0) == generation:
+                _cache[key] = {
+                    'expires_at': time.monotonic() + _cache_ttl(endpoint),
+                    'result': copy.deepcopy(r)
+                }
+
+    def invalidate(self, endpoint):
+        scope = (self.bridge_ip, self.bridge_user, endpoint)
+        with _cache_lock:
+            _cache_generations[scope] = _cache_generations.get(scope, 0) + 1
+            for key in [k for k in _cache if k[:3] == scope]:
+                del _cache[key]
+
+    # v2
     def search_v2(self, endpoint):
-        url = f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}"
-        try:
-            r = requests.get(url, headers=self.headers, verify=False, timeout=5)
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-
-        if len(r.json()['errors']) > 0:
-            return {
-                'success': False,
-                'errors': '\n'.join([
-                    x['description'] for x in r.json()['errors']
-                ])
-            }
-        else:
-            return {'success': True, 'records': r.json()['data']}
+        response = self.request(
+            'GET',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}"
+        )
+        return v2_result(response, lambda x: {'records': x['data']})
 
     def get_v2(self, endpoint, id):
-        url = f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}"
-        try:
-            r = requests.get(url, headers=self.headers, verify=False, timeout=5)
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        if len(r.json()['errors']) > 0:
-            errors = '\n'.join([x['description'] for x in r.json()['errors']])
-            r.close()
-            return {'success': False, 'errors': errors}
-        else:
-            r.close()
-            return {'success': True, 'record': r.json()['data'][0]}
+        response = self.request(
+            'GET',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}"
+        )
+        return v2_result(response, lambda x: {'record': x['data'][0]})
+
+    def put_v2(self, endpoint, id, payload):
+        response = self.request(
+            'PUT',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}",
+            payload
+        )
+        r = v2_result(response, lambda x: {'record': x['data'][0]})
+        if r.success:
+            self.invalidate(endpoint)
+        return r
 
     def post_v2(self, endpoint, payload):
-        url = f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}"
-        try:
-            r = requests.post(
-                url,
-                headers=self.headers,
-                verify=False,
-                data=json.dumps(payload)
-            )
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        if len(r.json()['errors']) > 0:
-            errors = '\n'.join([
-                    x['description'] for x in r.json()['errors']
-                ])
-            r.close()
-            return {
-                'success': False,
-                'errors': errors
-            }
-        else:
-            record = r.json()['data'][0]
-            r.close()
-            return {'success': True, 'record': record}
+        response = self.request(
+            'POST',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}",
+            payload
+        )
+        r = v2_result(response, lambda x: {'record': x['data'][0]})
+        if r.success:
+            self.invalidate(endpoint)
+        return r
 
     def delete_v2(self, endpoint, id):
-        url = f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}"
-        try:
-            r = requests.delete(
-                url, headers=self.headers, verify=False, timeout=5
-            )
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        if len(r.json()['errors']) > 0:
-            errors = '\n'.join([
-                    x['description'] for x in r.json()['errors']
-                ])
-            r.close()
-            return {
-                'success': False,
-                'errors': errors
-            }
-        else:
-            r.close()
-            return {'success': True}
+        response = self.request(
+            'DELETE',
+            f"https://{self.bridge_ip}/clip/v2/resource/{endpoint}/{id}"
+        )
+        r = v2_result(response, lambda x: {})
+        if r.success:
+            self.invalidate(endpoint)
+        return r
 
+    # v1
     def search_v1(self, endpoint):
-        url = f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}"
-        try:
-            r = requests.get(url, headers=self.headers, verify=False, timeout=5)
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        try:
-            data = r.json()
-        except requests.JSONDecodeError:
-            r.close()
-            return {'success': False, 'errors': 'Response was not JSON.'}
-        if isinstance(data, list):
-            errors = '\n'.join([x['error']['description'] for x in data])
-            r.close()
-            return {
-                'success': False,
-                'errors': errors
-            }
-        else:
-            r.close()
-            return {'success': True, 'records': data}
+        response = self.request(
+            'GET',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}"
+        )
+        return v1_read_result(response, lambda x: {'records': x})
 
     def get_v1(self, endpoint, id):
-        url = f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
-        try:
-            r = requests.get(url, headers=self.headers, verify=False, timeout=5)
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        try:
-            data = r.json()
-        except requests.JSONDecodeError:
-            r.close()
-            return {'success': False, 'errors': 'Response was not JSON.'}
-        if isinstance(data, list):
-            errors = '\n'.join([x['error']['description'] for x in data])
-            r.close()
-            return {
-                'success': False,
-                'errors': errors
-            }
-        else:
-            record = data | {'id_v1': f"/{endpoint}/{id}"}
-            r.close()
-            return {
-                'success': True,
-                'record': record
-            }
+        response = self.request(
+            'GET',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
+        )
+        return v1_read_result(
+            response,
+            lambda x: {'record': x | {'id_v1': f"/{endpoint}/{id}"}}
+        )
 
-    def put_v1(self, endpoint, id, payload):
-        url = f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
-        try:
-            r = requests.put(
-                url,
-                headers=self.headers,
-                verify=False,
-                timeout=5,
-                data=json.dumps(payload)
+    def put_v1(self, endpoint, id, payload, read_back=True):
+        response = self.request(
+            'PUT',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}",
+            payload
+        )
+        r = v1_write_result(response)
+        if not r.success:
+            return r
+        self.invalidate(endpoint)
+        if not read_back:
+            return BridgeResult(
+                success=True,
+                record={'id_v1': f"/{endpoint}/{id}"}
             )
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        try:
-            data = r.json()
-            r.close()
-        except requests.JSONDecodeError:
-            r.close()
-            return {'success': False, 'errors': 'Response was not JSON.'}
-
-        results = sum([list(x.keys()) for x in data], [])
-        if 'success' in results:
-            r = self.get(endpoint, data[0]['success'])
-            if not r['success']:
-                return {
-                    'success': False,
-                    'errors': ('Updating the record appeared successful, '
-                               'but I was unable to retrieve the result '
-                               f"because of the error: {r['errors']}")
-                }
-            return {'success': True, 'record': r['record']}
-        errors = sum([
-            list(x.values()) for x in data
-            if 'error' in list(x.keys())
-        ], [])
-        return {
-            'success': False,
-            'errors': '\n'.join([x['description'] for x in errors])
-        }
+        r = self.get(endpoint, id)
+        if not r['success']:
+            return BridgeResult(
+                success=False,
+                errors=('Updating the record appeared successful, '
+                        'but I was unable to retrieve the result '
+                        f"because of the error: {r['errors']}")
+            )
+        return BridgeResult(success=True, record=r['record'])
 
-    def post_v1(self, endpoint, payload):
-        url = f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}"
-        try:
-            r = requests.post(
-                url,
-                headers=self.headers,
-                verify=False,
-                timeout=5,
-                data=json.dumps(payload)
+    def post_v1(self, endpoint, payload, read_back=True):
+        response = self.request(
+            'POST',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}",
+            payload
+        )
+        r = v1_write_result(response)
+        if not r.success:
+            return r
+        self.invalidate(endpoint)
+        id = next(
+            x['success']['id'] for x in response[0] if 'success' in x
+        )
+        if not read_back:
+            return BridgeResult(
+                success=True,
+                record={'id_v1': f"/{endpoint}/{id}"}
             )
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        try:
-            data = r.json()
-            r.close()
-        except requests.JSONDecodeError:
-            return {'success': False, 'errors': 'Response was not JSON.'}
-        results = sum([list(x.keys()) for x in data], [])
-        r.close()
-        if 'success' in results:
-            r = self.get(endpoint, data[0]['success']['id'])
-            if not r['success']:
-                return {
-                    'success': False,
-                    'errors': ('Creating the record appeared successful, '
-                               'but I was unable to retrieve the result '
-                               f"because of the error: {r['errors']}")
-                }
-            r['record']['id_v1'] = f"/{endpoint}/{data[0]['success']['id']}"
-            return {'success': True, 'record': r['record']}
-        errors = sum([
-            list(x.values()) for x in data
-            if 'error' in list(x.keys())
-        ], [])
-        return {
-            'success': False,
-            'errors': '\n'.join([x['description'] for x in errors])
-        }
+        r = self.get(endpoint, id)
+        if not r['success']:
+            return BridgeResult(
+                success=False,
+                errors=('Creating the record appeared successful, '
+                        'but I was unable to retrieve the result '
+                        f"because of the error: {r['errors']}")
+            )
+        return BridgeResult(success=True, record=r['record'])
 
     def delete_v1(self, endpoint, id):
-        url = f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
-        try:
-            r = requests.delete(
-                url, headers=self.headers, verify=False, timeout=5
-            )
-        except requests.ConnectTimeout:
-            return {'success': False, 'errors': 'No response from the Bridge.'}
-        try:
-            data = r.json()
-        except requests.JSONDecodeError:
-            r.close()
-            return {'success': False, 'errors': 'Response was not JSON.'}
-        results = sum([list(x.keys()) for x in data], [])
-        if 'success' in results:
-            r.close()
-            return {'success': True}
-        errors = sum([
-            list(x.values()) for x in data
-            if 'error' in list(x.keys())
-        ], [])
-        r.close()
-        return {
-            'success': False,
-            'errors': '\n'.join([x['description'] for x in errors])
-        }
+        response = self.request(
+            'DELETE',
+            f"https://{self.bridge_ip}/api/{self.bridge_user}/{endpoint}/{id}"
+        )
+        r = v1_write_result(response)
+        if r.success:
+            self.invalidate(endpoint)
+        return r
+
+
+# Response Handling
+# Every response body is decoded exactly once, with orjson when it is
+# installed, and turned into a BridgeResult by one of the helpers below.
+class BridgeResult(dict):
+    @property
+    def success(self):
+        return self['success']
+
+    @property
+    def errors(self):
+        return self.get('errors')
+
+    @property
+    def record(self):
+        return self.get('record')
+
+    @property
+    def records(self):
+        return self.get('records')
+
+
+def decode(content):
+    try:
+        return _loads(content), None
+    except ValueError:
+        return None, 'Response was not JSON.'
+
+
+def v2_result(response, success):
+    data, error = response
+    if error:
+        return BridgeResult(success=False, errors=error)
+    if data['errors']:
+        return BridgeResult(
+            success=False,
+            errors='\n'.join([x['description'] for x in data['errors']])
+        )
+    return BridgeResult(success=True, **success(data))
+
+
+def v1_read_result(response, success):
+    data, error = response
+    if error:
+        return BridgeResult(success=False, errors=error)
+    if isinstance(data, list):
+        return BridgeResult(
+            success=False,
+            errors='\n'.join([x['error']['description'] for x in data])
+        )
+    return BridgeResult(success=True, **success(data))
+
+
+def v1_write_result(response):
+    data, error = response
+    if error:
+        return BridgeResult(success=False, errors=error)
+    if any('success' in x for x in data):
+        return BridgeResult(success=True)
+    return BridgeResult(
+        success=False,
+        errors='\n'.join([
+            x['error']['description'] for x in data if 'error' in x
+        ])
+    )
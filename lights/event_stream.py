@@ -0,0 +1,167 @@
+import copy
+import json
+import threading
+
+import requests
+from django.conf import settings
+
+
+MIRRORED_TYPES = [
+    'light',
+    'device',
+    'device_power',
+    'room',
+    'scene',
+    'temperature',
+    'light_level',
+]
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(bridge):
+    if not settings.HUE_BRIDGE_EVENTSTREAM:
+        return
+    if not bridge.bridge_ip or not bridge.bridge_user:
+        return
+    key = (bridge.bridge_ip, bridge.bridge_user)
+    with _mirrors_lock:
+        if key not in _mirrors:
+            _mirrors[key] = BridgeMirror(bridge)
+            _mirrors[key].start()
+        mirror = _mirrors[key]
+    return mirror if mirror.is_live() else None
+
+
+class BridgeMirror:
+    def __init__(self, bridge, base_url=None, retry_delay=5):
+        self.bridge = bridge
+        self.base_url = base_url or f"https://{bridge.bridge_ip}"
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        self.session.verify = False
+        self.records = {x: {} for x in MIRRORED_TYPES}
+        self.lock = threading.Lock()
+        self.live = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run,
+            name=f"hue-eventstream-{self.bridge.bridge_ip}",
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_live(self):
+        return self.live.is_set()
+
+    # Reading
+    def search(self, endpoint):
+        if endpoint not in self.records or not self.is_live():
+            return
+        with self.lock:
+            records = copy.deepcopy(list(self.records[endpoint].values()))
+        return {'success': True, 'records': records}
+
+    def get(self, endpoint, id):
+        if endpoint not in self.records or not self.is_live():
+            return
+        with self.lock:
+            record = copy.deepcopy(self.records[endpoint].get(id))
+        if not record:
+            return
+        return {'success': True, 'record': record}
+
+    def find_v1(self, endpoint, id_v1):
+        if endpoint not in self.records or not self.is_live():
+            return
+        with self.lock:
+            for record in self.records[endpoint].values():
+                if record.get('id_v1') == id_v1:
+                    return copy.deepcopy(record)
+
+    # Subscribing
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self._subscribe()
+            except (requests.RequestException, ValueError) as e:
+                print(f"Hue event stream disconnected: {e}")
+            self.live.clear()
+            self.stopped.wait(self.retry_delay)
+
+    def _subscribe(self):
+        # Connect before taking the snapshot so that nothing which changes
+        # while the snapshot loads is missed.
+        r = self.session.get(
+            f"{self.base_url}/eventstream/clip/v2",
+            headers=self.bridge.headers | {'Accept': 'text/event-stream'},
+            stream=True,
+            timeout=(
+                self.bridge.timeout,
+                settings.HUE_BRIDGE_EVENTSTREAM_IDLE
+            )
+        )
+        try:
+            r.raise_for_status()
+            self._load_snapshot()
+            self.live.set()
+            data = []
+            for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+                if self.stopped.is_set():
+                    return
+                if line.startswith('data:'):
+                    data.append(line[5:].strip())
+                elif not line and data:
+                    self._apply(json.loads('\n'.join(data)))
+                    data = []
+        finally:
+            r.close()
+
+    def _load_snapshot(self):
+        records = {}
+        for endpoint in MIRRORED_TYPES:
+            r = self.session.get(
+                f"{self.base_url}/clip/v2/resource/{endpoint}",
+                headers=self.bridge.headers,
+                timeout=self.bridge.timeout
+            )
+            data = r.json()
+            r.close()
+            if data['errors']:
+                raise ValueError(
+                    '\n'.join([x['description'] for x in data['errors']])
+                )
+            records[endpoint] = {x['id']: x for x in data['data']}
+        with self.lock:
+            self.records = records
+
+    def _apply(self, events):
+        with self.lock:
+            for event in events:
+                for resource in event.get('data', []):
+                    records = self.records.get(resource.get('type'))
+                    if records is None:
+                        continue
+                    if event['type'] == 'add':
+                        records[resource['id']] = resource
+                    elif event['type'] == 'delete':
+                        records.pop(resource['id'], None)
+                    elif event['type'] == 'update':
+                        if resource['id'] in records:
+                            _merge(records[resource['id']], resource)
+
+
+# Utils
+def _merge(record, changes):
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(record.get(key), dict):
+            _merge(record[key], value)
+        else:
+            record[key] = value
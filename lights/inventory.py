@@ -0,0 +1,94 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BridgeInventory:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.collections = {}
+        self.ids = {}
+        self.owners = {}
+        self.groups = {}
+        self.products = {}
+        self.uniqueids = {}
+
+    def load(self, endpoints):
+        endpoints = [x for x in endpoints if x not in self.collections]
+        if not endpoints:
+            return {'success': True}
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as pool:
+            results = list(pool.map(self.bridge.search, endpoints))
+        return self._store(endpoints, results)
+
+    async def aload(self, endpoints):
+        endpoints = [x for x in endpoints if x not in self.collections]
+        results = await asyncio.gather(
+            *[self.bridge.search(x) for x in endpoints]
+        )
+        return self._store(endpoints, results)
+
+    def _store(self, endpoints, results):
+        for endpoint, r in zip(endpoints, results):
+            if not r['success']:
+                return {
+                    'success': False,
+                    'errors': f"{endpoint}: {r['errors']}"
+                }
+            self.collections[endpoint] = r['records']
+            self._index(endpoint)
+        return {'success': True}
+
+    def records(self, endpoint):
+        return self.collections[endpoint]
+
+    # Lookups
+    def get(self, endpoint, id):
+        return self.ids[endpoint].get(id)
+
+    def owned_by(self, endpoint, rid):
+        return self.owners[endpoint].get(rid, [])
+
+    def scenes_in(self, room_id):
+        return self.groups['scene'].get(room_id, [])
+
+    def devices_in(self, room):
+        devices = [
+            self.get('device', x['rid']) for x in room['children']
+            if x['rtype'] == 'device'
+        ]
+        return [x for x in devices if x]
+
+    def with_product(self, product_name):
+        return self.products.get(product_name, [])
+
+    def with_uniqueid_prefix(self, prefix):
+        return self.uniqueids.get(prefix, [])
+
+    def _index(self, endpoint):
+        records = self.collections[endpoint]
+        if isinstance(records, dict):
+            # v1 collections are keyed by id and don't carry one themselves.
+            self.ids[endpoint] = {
+                x: y | {'id_v1': f"/{endpoint}/{x}"}
+                for x, y in records.items()
+            }
+        else:
+            self.ids[endpoint] = {x['id']: x for x in records}
+
+        owners = {}
+        groups = {}
+        for record in self.ids[endpoint].values():
+            if 'owner' in record:
+                owners.setdefault(record['owner']['rid'], []).append(record)
+            if 'group' in record:
+                groups.setdefault(record['group']['rid'], []).append(record)
+            if 'product_data' in record:
+                self.products.setdefault(
+                    record['product_data']['product_name'], []
+                ).append(record)
+            if 'uniqueid' in record:
+                self.uniqueids.setdefault(
+                    record['uniqueid'][:27], []
+                ).append(record)
+        self.owners[endpoint] = owners
+        self.groups[endpoint] = groups
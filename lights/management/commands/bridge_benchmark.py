@@ -0,0 +1,111 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from lights.bridge_api import decode, v1_read_result, v1_write_result
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Command(BaseCommand):
+    help = (
+        'Times decoding and result handling for large Bridge responses. '
+        'Pass recorded /rules and /sensors responses to use real payloads.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', help='Recorded v1 rules response.')
+        parser.add_argument('--sensors', help='Recorded v1 sensors response.')
+        parser.add_argument('--count', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        self.repeat = options['repeat']
+        payloads = {
+            'rules': self._recorded(options['rules']) or _rules(count),
+            'sensors': self._recorded(options['sensors']) or _sensors(count),
+        }
+
+        for name, content in payloads.items():
+            self.stdout.write(f"{name} ({len(content) / 1024:.0f} KiB)")
+            self._time('json.loads', lambda: json.loads(content))
+            if orjson:
+                self._time('orjson.loads', lambda: orjson.loads(content))
+            self._time('decode + result', lambda: v1_read_result(
+                decode(content),
+                lambda x: {'records': x}
+            ))
+
+        results = [
+            {'success': {f"/rules/{x}/name": 'Rule'}} for x in range(count)
+        ] + [{'error': {'description': 'invalid value'}}]
+        self.stdout.write(f"write results ({len(results)} entries)")
+        self._time(
+            'sum([...], []) flatten',
+            lambda: 'success' in sum([list(x.keys()) for x in results], [])
+        )
+        self._time(
+            'v1_write_result',
+            lambda: v1_write_result((results, None))
+        )
+
+    def _time(self, label, statement):
+        seconds = min(timeit.repeat(statement, number=1, repeat=self.repeat))
+        self.stdout.write(f"  {label:<24} {seconds * 1000:8.2f} ms")
+
+    def _recorded(self, path):
+        if not path:
+            return
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+# Utils
+def _rules(count):
+    return json.dumps({
+        str(x): {
+            'name': f"Room{x}Motion",
+            'owner': 'user',
+            'created': '2023-01-01T00:00:00',
+            'status': 'enabled',
+            'conditions': [
+                {
+                    'address': f"/sensors/{x}/state/presence",
+                    'operator': 'eq',
+                    'value': 'true'
+                },
+                {
+                    'address': f"/sensors/{x + 1}/state/status",
+                    'operator': 'lt',
+                    'value': '1'
+                },
+            ],
+            'actions': [
+                {
+                    'address': f"/groups/{x}/action",
+                    'method': 'PUT',
+                    'body': {'scene': f"scene-{x}"}
+                },
+            ],
+        }
+        for x in range(count)
+    }).encode()
+
+
+def _sensors(count):
+    return json.dumps({
+        str(x): {
+            'name': f"Sensor {x}",
+            'type': 'ZLLPresence',
+            'modelid': 'SML001',
+            'uniqueid': f"00:17:88:01:02:03:{x % 256:02x}:05-02-0406",
+            'state': {'presence': False, 'lastupdated': '2023-01-01T00:00:00'},
+            'config': {'on': True, 'battery': 100, 'reachable': True},
+        }
+        for x in range(count)
+    }).encode()
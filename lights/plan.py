@@ -0,0 +1,241 @@
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .bridge_api import throttle
+
+
+# Shared by every plan so the bridge never sees more than
+# HUE_BRIDGE_BATCH_WORKERS writes in flight from this process.
+_apply_pool = ThreadPoolExecutor(
+    max_workers=settings.HUE_BRIDGE_BATCH_WORKERS,
+    thread_name_prefix='bridge-plan'
+)
+
+_reference = re.compile(r'@(new\d+)@')
+
+
+class PlanStep:
+    def __init__(self, action, endpoint, task, id=None, payload=None,
+                 previous=None, ref=None):
+        self.action = action
+        self.endpoint = endpoint
+        self.task = task
+        self.id = id
+        self.payload = payload
+        self.previous = previous
+        self.ref = ref
+        self.created_id = None
+
+    def references(self):
+        if self.payload is None:
+            return set()
+        return set(_reference.findall(json.dumps(self.payload)))
+
+    def describe(self):
+        record = self.payload or self.previous or {}
+        name = record.get('name') or record.get('metadata', {}).get('name')
+        target = self.endpoint if self.id is None \
+            else f"{self.endpoint}/{self.id}"
+        label = f" '{name}'" if name else ''
+        return f"{self.action.capitalize()} {target}{label}"
+
+
+class Plan:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.steps = []
+        self.resolved = {}
+        self.applied = []
+
+    def __str__(self):
+        return '\n'.join(self.describe())
+
+    # Building
+    def create(self, task, endpoint, payload):
+        ref = f"new{len(self.steps)}"
+        self.steps.append(
+            PlanStep('create', endpoint, task, payload=payload, ref=ref)
+        )
+        # Later payloads can refer to the new record before it exists; the
+        # placeholder is swapped for the real id when the plan is applied.
+        return {'id': f"@{ref}@", 'id_v1': f"/{endpoint}/@{ref}@"}
+
+    def update(self, task, endpoint, id, payload, previous):
+        self.steps.append(PlanStep(
+            'update', endpoint, task, id=id, payload=payload, previous=previous
+        ))
+
+    def delete(self, task, endpoint, id, previous=None):
+        self.steps.append(
+            PlanStep('delete', endpoint, task, id=id, previous=previous)
+        )
+
+    def links(self):
+        return [
+            f"/{x.endpoint}/@{x.ref}@" for x in self.steps
+            if x.action == 'create'
+            and x.endpoint in self.bridge.v1_endpoints()
+        ]
+
+    def is_empty(self):
+        return not self.steps
+
+    def describe(self):
+        return [x.describe() for x in self.steps]
+
+    # Applying
+    def apply(self):
+        writes = [x for x in self.steps if x.action != 'delete']
+        deletes = [x for x in self.steps if x.action == 'delete']
+
+        for stage in self._write_stages(writes):
+            failure = self._run_stage(stage)
+            if failure:
+                return failure | {'rollback_errors': self._rollback()}
+
+        # Deletes go last. A deleted record can only come back under a new
+        # id, so a failure here leaves the writes in place and reports it.
+        for stage in self._delete_stages(deletes):
+            failure = self._run_stage(stage)
+            if failure:
+                return failure | {'rollback_errors': []}
+        return {'success': True}
+
+    def _write_stages(self, steps):
+        # A step runs one stage after the latest step it refers to, wherever
+        # that step sits in the plan.
+        creators = {x.ref: x for x in steps if x.ref}
+        depth = {}
+
+        def level(step, seen=()):
+            if step in depth:
+                return depth[step]
+            if step in seen:
+                raise ValueError(
+                    f"{step.describe()} depends on itself through its "
+                    f"references."
+                )
+            levels = []
+            for ref in step.references():
+                if ref not in creators:
+                    raise ValueError(
+                        f"{step.describe()} refers to @{ref}@, which no "
+                        f"step in the plan creates."
+                    )
+                levels.append(level(creators[ref], (*seen, step)) + 1)
+            depth[step] = max(levels, default=0)
+            return depth[step]
+
+        stages = []
+        for step in steps:
+            while len(stages) <= level(step):
+                stages.append([])
+            stages[depth[step]].append(step)
+        return stages
+
+    def _delete_stages(self, steps):
+        # Records that link to others (resourcelinks) are deleted after them.
+        targets = [f"/{x.endpoint}/{x.id}" for x in steps]
+        first, last = [], []
+        for step in steps:
+            links = (step.previous or {}).get('links', [])
+            if any(x in targets for x in links):
+                last.append(step)
+            else:
+                first.append(step)
+        return [x for x in [first, last] if x]
+
+    def _run_stage(self, steps):
+        failed = threading.Event()
+        futures = [
+            (step, _apply_pool.submit(self._run, step, failed))
+            for step in steps
+        ]
+        failure = None
+        for step, future in futures:
+            r = future.result()
+            if r is None:
+                continue
+            if not r['success']:
+                if not failure:
+                    failure = {
+                        'success': False,
+                        'task': step.task,
+                        'errors': r['errors']
+                    }
+                continue
+            if step.action == 'create':
+                record = r['record']
+                step.created_id = record['id_v1'].split('/')[-1] \
+                    if 'id_v1' in record else record['rid']
+                self.resolved[step.ref] = step.created_id
+            self.applied.append(step)
+        return failure
+
+    def _run(self, step, failed):
+        if failed.is_set():
+            return
+        throttle(self.bridge.bridge_ip)
+        try:
+            if step.action == 'create':
+                r = self.bridge.post(
+                    step.endpoint,
+                    self._resolve(step.payload),
+                    read_back=False
+                )
+            elif step.action == 'update':
+                r = self.bridge.put(
+                    step.endpoint,
+                    step.id,
+                    self._resolve(step.payload),
+                    read_back=False
+                )
+            else:
+                r = self.bridge.delete(step.endpoint, step.id)
+                if not r['success'] and 'not available' in r['errors']:
+                    r = {'success': True}
+        except Exception as e:
+            r = {'success': False, 'errors': str(e)}
+        if not r['success']:
+            failed.set()
+        return r
+
+    def _resolve(self, payload):
+        text = json.dumps(payload)
+        if not _reference.search(text):
+            return payload
+        return json.loads(
+            _reference.sub(lambda x: self.resolved[x.group(1)], text)
+        )
+
+    def _rollback(self):
+        errors = []
+        for step in reversed(self.applied):
+            if step.action == 'create':
+                r = self.bridge.delete(step.endpoint, step.created_id)
+                target = step.created_id
+            elif step.action == 'update':
+                r = self.bridge.put(
+                    step.endpoint,
+                    step.id,
+                    {
+                        k: v for k, v in step.previous.items()
+                        if k in step.payload
+                    },
+                    read_back=False
+                )
+                target = step.id
+            else:
+                continue
+            if not r['success']:
+                errors.append(
+                    f"While rolling back, I couldn't undo the {step.action} "
+                    f"of {target} in {step.endpoint}. The following error "
+                    f"was returned: {r['errors']}"
+                )
+        self.applied = []
+        return errors
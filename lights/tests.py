@@ -1,3 +1,566 @@
-from django.test import TestCase
+import asyncio
+import copy
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync
+from django.test import (RequestFactory,
+                         SimpleTestCase,
+                         TestCase,
+                         override_settings)
+
+from .event_stream import BridgeMirror
+from .bridge_api import (Bridge,
+                         cache_stats,
+                         clear_cache,
+                         connection_stats,
+                         decode,
+                         get_session,
+                         v1_write_result,
+                         v2_result)
+from .async_bridge_api import AsyncBridge
+from .views import AsyncLights, Lights
+from .workflows import Workflows
+from .models import LightsSettings
+from .plan import Plan
+from .inventory import BridgeInventory
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"errors": [], "data": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBridgeTestCase(SimpleTestCase):
+    handler = KeepAliveHandler
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        self.address = f"127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BridgeSessionTests(FakeBridgeTestCase):
+    def test_bridges_share_a_session_per_ip(self):
+        s = {'bridge_ip': self.address, 'bridge_user': 'user'}
+        self.assertIs(Bridge(s).session, Bridge(s).session)
+        self.assertIsNot(Bridge(s).session, get_session('10.0.0.1'))
+
+    def test_connections_are_reused(self):
+        session = get_session(self.address)
+        for _ in range(3):
+            session.get(f"http://{self.address}/", timeout=5).close()
+        stats = connection_stats()[self.address]
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], 2)
+
+
+class EventStreamHandler(BaseHTTPRequestHandler):
+    released = threading.Event()
+    lights = [{'id': 'light-1', 'type': 'light', 'on': {'on': False}}]
+    events = [{
+        'type': 'update',
+        'data': [{'id': 'light-1', 'type': 'light', 'on': {'on': True}}]
+    }]
+
+    def do_GET(self):
+        self.send_response(200)
+        if self.path == '/eventstream/clip/v2':
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            self.wfile.write(f"data: {json.dumps(self.events)}\n\n".encode())
+            self.wfile.flush()
+            self.released.wait(10)
+            return
+        records = self.lights if self.path.endswith('/light') else []
+        body = json.dumps({'errors': [], 'data': records}).encode()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BridgeMirrorTests(FakeBridgeTestCase):
+    handler = EventStreamHandler
+
+    def test_mirror_applies_streamed_updates(self):
+        bridge = Bridge({'bridge_ip': self.address, 'bridge_user': 'user'})
+        mirror = BridgeMirror(bridge, base_url=f"http://{self.address}")
+        mirror.start()
+        try:
+            self.assertTrue(mirror.live.wait(5))
+            for _ in range(50):
+                r = mirror.get('light', 'light-1')
+                if r['record']['on']['on']:
+                    break
+                threading.Event().wait(0.1)
+            self.assertTrue(r['record']['on']['on'])
+            self.assertIsNone(mirror.search('rules'))
+        finally:
+            mirror.stop()
+            self.handler.released.set()
+
+    def tearDown(self):
+        self.handler.released.set()
+        super().tearDown()
+
+
+class BridgeResultTests(SimpleTestCase):
+    def test_v1_write_results(self):
+        r = v1_write_result(decode(
+            b'[{"success": {"/rules/1/name": "a"}},'
+            b' {"error": {"description": "invalid value"}}]'
+        ))
+        self.assertTrue(r.success)
+        r = v1_write_result(decode(
+            b'[{"error": {"description": "invalid value"}},'
+            b' {"error": {"description": "link not found"}}]'
+        ))
+        self.assertFalse(r.success)
+        self.assertEqual(r.errors, 'invalid value\nlink not found')
+
+    def test_created_id_is_taken_from_the_success_entry(self):
+        bridge = Bridge({'bridge_ip': '10.0.0.4', 'bridge_user': 'user'})
+        response = decode(
+            b'[{"error": {"description": "parameter not available"}},'
+            b' {"success": {"id": "12"}}]'
+        )
+        with mock.patch.object(Bridge, 'request', return_value=response):
+            r = bridge.post_v1('sensors', {'name': 'a'}, read_back=False)
+        self.assertEqual(r['record'], {'id_v1': '/sensors/12'})
+
+    def test_unexpected_bridge_body_is_not_authorised(self):
+        bridge = Bridge({'bridge_ip': '10.0.0.4', 'bridge_user': 'user'})
+        response = decode(
+            b'[{"error": {"type": 1, "description": "unauthorized user"}}]'
+        )
+        with mock.patch.object(Bridge, 'request', return_value=response):
+            self.assertFalse(bridge.is_authorised())
+
+    def test_body_that_is_not_json(self):
+        r = v2_result(decode(b'<html>'), lambda x: {'records': x['data']})
+        self.assertEqual(
+            r,
+            {'success': False, 'errors': 'Response was not JSON.'}
+        )
+
+
+class BridgeCacheTests(SimpleTestCase):
+    def setUp(self):
+        clear_cache()
+        self.bridge = Bridge({'bridge_ip': '10.0.0.2', 'bridge_user': 'user'})
+
+    def test_search_is_read_through(self):
+        records = {'success': True, 'records': [{'id': 'a'}]}
+        with mock.patch.object(
+            Bridge, 'search_v2', return_value=records
+        ) as search_v2:
+            self.bridge.search('device')
+            r = self.bridge.search('device')
+        self.assertEqual(search_v2.call_count, 1)
+        self.assertEqual(r, records)
+        self.assertEqual(cache_stats()['device'], {'hits': 1, 'misses': 1})
+
+    def test_cached_records_are_copies(self):
+        records = {'success': True, 'records': [{'id': 'a'}]}
+        with mock.patch.object(Bridge, 'search_v2', return_value=records):
+            self.bridge.search('device')['records'].append({'id': 'b'})
+            r = self.bridge.search('device')
+        self.assertEqual(len(r['records']), 1)
+
+    def test_writes_invalidate_endpoint(self):
+        records = {'success': True, 'records': {}}
+        with mock.patch.object(
+            Bridge, 'search_v1', return_value=records
+        ) as search_v1:
+            self.bridge.search('rules')
+            self.bridge.invalidate('rules')
+            self.bridge.search('rules')
+        self.assertEqual(search_v1.call_count, 2)
+
+    def test_failures_are_not_cached(self):
+        error = {'success': False, 'errors': 'No response from the Bridge.'}
+        with mock.patch.object(
+            Bridge, 'search_v2', return_value=error
+        ) as search_v2:
+            self.bridge.search('room')
+            self.bridge.search('room')
+        self.assertEqual(search_v2.call_count, 2)
+
+
+class LightsPageTests(TestCase):
+    collections = {
+        'rules': {},
+        'light': [],
+        'resourcelinks': {},
+        'room': [],
+        'device': [],
+        'device_power': [],
+    }
+
+    def setUp(self):
+        LightsSettings(
+            bridge_ip='10.0.0.6',
+            bridge_user='user',
+            bridge_key='key'
+        ).save()
+        self.request = RequestFactory().get('/lights/')
+
+    def _search(self, endpoint):
+        return {'success': True, 'records': self.collections[endpoint]}
+
+    async def _asearch(self, endpoint):
+        return self._search(endpoint)
+
+    def test_failed_loader_renders_partial_page(self):
+        view = Lights()
+        view.setup(self.request)
+        with mock.patch.object(
+            Lights, '_get_rooms', side_effect=RuntimeError('boom')
+        ), mock.patch.object(
+            Bridge, 'search', side_effect=self._search
+        ), mock.patch.object(
+            Bridge, 'is_authorised', return_value=True
+        ), mock.patch('lights.views.messages') as messages:
+            context = view.get_context_data()
+        self.assertEqual(context['rooms'], [])
+        self.assertTrue(context['authorised'])
+        self.assertEqual(context['rule_count'], 0)
+        messages.warning.assert_called_once()
+        self.assertIn('boom', messages.warning.call_args[0][1])
+
+    def test_async_page_matches_sync_page(self):
+        view = AsyncLights()
+        view.setup(self.request)
+        with mock.patch.object(
+            AsyncBridge, 'search', side_effect=self._asearch
+        ), mock.patch.object(
+            AsyncBridge, 'is_authorised', return_value=True
+        ), mock.patch('lights.views.messages') as messages:
+            context = async_to_sync(view.get_context_data)()
+        self.assertTrue(context['authorised'])
+        self.assertEqual(context['rooms'], [])
+        self.assertEqual(context['devices'], [])
+        messages.warning.assert_not_called()
+
+
+class AsyncBridgeTests(SimpleTestCase):
+    def setUp(self):
+        clear_cache()
+        self.bridge = AsyncBridge(
+            {'bridge_ip': '10.0.0.7', 'bridge_user': 'user'}
+        )
+
+    def _client(self, handler):
+        return mock.patch(
+            'lights.async_bridge_api._build_client',
+            side_effect=lambda: httpx.AsyncClient(
+                transport=httpx.MockTransport(handler)
+            )
+        )
+
+    def test_v2_search_matches_bridge_results(self):
+        def handler(request):
+            self.assertEqual(request.url.path, '/clip/v2/resource/device')
+            return httpx.Response(200, json={'errors': [], 'data': [{}]})
+
+        with self._client(handler):
+            r = async_to_sync(self.bridge.search)('device')
+        self.assertEqual(r, {'success': True, 'records': [{}]})
+
+    def test_concurrent_misses_fetch_once(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            return httpx.Response(200, json={'errors': [], 'data': [{}]})
+
+        async def render():
+            return await asyncio.gather(
+                self.bridge.search('device'),
+                self.bridge.search('device')
+            )
+
+        with self._client(handler):
+            async_to_sync(render)()
+            self.assertEqual(len(calls), 1)
+            with override_settings(HUE_BRIDGE_CACHE_TTLS={'device': 0}):
+                async_to_sync(self.bridge.search)('device')
+            self.assertEqual(len(calls), 2)
+
+    def test_v1_write_errors(self):
+        def handler(request):
+            self.assertEqual(request.url.path, '/api/user/rules/4')
+            return httpx.Response(200, json=[
+                {'error': {'description': 'invalid value'}}
+            ])
+
+        with self._client(handler):
+            r = async_to_sync(self.bridge.put)('rules', '4', {'name': 'x'})
+        self.assertEqual(r, {'success': False, 'errors': 'invalid value'})
+
+
+class PlanTests(SimpleTestCase):
+    def setUp(self):
+        self.bridge = Bridge({'bridge_ip': '10.0.0.3', 'bridge_user': 'user'})
+        self.posted = []
+
+    def _post(self, endpoint, payload, read_back=True):
+        if payload['name'] == 'broken':
+            return {'success': False, 'errors': 'invalid rule'}
+        self.posted.append(payload)
+        id = str(len(self.posted))
+        return {'success': True, 'record': {'id_v1': f"/{endpoint}/{id}"}}
+
+    def test_placeholders_resolve_to_created_ids(self):
+        plan = Plan(self.bridge)
+        status = plan.create('posting status', 'sensors', {'name': 'status'})
+        plan.create('posting rule', 'rules', {
+            'name': 'rule',
+            'address': f"{status['id_v1']}/state"
+        })
+        plan.create('posting links', 'resourcelinks', {
+            'name': 'links',
+            'links': plan.links()
+        })
+        with mock.patch.object(Bridge, 'post', side_effect=self._post):
+            r = plan.apply()
+        self.assertTrue(r['success'])
+        self.assertEqual(self.posted[1]['address'], '/sensors/1/state')
+        self.assertEqual(
+            self.posted[2]['links'],
+            ['/sensors/1', '/rules/2']
+        )
+
+    def test_failed_apply_is_rolled_back(self):
+        plan = Plan(self.bridge)
+        for name in ['a', 'b', 'broken']:
+            plan.create(f"posting {name}", 'rules', {'name': name})
+        with mock.patch.object(Bridge, 'post', side_effect=self._post), \
+                mock.patch.object(
+                    Bridge, 'delete', return_value={'success': True}
+                ) as delete:
+            r = plan.apply()
+        self.assertFalse(r['success'])
+        self.assertEqual(r['task'], 'posting broken')
+        self.assertEqual(
+            sorted(x.args for x in delete.call_args_list),
+            sorted(('rules', str(x + 1)) for x in range(len(self.posted)))
+        )
+
+    def test_unknown_placeholder_is_rejected(self):
+        plan = Plan(self.bridge)
+        plan.create('posting rule', 'rules', {
+            'name': 'rule',
+            'address': '/sensors/@new5@/state'
+        })
+        with mock.patch.object(Bridge, 'post', side_effect=self._post):
+            with self.assertRaisesRegex(ValueError, '@new5@'):
+                plan.apply()
+        self.assertEqual(self.posted, [])
+
+    def test_describe_lists_every_change(self):
+        plan = Plan(self.bridge)
+        plan.create('posting rule', 'rules', {'name': 'HallMotion'})
+        plan.delete('deleting rule', 'rules', '7', {'name': 'HallOld'})
+        self.assertEqual(str(plan), (
+            "Create rules 'HallMotion'\n"
+            "Delete rules/7 'HallOld'"
+        ))
+
+
+class BridgeInventoryTests(SimpleTestCase):
+    collections = {
+        'device': [
+            {
+                'id': 'device-1',
+                'metadata': {'name': 'Hall switch'},
+                'product_data': {'product_name': 'Hue dimmer switch'}
+            },
+            {
+                'id': 'device-2',
+                'metadata': {'name': 'Hall sensor'},
+                'product_data': {'product_name': 'Hue motion sensor'}
+            },
+        ],
+        'device_power': [
+            {'id': 'power-2', 'owner': {'rid': 'device-2', 'rtype': 'device'}}
+        ],
+        'sensors': {
+            '10': {'uniqueid': '00:17:88:01:02:03:04:05-02-0406'},
+            '11': {'uniqueid': '00:17:88:01:02:03:04:05-02-0400'},
+        },
+    }
+
+    def setUp(self):
+        bridge = Bridge({'bridge_ip': '10.0.0.5', 'bridge_user': 'user'})
+        self.inventory = BridgeInventory(bridge)
+        with mock.patch.object(
+            Bridge,
+            'search',
+            side_effect=lambda x: {
+                'success': True,
+                'records': self.collections[x]
+            }
+        ) as search:
+            self.inventory.load(['device', 'device_power', 'sensors'])
+            self.inventory.load(['device'])
+        self.assertEqual(search.call_count, 3)
+
+    def test_indexes(self):
+        inventory = self.inventory
+        self.assertEqual(
+            inventory.get('device', 'device-2')['metadata']['name'],
+            'Hall sensor'
+        )
+        power = inventory.owned_by('device_power', 'device-2')
+        self.assertEqual([x['id'] for x in power], ['power-2'])
+        switches = inventory.with_product('Hue dimmer switch')
+        self.assertEqual([x['id'] for x in switches], ['device-1'])
+        sensors = inventory.with_uniqueid_prefix('00:17:88:01:02:03:04:05-02-')
+        self.assertEqual(
+            sorted(x['id_v1'] for x in sensors),
+            ['/sensors/10', '/sensors/11']
+        )
+
+
+class WorkflowTests(TestCase):
+    room = {
+        'id': 'room-1',
+        'id_v1': '/groups/1',
+        'metadata': {'name': 'Hall'},
+        'children': [{'rid': 'device-1', 'rtype': 'device'}]
+    }
+    collections = {
+        'scene': [
+            {
+                'id': f"scene-{x}",
+                'id_v1': f"/scenes/{x}",
+                'metadata': {'name': x},
+                'group': {'rid': 'room-1'}
+            }
+            for x in ['Morning', 'Day', 'Evening', 'Night']
+        ],
+        'rules': {},
+        'sensors': {
+            '10': {
+                'name': 'Hall sensor',
+                'uniqueid': '00:17:88:01:02:03:04:05-02-0406'
+            },
+            '11': {
+                'name': 'Hall light',
+                'uniqueid': '00:17:88:01:02:03:04:05-02-0400'
+            },
+        },
+        'schedules': {},
+        'resourcelinks': {},
+        'device': [{
+            'id': 'device-1',
+            'metadata': {'name': 'Ceiling'},
+            'services': [{'rid': 'light-1', 'rtype': 'light'}]
+        }],
+    }
+    motion_sensor = {'id': 'device-2', 'id_v1': '/sensors/10'}
+
+    def setUp(self):
+        clear_cache()
+        LightsSettings(bridge_ip='10.0.0.4', bridge_user='user').save()
+        self.posted = []
+        self.patches = [
+            mock.patch.object(
+                Bridge,
+                'search',
+                side_effect=lambda x: {
+                    'success': True,
+                    'records': copy.deepcopy(self.collections[x])
+                }
+            ),
+            mock.patch.object(Bridge, 'get', side_effect=AssertionError),
+            mock.patch.object(Bridge, 'post', side_effect=self._post),
+            mock.patch('lights.workflows.messages'),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def _post(self, endpoint, payload, read_back=True):
+        self.posted.append((endpoint, payload))
+        id = str(100 + len(self.posted))
+        return {'success': True, 'record': {'id_v1': f"/{endpoint}/{id}"}}
+
+    def _workflows(self, dry_run=False):
+        devices = {
+            'switches': [],
+            'sensors': [self.motion_sensor],
+            'button': []
+        }
+        return Workflows(mock.Mock(), self.room, devices, dry_run)
+
+    def test_sensor_configuration_dry_run_posts_nothing(self):
+        self._workflows(dry_run=True).create_sensor_configuration(5)
+        self.assertEqual(self.posted, [])
+
+    def test_sensor_configuration_links_every_record(self):
+        self._workflows().create_sensor_configuration(5)
+        endpoint, resourcelink = self.posted[-1]
+        self.assertEqual(endpoint, 'resourcelinks')
+        self.assertEqual(
+            sorted(resourcelink['links']),
+            sorted(f"/{x}/{101 + i}" for i, (x, _) in enumerate(
+                self.posted[:-1]
+            ))
+        )
+        rules = [x for endpoint, x in self.posted if endpoint == 'rules']
+        self.assertEqual(len(rules), 7)
+        self.assertNotIn('@', str(rules))
+
+    def _install(self, delay):
+        self._workflows().create_sensor_configuration(delay)
+        collections = copy.deepcopy(self.collections)
+        for i, (endpoint, payload) in enumerate(self.posted):
+            collections[endpoint][str(101 + i)] = copy.deepcopy(payload)
+        self.collections = collections
+        self.posted = []
+        clear_cache()
+
+    def test_reconcile_only_updates_changed_rules(self):
+        self._install(5)
+        with mock.patch.object(
+            Bridge, 'put', return_value={'success': True, 'record': {}}
+        ) as put:
+            self._workflows().reconcile_sensor_configuration(10)
+        self.assertEqual(self.posted, [])
+        self.assertEqual(
+            [x.args[2]['conditions'][3]['value'] for x in put.call_args_list],
+            ['PT00:09:40']
+        )
+
+    def test_reconcile_unchanged_configuration_makes_no_calls(self):
+        self._install(5)
+        with mock.patch.object(Bridge, 'put') as put:
+            self._workflows().reconcile_sensor_configuration(5)
+        self.assertEqual(self.posted, [])
+        put.assert_not_called()
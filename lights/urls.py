@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.urls import path
 from .views import *
 
 urlpatterns = [
-    path('', Lights.as_view(), name='lights'),
+    path(
+        '',
+        (AsyncLights if settings.LIGHTS_ASYNC else Lights).as_view(),
+        name='lights'
+    ),
     path('auth/', LightsAuth.as_view(), name='lights_auth'),
     path('disconnect/', LightsDisconnect.as_view(), name='lights_disconnect'),
     path('commit/', LightsCommitChanges.as_view(), name='lights_commit'),
@@ -1,3 +1,8 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import HttpResponseRedirect
@@ -5,7 +10,9 @@ from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views.generic import View, TemplateView
 
+from .async_bridge_api import AsyncBridge
 from .bridge_api import Bridge
+from .inventory import BridgeInventory
 from .models import LightsSettings, LightsUserAccess
 from .workflows import (
     Workflows,
@@ -13,198 +20,228 @@ from .workflows import (
 )
 
 
+_loader_pool = ThreadPoolExecutor(
+    max_workers=settings.LIGHTS_LOADER_WORKERS,
+    thread_name_prefix='lights-loader'
+)
+
+
 class Lights(TemplateView):
     template_name = 'lights.html'
 
+    # Each loader needs its own collections from the bridge, so they run side
+    # by side and the page renders whatever has arrived by the deadline.
+    loaders = [
+        ('the rule and bulb counts', ['rules', 'light'], '_get_bridge_counts',
+         {}),
+        ('the rooms', ['resourcelinks', 'room'], '_get_rooms', {'rooms': []}),
+        ('the switches and sensors', ['device'], '_get_switches_and_sensors',
+         {}),
+        ('the battery levels', ['device', 'device_power'], '_check_batteries',
+         {'devices': []}),
+    ]
+
     def dispatch(self, request, *args, **kwargs):
-        # Access Control
-        user = request.user
-        if not user.is_authenticated:
-            return redirect(reverse_lazy('dashboard'))
-        if not LightsUserAccess.objects.filter(User=user).exists():
+        if not _has_access(request.user):
             return redirect(reverse_lazy('dashboard'))
         return super().dispatch(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context = context | self._check_bridge()
-        context = context | self._get_bridge_counts()
-        context = context | self._get_rooms()
-        context = context | self._get_switches_and_sensors({
-            'switches': 'Hue dimmer switch',
-            'sensors': 'Hue motion sensor',
-            'buttons': 'Hue Smart button'
-        })
-        context = context | self._check_batteries()
-        return context
-
-    def _check_bridge(self):
-        s = _get_settings().__dict__
-        if not s['bridge_ip'] or not s['bridge_user'] or not s['bridge_key']:
-            return {'authorised': False, 'settings': s}
-
-        bridge = Bridge(s)
-        if not bridge.is_authorised():
-            return {'authorised': False, 'settings': s}
-
-        return {'authorised': True, 'settings': s}
-
-    def _get_bridge_counts(self):
-        s = _get_settings().__dict__
-        if not s['bridge_ip'] or not s['bridge_user'] or not s['bridge_key']:
-            return {'rooms': []}
-
-        bridge = Bridge(s)
-        r = bridge.search('rules')
-        if not r['success']:
-            error = (
-                'I was not able to find a list of rules because of the '
-                f"following  error: {r['errors']}. Try re-authorising."
+        self.s = _get_settings().__dict__
+        self.warnings = []
+        if not self._has_credentials():
+            return context | self._fallbacks()
+
+        bridge = Bridge(self.s)
+        futures = [(
+            'the bridge status',
+            _loader_pool.submit(self._check_bridge, bridge),
+            {'authorised': False, 'settings': self.s}
+        )] + [
+            (
+                description,
+                _loader_pool.submit(
+                    self._load,
+                    description,
+                    BridgeInventory(bridge),
+                    endpoints,
+                    builder,
+                    fallback
+                ),
+                fallback
             )
-            messages.warning(self.request, error)
-            return {'rule_count': 0}
-
-        rule_count = len(r['records'])
-
-        r = bridge.search('light')
+            for description, endpoints, builder, fallback in self.loaders
+        ]
+        done, _ = wait(
+            [x[1] for x in futures],
+            timeout=settings.LIGHTS_PAGE_DEADLINE
+        )
+        return self._merge(context, futures, done)
+
+    def _load(self, description, inventory, endpoints, builder, fallback):
+        return self._build(
+            description,
+            inventory,
+            inventory.load(endpoints),
+            builder,
+            fallback
+        )
+
+    def _build(self, description, inventory, r, builder, fallback):
         if not r['success']:
-            error = (
-                'I was not able to find a list of lights because of the '
-                f"following  error: {r['errors']}. Try re-authorising."
+            self.warnings.append(
+                f"I was not able to find {description} because of the "
+                f"following error: {r['errors']}. Try re-authorising."
             )
-            messages.warning(self.request, error)
-            return {'rule_count': 0}
+            return fallback
+        return getattr(self, builder)(inventory)
+
+    def _merge(self, context, futures, done):
+        for description, future, fallback in futures:
+            if future not in done:
+                future.cancel()
+                self.warnings.append(
+                    f"The bridge took too long to respond with {description}."
+                )
+                context = context | fallback
+            elif future.exception():
+                self.warnings.append(
+                    f"I was not able to load {description} because of the "
+                    f"following error: {future.exception()}"
+                )
+                context = context | fallback
+            else:
+                context = context | future.result()
 
-        bulb_count = len(r['records'])
+        for warning in self.warnings:
+            messages.warning(self.request, warning)
+        return context
 
-        return {
-            'rule_count': rule_count,
-            'bulb_count': bulb_count
-        }
+    def _has_credentials(self):
+        s = self.s
+        return s['bridge_ip'] and s['bridge_user'] and s['bridge_key']
 
-    def _get_rooms(self):
-        s = _get_settings().__dict__
-        if not s['bridge_ip'] or not s['bridge_user'] or not s['bridge_key']:
-            return {'rooms': []}
+    def _fallbacks(self):
+        context = {'authorised': False, 'settings': self.s}
+        for _, _, _, fallback in self.loaders:
+            context = context | fallback
+        return context
 
-        bridge = Bridge(s)
-        r = bridge.search('resourcelinks')
-        if not r['success']:
-            error = (
-                'I was not able to find a which rooms have existing '
-                'configurations because of the following error: '
-                f"{r['errors']}. Try re-authorising."
-            )
-            messages.warning(self.request, error)
-            return {'rooms': rooms}
+    def _check_bridge(self, bridge):
+        return self._bridge_status(bridge.is_authorised())
+
+    def _bridge_status(self, authorised):
+        return {'authorised': bool(authorised), 'settings': self.s}
 
-        resource_links = [{**room, "id": k} for k, room in r['records'].items()]
+    def _get_bridge_counts(self, inventory):
+        return {
+            'rule_count': len(inventory.records('rules')),
+            'bulb_count': len(inventory.records('light'))
+        }
 
+    def _get_rooms(self, inventory):
         rooms_with_sensors = [
-            x['name'].replace('Sensor', '') for x in resource_links
+            x['name'].replace('Sensor', '')
+            for x in inventory.records('resourcelinks').values()
             if x['description'] == 'Barry Butler Sensor Configuration.'
         ]
-
-
-        r = bridge.search('room')
-        if not r['success']:
-            error = (
-                'I was not able to find a list of rooms because of the '
-                f"following  error: {r['errors']}. Try re-authorising."
-            )
-            messages.warning(self.request, error)
-            return {'rooms': []}
         rooms = [
             {
                 'id': x['id'],
                 'name': x['metadata']['name'],
-                'sensors': True
-                    if x['metadata']['name'] in rooms_with_sensors
-                    else False
+                'sensors': x['metadata']['name'] in rooms_with_sensors
             }
-            for x in r['records']
+            for x in inventory.records('room')
         ]
-
         return {'rooms': rooms}
 
-    def _get_switches_and_sensors(self, devices):
-        s = _get_settings().__dict__
-        if not s['bridge_ip'] or not s['bridge_user'] or not s['bridge_key']:
-            return {'rooms': []}
-
-        bridge = Bridge(s)
-        r = bridge.search('device')
-        if not r['success']:
-            error = (
-                'I was not able to find a list of switches because of the '
-                f"following  error: {r['errors']}. Try re-authorising."
-            )
-            messages.warning(self.request, error)
-            return r
-
-        response = {}
-
-        for key, product_name in devices.items():
-            response[key] = [
-                x for x in r['records']
-                if x['product_data']['product_name'] == product_name
-            ]
-
-        return response
-
-    def _check_batteries(self):
-        s = _get_settings().__dict__
-        if not s['bridge_ip'] or not s['bridge_user'] or not s['bridge_key']:
-            return {'devices': []}
-
-        bridge = Bridge(s)
-
-        r = bridge.search('device')
-        if not r['success']:
-            error = (
-                'I was not able to find a list of devices because of the '
-                f"following  error: {r['errors']}. Try re-authorising."
-            )
-            messages.warning(self.request, error)
-            return {'devices': []}
-        device_list = r['records']
-
-        r = bridge.search('device_power')
-        if not r['success']:
-            error = (
-                'I was not able to find a list of devices because of the '
-                f"following  error: {r['errors']}. Try re-authorising."
-            )
-            messages.warning(self.request, error)
-            return {'devices': []}
-        power_states = r['records']
+    def _get_switches_and_sensors(self, inventory):
+        return {
+            'switches': inventory.with_product('Hue dimmer switch'),
+            'sensors': inventory.with_product('Hue motion sensor'),
+            'buttons': inventory.with_product('Hue Smart button')
+        }
 
+    def _check_batteries(self, inventory):
         devices = []
-        for state in power_states:
-            name = [
-                x['metadata']['name'] for x in device_list
-                if x['id'] == state['owner']['rid']
-            ][0]
-            try:
-                devices.append({
-                    'name': name,
-                    'battery_level': state['power_state']['battery_level']
-                })
-            except KeyError:
-                devices.append({
-                    'name': name,
-                    'battery_level': '??'
-                })
-
-        for x in devices:
-            if x['battery_level'] == '??':
-                x['battery_level'] = 20
+        for state in inventory.records('device_power'):
+            device = inventory.get('device', state['owner']['rid'])
+            if not device:
+                continue
+            devices.append({
+                'name': device['metadata']['name'],
+                'battery_level': state.get('power_state', {}).get(
+                    'battery_level', 20
+                )
+            })
+
         return {
             'devices': devices,
             'battery_warning': any(x['battery_level'] < 20 for x in devices)
         }
 
 
+class AsyncLights(Lights):
+    '''
+        The Lights page for ASGI deployments. Bridge calls are awaited on the
+        event loop instead of holding a thread each.
+    '''
+    async def dispatch(self, request, *args, **kwargs):
+        if not await sync_to_async(_has_access)(request.user):
+            return redirect(reverse_lazy('dashboard'))
+        return await super(Lights, self).dispatch(request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        context = await self.get_context_data(**kwargs)
+        return self.render_to_response(context)
+
+    async def get_context_data(self, **kwargs):
+        context = super(Lights, self).get_context_data(**kwargs)
+        self.s = (await sync_to_async(_get_settings)()).__dict__
+        self.warnings = []
+        if not self._has_credentials():
+            return context | self._fallbacks()
+
+        bridge = AsyncBridge(self.s)
+        futures = [(
+            'the bridge status',
+            asyncio.ensure_future(self._acheck_bridge(bridge)),
+            {'authorised': False, 'settings': self.s}
+        )] + [
+            (
+                description,
+                asyncio.ensure_future(self._aload(
+                    description,
+                    BridgeInventory(bridge),
+                    endpoints,
+                    builder,
+                    fallback
+                )),
+                fallback
+            )
+            for description, endpoints, builder, fallback in self.loaders
+        ]
+        done, _ = await asyncio.wait(
+            [x[1] for x in futures],
+            timeout=settings.LIGHTS_PAGE_DEADLINE
+        )
+        return self._merge(context, futures, done)
+
+    async def _aload(self, description, inventory, endpoints, builder,
+                     fallback):
+        return self._build(
+            description,
+            inventory,
+            await inventory.aload(endpoints),
+            builder,
+            fallback
+        )
+
+    async def _acheck_bridge(self, bridge):
+        return self._bridge_status(await bridge.is_authorised())
+
+
 class LightsAuth(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         return HttpResponseRedirect(reverse_lazy('lights'))
@@ -245,6 +282,7 @@ class LightsCommitChanges(LoginRequiredMixin, View):
         self.request = request
         self.s = _get_settings().__dict__
         self.bridge = Bridge(self.s)
+        self.inventory = BridgeInventory(self.bridge)
 
         r = self.bridge.get('room', request.POST['room_id'])
         if not r['success']:
@@ -309,7 +347,12 @@ class LightsCommitChanges(LoginRequiredMixin, View):
         # Get delay
         delay = request.POST['minutes']
 
-        bridge_secretary = Workflows(request, room, devices)
+        bridge_secretary = Workflows(
+            request,
+            room,
+            devices,
+            dry_run='dry_run' in request.POST
+        )
         if request.POST['action_type'] == 'create_scenes':
             try:
                 bridge_secretary.create_daily_scenes()
@@ -325,7 +368,7 @@ class LightsCommitChanges(LoginRequiredMixin, View):
                 messages.error(request, 'Please select at least one switch.')
             else:
                 try:
-                    bridge_secretary.create_switch_configuration()
+                    bridge_secretary.reconcile_switch_configuration()
                 except WorkflowException as e:
                     messages.error(request, e)
         elif request.POST['action_type'] == 'remove_switches':
@@ -338,7 +381,9 @@ class LightsCommitChanges(LoginRequiredMixin, View):
                 messages.error(request, 'Please select at least one sensor.')
             else:
                 try:
-                    bridge_secretary.create_sensor_configuration(float(delay))
+                    bridge_secretary.reconcile_sensor_configuration(
+                        float(delay)
+                    )
                 except WorkflowException as e:
                     messages.error(request, e)
         elif request.POST['action_type'] == 'remove_sensors':
@@ -356,20 +401,28 @@ class LightsCommitChanges(LoginRequiredMixin, View):
         return HttpResponseRedirect(reverse_lazy('lights'))
 
     def _get_devices(self, type_slug):
-        ids = [
+        ids = {
             x.replace(f"{type_slug}_", '') for x in self.request.POST.keys()
             if x[:len(type_slug)+1] == f"{type_slug}_"
-        ]
-        r = self.bridge.search('device')
+        }
+        r = self.inventory.load(['device'])
         if not r['success']:
             return r
         return {
             'success': True,
-            'records': [x for x in r['records'] if x['id'] in ids]
+            'records': [
+                x for x in self.inventory.records('device') if x['id'] in ids
+            ]
         }
 
 
 # Utils
+def _has_access(user):
+    if not user.is_authenticated:
+        return False
+    return LightsUserAccess.objects.filter(User=user).exists()
+
+
 def _get_settings():
     if not LightsSettings.objects.all().exists():
         LightsSettings().save()
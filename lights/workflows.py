@@ -1,5 +1,7 @@
 from .bridge_api import Bridge
+from .inventory import BridgeInventory
 from .models import LightsSettings
+from .plan import Plan
 from django.contrib import messages
 import copy
 import random
@@ -19,21 +21,22 @@ class WorkflowException(Exception):
 
 
 class Workflows:
-    def __init__(self, request, room, devices):
+    def __init__(self, request, room, devices, dry_run=False):
         self.s = get_settings().__dict__
         self.bridge = Bridge(self.s)
+        self.dry_run = dry_run
 
         self.request = request
         self.room = room
         self.room_name = room['metadata']['name']
         self.room_name_min = self.room_name.replace(' ', '')
+        self.inventory = self._load_inventory()
         self.scenes = self._get_scenes_for_room()
         self.lights = self._get_lights_in_room()
 
         self.switches = devices['switches']
         self.sensors = devices['sensors']
         self.button = devices['button']
-        self.records_posted = []
         self.schedule = None
         self.flag = None
         self.occupancy_status = None
@@ -50,10 +53,11 @@ class Workflows:
 
     def create_daily_scenes(self):
         self.pluralise = 'Daily Scenes'
-        r = self.bridge.search('rules')
-        if not r['success']:
-            self.failure('getting rule data', r['errors'])
-        rule_names = [x['name'] for x in r['records'].values()]
+        plan = Plan(self.bridge)
+        rules = {
+            x['name']: (id, x)
+            for id, x in self.inventory.records('rules').items()
+        }
 
         # Create Scenes
         for time_of_day in self.scene_names:
@@ -67,110 +71,121 @@ class Workflows:
                     scene_name = f"Lamps for {time_of_day}"
                 exists = scene_name in existing_scene_names
                 if post_it and not exists:
-                    r = self.bridge.post(
+                    plan.create(
+                        f"creating new scene for {scene_name}",
                         'scene',
                         self.payload__scene(time_of_day, lamps_scene)
                     )
-                    if not r['success']:
-                        self._failure(
-                            f"creating new scene for {scene_name}",
-                            r['errors']
-                        )
                 lamps_scene = True
                 post_it = self._room_has_lamps()
 
-            # Create Transition Rule
-            rule_name = f"{self.room_name_min}>>{time_of_day}"
-            if not rule_name in rule_names:
-                r = self.bridge.post(
+            # Create or Update Transition Rule
+            payload = self.payload__transition_rule(time_of_day)
+            if not payload['name'] in rules:
+                plan.create(
+                    f"creating new transition rule for {time_of_day}",
                     'rules',
-                    self.payload__transition_rule(time_of_day)
+                    payload
                 )
-                if not r['success']:
-                    self._failure(
-                        f"creating new transition rule for {time_of_day}",
-                        r['errors']
+            else:
+                id, rule = rules[payload['name']]
+                if self._rule_changed(rule, payload):
+                    plan.update(
+                        f"updating transition rule for {time_of_day}",
+                        'rules',
+                        id,
+                        self._rule_body(payload),
+                        rule
                     )
 
-        self._create_success()
+        config = self._get_resourcelink('Daily Scenes')
+        kept = config['links'] if config else []
+        self._reconcile_success(plan, config, kept)
 
     def remove_daily_scenes(self):
         self.pluralise = 'Daily Scenes'
+        plan = Plan(self.bridge)
 
         scenes_to_remove = self.scene_names + [
             f"Lamps for {x}" for x in self.scene_names
         ]
         for scene in self.scenes:
             if scene['metadata']['name'] in scenes_to_remove:
-                r = self.bridge.delete('scene', scene['id'])
-                if not r['success']:
-                    self._failure(
-                        f"deleting scene {scene['metadata']['name']}",
-                        r['errors']
-                    )
+                plan.delete(
+                    f"deleting scene {scene['metadata']['name']}",
+                    'scene',
+                    scene['id'],
+                    scene
+                )
 
-        r = self.bridge.search('rules')
-        if not r['success']:
-            self.failure('getting rule data', r['errors'])
-        for id_v1, rule in r['records'].items():
-            for scene_name in self.scene_names:
-                rule_to_delete = f"{self.room_name_min}>>{scene_name}"
-                if rule['name'] == rule_to_delete:
-                    r = self.bridge.delete('rules', id_v1)
-                    if not r['success']:
-                        self._failure('deleting rule', r['errors'])
-        self._remove_success()
+        rules_to_remove = [
+            f"{self.room_name_min}>>{x}" for x in self.scene_names
+        ]
+        for id_v1, rule in self.inventory.records('rules').items():
+            if rule['name'] in rules_to_remove:
+                plan.delete('deleting rule', 'rules', id_v1, rule)
+        if self._apply(plan):
+            self._remove_success()
 
     def create_switch_configuration(self):
         self.pluralise = 'Switch' if len(self.switches) == 1 else 'Switches'
         self._check_config_exists()
         self._check_daily_scenes_exist()
+        plan = Plan(self.bridge)
 
         if self._has_lamps_scenes():
-            self.flag = self._post(
+            self.flag = plan.create(
                 'posting Click Check Sensor',
                 'sensors',
                 self.payload__click_check_sensor()
             )
 
-            self.schedule = self._post(
+            self.schedule = plan.create(
                 'posting Click Check Schedule',
                 'schedules',
                 self.payload__click_check_schedule()
             )
 
-        for switch in self.switches:
-            if len(self.switches) > 1:
-                self.switch_suffix += 1
+        for task, payload in self._switch_rules():
+            plan.create(task, 'rules', payload)
 
-            for button in self.generic_buttons:
-                record = self._post(
-                    f"posting {button['suffix']} button rule",
-                    'rules',
-                    self.payload__generic_button(switch, button)
-                )
+        return self._create_success(plan)
 
-            for scene_name in self.scene_names:
-                if self._has_lamps_scenes():
-                    record = self._post(
-                        f"posting {scene_name} Lamps On button rule",
-                        'rules',
-                        self.payload__on_button_lamps(switch, scene_name)
-                    )
-                    record = self._post(
-                        f"posting {scene_name} Main On button rule",
-                        'rules',
-                        self.payload__on_button_main(switch, scene_name)
-                    )
+    def reconcile_switch_configuration(self):
+        self.pluralise = 'Switch' if len(self.switches) == 1 else 'Switches'
+        config = self._get_resourcelink('Switches') \
+            or self._get_resourcelink('Switch')
+        if not config:
+            return self.create_switch_configuration()
+        self._check_daily_scenes_exist()
+        plan = Plan(self.bridge)
+        kept = [x for x in config['links'] if not x.startswith('/rules/')]
 
-                else:
-                    record = self._post(
-                        f"posting {scene_name} On button rule",
-                        'rules',
-                        self.payload__on_button_no_lamps(switch, scene_name)
-                    )
+        flag = self._linked_record(
+            config, 'sensors', f"{self.room_name_min}Clicked"
+        )
+        schedule = self._linked_record(
+            config, 'schedules', f"{self.room_name_min}Clicked"
+        )
+        if self._has_lamps_scenes():
+            self.flag = flag or plan.create(
+                'posting Click Check Sensor',
+                'sensors',
+                self.payload__click_check_sensor()
+            )
+            self.schedule = schedule or plan.create(
+                'posting Click Check Schedule',
+                'schedules',
+                self.payload__click_check_schedule()
+            )
+        else:
+            for record in [x for x in [flag, schedule] if x]:
+                endpoint, id = record['id_v1'].split('/')[1:3]
+                plan.delete('removing Click Check', endpoint, id, record)
+                kept.remove(record['id_v1'])
 
-        return self._create_success()
+        kept += self._reconcile_rules(plan, config, self._switch_rules())
+        return self._reconcile_success(plan, config, kept)
 
     def remove_switch_configuration(self):
         self.pluralise = 'Switch Configuration'
@@ -184,8 +199,8 @@ class Workflows:
                 )
                 messages.warning(self.request, message)
                 return
-        self._delete_records_in(config)
-        return self._remove_success()
+        if self._delete_records_in(config):
+            return self._remove_success()
 
     def create_sensor_configuration(self, delay):
         self.pluralise = 'Sensor' if len(self.sensors) == 1 else 'Sensors'
@@ -196,74 +211,38 @@ class Workflows:
                 'checking compatibility with the bridge',
                 config_exists
             )
+        plan = Plan(self.bridge)
 
-        self.occupancy_status = self._post(
+        self.occupancy_status = plan.create(
             'posting Occupancy Status Sensor',
             'sensors',
             self.payload__status_sensor()
         )
 
-        for sensor in self.sensors:
-            self.light_level_sensor = self._get_light_level_sensor_for(sensor)
-            if len(self.switches) > 1:
-                self.switch_suffix += 1
+        for task, payload in self._sensor_rules(delay):
+            plan.create(task, 'rules', payload)
 
-            record = self._post(
-                f"posting Occupancy Detected 1 rule",
-                'rules',
-                self.payload__occupancy(sensor)
-            )
-            record = self._post(
-                f"posting Dim (No Motion) rule",
-                'rules',
-                self.payload__dim_no_motion(sensor, delay)
-            )
-            record = self._post(
-                f"posting Off (No Motion) rule",
-                'rules',
-                self.payload__off_no_motion(sensor)
-            )
-            if len(self.button):
-                record = self._post(
-                    f" posting Sensor Snooze rule",
-                    'rules',
-                    self.payload__sensor_snooze()
-                )
-                record = self._post(
-                    f" posting Sensor Un-Snooze rule",
-                    'rules',
-                    self.payload__sensor_unsnooze()
-                )
-                record = self._post(
-                    f" posting Button Off rule",
-                    'rules',
-                    self.payload__button_off()
-                )
-                record = self._post(
-                    f" posting Override Button On rule",
-                    'rules',
-                    self.payload__override_button_on()
-                )
-                record = self._post(
-                    f" posting Override Button Dim (No Motion) rule",
-                    'rules',
-                    self.payload__override_dim_no_motion(sensor, delay)
-                )
+        return self._create_success(plan)
 
-            for scene_name in self.scene_names:
-                record = self._post(
-                    f"posting {scene_name} On rule",
-                    'rules',
-                    self.payload__sensor_on(scene_name)
-                )
-                if len(self.button):
-                    record = self._post(
-                        f" posting {scene_name} Button On rule",
-                        'rules',
-                        self.payload__button_on(scene_name)
-                    )
+    def reconcile_sensor_configuration(self, delay):
+        self.pluralise = 'Sensor' if len(self.sensors) == 1 else 'Sensors'
+        config = self._get_resourcelink('Sensors') \
+            or self._get_resourcelink('Sensor')
+        if not config:
+            return self.create_sensor_configuration(delay)
+        plan = Plan(self.bridge)
+        kept = [x for x in config['links'] if not x.startswith('/rules/')]
+
+        self.occupancy_status = self._linked_record(
+            config, 'sensors', f"{self.room_name_min}Occupancy"
+        ) or plan.create(
+            'posting Occupancy Status Sensor',
+            'sensors',
+            self.payload__status_sensor()
+        )
 
-        return self._create_success()
+        kept += self._reconcile_rules(plan, config, self._sensor_rules(delay))
+        return self._reconcile_success(plan, config, kept)
 
     def remove_sensor_configuration(self):
         self.pluralise = 'Sensor Configuration'
@@ -277,8 +256,8 @@ class Workflows:
                 )
                 messages.warning(self.request, message)
                 return
-        self._delete_records_in(config)
-        return self._remove_success()
+        if self._delete_records_in(config):
+            return self._remove_success()
 
     def enable_disable_maintenance_mode(self, action):
         self.pluralise = 'Sensor Configuration'
@@ -313,37 +292,204 @@ class Workflows:
             )
         return self._maintenance_success(action)
 
+    # Rule sets
+    def _switch_rules(self):
+        rules = []
+        for switch in self.switches:
+            if len(self.switches) > 1:
+                self.switch_suffix += 1
+
+            for button in self.generic_buttons:
+                rules.append((
+                    f"posting {button['suffix']} button rule",
+                    self.payload__generic_button(switch, button)
+                ))
+
+            for scene_name in self.scene_names:
+                if self._has_lamps_scenes():
+                    rules.append((
+                        f"posting {scene_name} Lamps On button rule",
+                        self.payload__on_button_lamps(switch, scene_name)
+                    ))
+                    rules.append((
+                        f"posting {scene_name} Main On button rule",
+                        self.payload__on_button_main(switch, scene_name)
+                    ))
+
+                else:
+                    rules.append((
+                        f"posting {scene_name} On button rule",
+                        self.payload__on_button_no_lamps(switch, scene_name)
+                    ))
+        return rules
+
+    def _sensor_rules(self, delay):
+        rules = []
+        for sensor in self.sensors:
+            self.light_level_sensor = self._get_light_level_sensor_for(sensor)
+            if len(self.switches) > 1:
+                self.switch_suffix += 1
+
+            rules.append((
+                f"posting Occupancy Detected 1 rule",
+                self.payload__occupancy(sensor)
+            ))
+            rules.append((
+                f"posting Dim (No Motion) rule",
+                self.payload__dim_no_motion(sensor, delay)
+            ))
+            rules.append((
+                f"posting Off (No Motion) rule",
+                self.payload__off_no_motion(sensor)
+            ))
+            if len(self.button):
+                rules.append((
+                    f" posting Sensor Snooze rule",
+                    self.payload__sensor_snooze()
+                ))
+                rules.append((
+                    f" posting Sensor Un-Snooze rule",
+                    self.payload__sensor_unsnooze()
+                ))
+                rules.append((
+                    f" posting Button Off rule",
+                    self.payload__button_off()
+                ))
+                rules.append((
+                    f" posting Override Button On rule",
+                    self.payload__override_button_on()
+                ))
+                rules.append((
+                    f" posting Override Button Dim (No Motion) rule",
+                    self.payload__override_dim_no_motion(sensor, delay)
+                ))
+
+            for scene_name in self.scene_names:
+                rules.append((
+                    f"posting {scene_name} On rule",
+                    self.payload__sensor_on(scene_name)
+                ))
+                if len(self.button):
+                    rules.append((
+                        f" posting {scene_name} Button On rule",
+                        self.payload__button_on(scene_name)
+                    ))
+        return rules
+
+    # Reconciliation
+    def _reconcile_rules(self, plan, config, desired):
+        # Rules can share a name (one set per sensor), so pair them up with
+        # the linked rules of that name in the order they were created.
+        existing = {}
+        for link in sorted(config['links'], key=self._link_order):
+            endpoint, id = link.split('/')[1:3]
+            rule = self.inventory.records('rules').get(id)
+            if endpoint == 'rules' and rule:
+                existing.setdefault(rule['name'], []).append((id, rule))
+
+        kept = []
+        for task, payload in desired:
+            matches = existing.get(payload['name'])
+            if not matches:
+                plan.create(task, 'rules', payload)
+                continue
+            id, rule = matches.pop(0)
+            kept.append(f"/rules/{id}")
+            if self._rule_changed(rule, payload):
+                plan.update(
+                    task.replace('posting', 'updating'),
+                    'rules',
+                    id,
+                    self._rule_body(payload),
+                    rule
+                )
+
+        for matches in existing.values():
+            for id, rule in matches:
+                plan.delete('removing unused rule', 'rules', id, rule)
+        return kept
+
+    def _reconcile_success(self, plan, config, kept):
+        if not config:
+            return self._create_success(plan)
+        links = kept + plan.links()
+        name = f"{self.room_name_min}{self.pluralise}"
+        if sorted(links) != sorted(config['links']) or name != config['name']:
+            id = config['id_v1'].split('/')[2]
+            plan.update(
+                'updating Resource Link set',
+                'resourcelinks',
+                id,
+                {'name': name, 'links': links},
+                config
+            )
+        if plan.is_empty():
+            message = (
+                f"Nothing needed changing for the {self.pluralise} in the "
+                f"{self.room_name}."
+            )
+            messages.info(self.request, message)
+            return
+        if not self._apply(plan):
+            return
+        message = f"{self.pluralise} updated for the {self.room_name}."
+        messages.success(self.request, message)
+        return
+
+    def _rule_changed(self, rule, payload):
+        return any(
+            rule.get(x) != payload[x] for x in self._rule_body(payload)
+        )
+
+    def _rule_body(self, payload):
+        return {x: payload[x] for x in ['conditions', 'actions']}
+
+    def _linked_record(self, config, endpoint, name):
+        for link in config['links']:
+            link_endpoint, id = link.split('/')[1:3]
+            record = self.inventory.collections.get(endpoint, {}).get(id)
+            if link_endpoint == endpoint and record and record['name'] == name:
+                return record | {'id_v1': link}
+        return
+
+    def _link_order(self, link):
+        id = link.split('/')[2]
+        return int(id) if id.isdigit() else 0
+
+    # Apply changes
+    def _apply(self, plan):
+        if self.dry_run:
+            changes = '; '.join(plan.describe()) or 'no changes'
+            message = (
+                f"Preview of {self.pluralise} for the {self.room_name}: "
+                f"{changes}."
+            )
+            messages.info(self.request, message)
+            return False
+        r = plan.apply()
+        if not r['success']:
+            for error in r['rollback_errors']:
+                messages.warning(self.request, error)
+            self._failure(r['task'], r['errors'])
+        return True
+
     # Handle failure
     def _failure(self, task, message):
         error = (
             f"Unfortunately while I was {task} the "
             f"following error was returned: {message}"
         )
-        self._cleanup()
         raise WorkflowException(error)
 
-    def _cleanup(self):
-        for record in self.records_posted:
-            if record['endpoint'] in self.bridge.v1_endpoints():
-                rid = record['id_v1'].replace(f"/{record['endpoint']}/", '')
-            else:
-                rid = record['id']
-            r = self.bridge.delete(record['endpoint'], rid)
-            if not r['success']:
-                message = (
-                    f"While trying to cleanup, I couldn't delete the record "
-                    f"{rid} from {record['endpoint']}. The following error was "
-                    f"returned: {r['errors']}"
-                )
-                messages.warning(self.request, message)
-
     # Handle success
-    def _create_success(self):
-        record = self._post(
+    def _create_success(self, plan):
+        plan.create(
             'creating Resource Link set',
             'resourcelinks',
-            self.payload__resource_link()
+            self.payload__resource_link(plan.links())
         )
+        if not self._apply(plan):
+            return
         message = f"{self.pluralise} configured for the {self.room_name}."
         messages.success(self.request, message)
         return
@@ -1008,101 +1154,88 @@ class Workflows:
         return {'state': {'status': 0 if action == 'disable' else 3}}
 
     # Resource Link
-    def payload__resource_link(self):
+    def payload__resource_link(self, links):
         return {
             'name': f"{self.room_name_min}{self.pluralise}",
             'description': f"Barry Butler {self.pluralise} Configuration.",
             'classid': 1,
             'recycle': False,
-            'links': [x['id_v1'] for x in self.records_posted]
+            'links': links
         }
 
     # Utils
-    def _get_scenes_for_room(self):
-        r = self.bridge.search('scene')
+    def _load_inventory(self):
+        inventory = BridgeInventory(self.bridge)
+        r = inventory.load(
+            [
+                'device',
+                'scene',
+                'rules',
+                'sensors',
+                'schedules',
+                'resourcelinks'
+            ]
+        )
         if not r['success']:
             self._failure(
-                'getting existing scenes for this room',
+                'getting the current bridge configuration',
                 r['errors']
             )
-        return [x for x in r['records'] if x['group']['rid'] == self.room['id']]
+        return inventory
+
+    def _get_scenes_for_room(self):
+        return self.inventory.scenes_in(self.room['id'])
 
     def _get_lights_in_room(self):
         lights = []
-        for child in self.room['children']:
-            r = self.bridge.get(child['rtype'], child['rid'])
-            if not r['success']:
-                self._failure('finding lights', r['errors'])
-            r['record']['is_lamp'] = \
-                'lamp' in r['record']['metadata']['name'].lower()
-
-            is_light = \
-                'light' in [x['rtype'] for x in r['record']['services']]
-            if is_light:
-                for service in r['record']['services']:
-                    if service['rtype'] == 'light':
-                        r['record']['light_service_id'] = service['rid']
-                lights.append(r['record'])
+        for device in self.inventory.devices_in(self.room):
+            services = {x['rtype']: x['rid'] for x in device['services']}
+            if 'light' not in services:
+                continue
+            lights.append(device | {
+                'is_lamp': 'lamp' in device['metadata']['name'].lower(),
+                'light_service_id': services['light']
+            })
         return lights
 
     def _get_light_level_sensor_for(self, sensor):
-        r = self.bridge.get('sensors', sensor['id_v1'].replace('/sensors/', ''))
-        if not r['success']:
-            self._failure('getting v1 presence sensor', r['errors'])
-        presence_sensor = r['record']
-        r = self.bridge.search('sensors')
-        if not r['success']:
-            self._failure('getting Sensor list', r['errors'])
-        all_sensors = [
-            (y | {'id_v1': f"/sensors/{x}"}) for x, y in r['records'].items()
-            if 'uniqueid' in y
-        ]
+        id = sensor['id_v1'].replace('/sensors/', '')
+        presence_sensor = self.inventory.get('sensors', id)
+        if not presence_sensor:
+            self._failure(
+                'getting v1 presence sensor',
+                f"{sensor['id_v1']} was not found."
+            )
         unique_id = presence_sensor['uniqueid'][:27]
-        try:
-            return [
-                x for x in all_sensors if x['uniqueid'] == f"{unique_id}0400"
-            ][0]
-        except IndexError:
-            self._failure('finding light sensor', 'Light sensor not found!')
+        for x in self.inventory.with_uniqueid_prefix(unique_id):
+            if x['uniqueid'] == f"{unique_id}0400":
+                return x
+        self._failure('finding light sensor', 'Light sensor not found!')
 
     def _get_resourcelink(self, type):
-        r = self.bridge.search('resourcelinks')
-        if not r['success']:
-            self._failure(
-                'getting Resource Links',
-                r['errors']
-            )
+        resourcelinks = self.inventory.records('resourcelinks')
         name = f"{self.room_name_min}{type}"
-        if name in [x['name'] for x in r['records'].values()]:
+        if name in [x['name'] for x in resourcelinks.values()]:
             return [
                 y | {'id_v1': f"/resourcelinks/{x}"}
-                for x, y in r['records'].items()
+                for x, y in resourcelinks.items()
                 if y['name'] == name
             ][0]
         return
 
-    def _post(self, task, endpoint, payload):
-        r = self.bridge.post(endpoint, payload)
-        if not r['success']:
-            self._failure(task, r['errors'])
-        record = r['record'] | {'endpoint': endpoint}
-        self.records_posted.append(record)
-        return r['record']
-
     def _delete_records_in(self, config):
+        plan = Plan(self.bridge)
         for link in config['links']:
-            r = self.bridge.delete(link.split('/')[1], link.split('/')[2])
-            if not r['success']:
-                self._failure('removing existing configuration', r['errors'])
-        r = self.bridge.delete(
-            config['id_v1'].split('/')[1],
-            config['id_v1'].split('/')[2]
-        )
-        if not r['success']:
-            self._failure('removing existing configuration', r['errors'])
-        return
-
-        return self._remove_success()
+            endpoint, id = link.split('/')[1:3]
+            plan.delete(
+                'removing existing configuration',
+                endpoint,
+                id,
+                self.inventory.collections.get(endpoint, {}).get(id)
+            )
+        endpoint, id = config['id_v1'].split('/')[1:3]
+        plan.delete('removing existing configuration', endpoint, id, config)
+        return self._apply(plan)
 
     def _build_time_interval_string(self, scene_name):
         get_end = {
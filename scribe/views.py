@@ -1,3 +1,6 @@
+import fcntl
+
+from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.views.generic import View
 from heating.workflows import Heating
@@ -5,6 +8,18 @@ from heating.workflows import Heating
 
 class RecordData(View):
     def get(self, request, *args, **kwargs):
-        heating = Heating()
-        heating.record_current_data()
+        # A running collection scheduler holds the lock and is already
+        # recording, so this cycle is skipped rather than doubled up.
+        lock = open(settings.HEATING_SCHEDULER_LOCK, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return HttpResponse(status=204)
+        try:
+            heating = Heating()
+            heating.record_current_data()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
         return HttpResponse(status=204)
\ No newline at end of file